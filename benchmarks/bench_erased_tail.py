@@ -0,0 +1,80 @@
+"""
+Upload time saved by leaving the erased tail of an image out of the upload.
+
+Flashes each image twice on the bootloader simulator, once in full and once
+without the run of 0xFF bytes at its end, and reports the bytes left out, the
+erase-to-CRC time of both uploads and whether both CRCs match the expected
+one. Pass real ArduPilot or PX4 builds, as the amount of trailing padding
+depends on the linker script and the build:
+
+    python benchmarks/bench_erased_tail.py arducopter.apj px4_fmu-v5_default.px4
+    python benchmarks/bench_erased_tail.py --baudrate 115200 --latency 0.001 build/*.apj
+
+Without files, a synthetic image with a 64 KB erased tail is used.
+"""
+import argparse
+import random
+import time
+import sys
+import os
+
+from serial import Serial
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from bootloader_protocol import _erase_program_area, _get_crc, _write_to_program_area  # noqa: E402
+from bootloader_simulator import BootloaderSimulator  # noqa: E402
+from firmware import Firmware, Image, erased_tail, load_firmware, _pad  # noqa: E402
+
+
+def flash(simulator: BootloaderSimulator, image: Image, window: int) -> tuple[float, int]:
+    with Serial(simulator.port, 115200, timeout=2) as ser:
+        start = time.perf_counter()
+        _erase_program_area(ser)
+        for _ in _write_to_program_area(ser, image, window):
+            pass
+        crc = _get_crc(ser)
+        return time.perf_counter() - start, crc
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("paths", nargs="*", help=".apj, .px4, .bin or .hex firmware files")
+    parser.add_argument("--board-id", type=int, default=9, help="board id of .bin and .hex files")
+    parser.add_argument("--latency", type=float, default=0.001, help="seconds before each reply")
+    parser.add_argument("--baudrate", type=int, default=None, help="simulated UART baud rate")
+    parser.add_argument("--program-time", type=float, default=0, help="seconds spent per chunk")
+    parser.add_argument("--window", type=int, default=8, help="upload window")
+    args = parser.parse_args()
+
+    if args.paths:
+        firmwares = [(os.path.basename(path), load_firmware(path, args.board_id)) for path in args.paths]
+    else:
+        image = random.Random(0).randbytes(1024 * 1024) + b'\xff' * 64 * 1024
+        firmwares = [("synthetic", Firmware(board_id=args.board_id, image_size=len(image), image=image))]
+
+    print(f"{'firmware':>24} {'size':>9} {'elided':>8} {'full s':>7} {'elided s':>8} {'saved':>6} {'crc':>4}")
+    for name, firmware in firmwares:
+        image = _pad(firmware.image)
+        elided = erased_tail(image)
+        times = []
+        crcs = []
+        for upload in (image, memoryview(image)[:len(image)-elided]):
+            with BootloaderSimulator(
+                board_id=firmware.board_id,
+                flash_size=max(len(image), 2 * 1024 * 1024 - 16 * 1024),
+                latency=args.latency,
+                baudrate=args.baudrate,
+                program_time=args.program_time
+            ) as simulator:
+                seconds, crc = flash(simulator, upload, args.window)
+                times.append(seconds)
+                crcs.append(crc)
+                expected = firmware.expected_crc32(simulator.flash_size)
+        saved = 1 - times[1] / times[0] if times[0] else 0.0
+        crc_ok = "ok" if crcs[0] == crcs[1] == expected else "FAIL"
+        print(f"{name[-24:]:>24} {len(image):>9} {elided:>8} {times[0]:>7.2f} {times[1]:>8.2f} {saved:>6.1%} {crc_ok:>4}")
+
+
+if __name__ == "__main__":
+    main()
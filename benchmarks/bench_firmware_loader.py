@@ -0,0 +1,82 @@
+"""
+Memory benchmark of the .apj loader and the upload chunker.
+
+Compares the loader and chunk list that _write_to_program_area used to build
+with the streaming loader and iter_chunks, reporting the peak traced memory
+(in multiples of the image size) and the number of allocations still alive
+once the chunks are planned.
+
+    python benchmarks/bench_firmware_loader.py --size 2097152
+"""
+from base64 import b64decode, b64encode
+import argparse
+import tempfile
+import tracemalloc
+import random
+import json
+import zlib
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from firmware import iter_chunks, load_firmware  # noqa: E402
+
+CHUNK_SIZE = 252
+
+
+def legacy_load(path: str) -> list[bytes]:
+    with open(path, "r") as file:
+        firmware_file: dict = json.load(file)
+    image = zlib.decompress(b64decode(firmware_file["image"]))
+    while ((len(image) % 4) != 0):
+        image += bytes(0xFF)
+
+    chunks: list[bytes] = []
+    for i in range(0, len(image), CHUNK_SIZE):
+        chunks.append(image[i: i+CHUNK_SIZE])
+    return chunks
+
+
+def streaming_load(path: str) -> list:
+    firmware = load_firmware(path)
+    chunks = iter_chunks(firmware.image, CHUNK_SIZE)
+    return [firmware, chunks]
+
+
+def measure(load, path: str) -> tuple[int, int]:
+    tracemalloc.start()
+    baseline = tracemalloc.take_snapshot()
+    result = load(path)
+    snapshot = tracemalloc.take_snapshot()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    allocations = sum(stat.count_diff for stat in snapshot.compare_to(baseline, "filename"))
+    del result
+    return peak, allocations
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=2 * 1024 * 1024 - 1, help="image size in bytes")
+    args = parser.parse_args()
+
+    # half random, half zeros, to compress roughly like a real image
+    rng = random.Random(0)
+    image = rng.randbytes(args.size // 2) + bytes(args.size - args.size // 2)
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "firmware.apj")
+        with open(path, "w") as file:
+            json.dump({"board_id": 9, "image_size": len(image), "image": b64encode(zlib.compress(image)).decode()}, file)
+
+        print(f"image size: {len(image)} bytes, .apj size: {os.path.getsize(path)} bytes")
+        for name, load in (("legacy", legacy_load), ("streaming", streaming_load)):
+            peak, allocations = measure(load, path)
+            print(f"{name:>10}: peak {peak / 1e6:7.2f} MB ({peak / len(image):4.2f} x image), "
+                  f"{allocations:6d} live allocations")
+
+
+if __name__ == "__main__":
+    main()
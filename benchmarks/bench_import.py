@@ -0,0 +1,71 @@
+"""
+Cold-start import time of the uploader modules.
+
+Imports each module in a fresh interpreter, several times, and reports the
+median and fastest import time and whether pymavlink or pyserial's port
+enumeration were loaded. Only rebooting an autopilot needs pymavlink, so none
+of these modules should load it. Exits with status 1 if a module loads a lazy
+dependency or takes longer than --target on median, so it can guard CI:
+
+    python benchmarks/bench_import.py
+    python benchmarks/bench_import.py --target 0.1 --runs 20 bootloader_protocol
+"""
+import statistics
+import subprocess
+import argparse
+import json
+import sys
+import os
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+
+MODULES = ("bootloader_protocol", "boards", "firmware", "async_protocol", "batch_upload", "firmware_library", "inventory")
+
+# loaded only when first needed
+LAZY_MODULES = ("pymavlink", "serial.tools.list_ports")
+
+PROBE = """
+import time, sys, json
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps([elapsed, [name for name in {lazy!r} if name in sys.modules]]))
+"""
+
+
+def import_time(module: str) -> tuple[float, list[str]]:
+    output = subprocess.run(
+        [sys.executable, "-c", PROBE.format(module=module, lazy=LAZY_MODULES)],
+        cwd=SRC, capture_output=True, text=True, check=True
+    ).stdout
+    elapsed, loaded = json.loads(output)
+    return elapsed, loaded
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("modules", nargs="*", default=MODULES, help="modules to import")
+    parser.add_argument("--runs", type=int, default=10, help="fresh interpreters per module")
+    parser.add_argument("--target", type=float, default=0.1, help="maximum median import time in seconds")
+    args = parser.parse_args()
+
+    failed = False
+    print(f"{'module':>20} {'median ms':>9} {'min ms':>7}  lazily loaded modules imported")
+    for module in args.modules:
+        # the first run compiles the bytecode cache
+        import_time(module)
+        times = []
+        loaded: set[str] = set()
+        for _ in range(args.runs):
+            elapsed, names = import_time(module)
+            times.append(elapsed)
+            loaded.update(names)
+        median = statistics.median(times)
+        failed = failed or median > args.target or bool(loaded)
+        print(f"{module:>20} {median * 1000:>9.1f} {min(times) * 1000:>7.1f}  {', '.join(sorted(loaded)) or '-'}")
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+End-to-end upload benchmark against the bootloader simulator.
+
+Flashes images from 256 KB to 2 MB through upload_firmware on a simulated
+board and reports the wall time of the whole flash, the upload throughput and
+the CPU time spent by the uploader thread:
+
+    python benchmarks/bench_upload.py --latency 0.001 --windows 1 8 32
+    python benchmarks/bench_upload.py --baudrate 921600 --erase-time 2
+"""
+import argparse
+import random
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from bootloader_protocol import upload_firmware  # noqa: E402
+from bootloader_simulator import BootloaderSimulator  # noqa: E402
+from firmware import Firmware  # noqa: E402
+
+SIZES = (256 * 1024, 512 * 1024, 1024 * 1024, 2 * 1024 * 1024 - 16 * 1024)
+
+
+def flash(simulator: BootloaderSimulator, firmware: Firmware, window: int) -> tuple[float, float, float]:
+    wall_start = time.perf_counter()
+    cpu_start = time.thread_time()
+    upload_time = 0.0
+    upload_start = None
+    for progress in upload_firmware(simulator.port, firmware, window):
+        if upload_start is None and progress["Uploading Firmware"] == "0%":
+            upload_start = time.perf_counter()
+        if upload_start is not None and progress["Verifying Firmware"] == "in progress" and not upload_time:
+            upload_time = time.perf_counter() - upload_start
+    return time.perf_counter() - wall_start, upload_time, time.thread_time() - cpu_start
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--latency", type=float, default=0.001, help="seconds before each reply")
+    parser.add_argument("--baudrate", type=int, default=None, help="simulated UART baud rate")
+    parser.add_argument("--erase-time", type=float, default=0, help="seconds spent erasing")
+    parser.add_argument("--program-time", type=float, default=0, help="seconds spent per chunk")
+    parser.add_argument("--windows", type=int, nargs="+", default=[1, 8], help="upload windows to compare")
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES, help="image sizes in bytes")
+    args = parser.parse_args()
+
+    print(f"{'size':>9} {'window':>6} {'flash s':>8} {'upload kB/s':>11} {'cpu s':>6}")
+    for size in args.sizes:
+        image = random.Random(size).randbytes(size)
+        firmware = Firmware(board_id=9, image_size=size, image=image)
+        for window in args.windows:
+            with BootloaderSimulator(
+                latency=args.latency,
+                baudrate=args.baudrate,
+                erase_time=args.erase_time,
+                program_time=args.program_time
+            ) as simulator:
+                wall, upload, cpu = flash(simulator, firmware, window)
+            throughput = size / upload / 1000 if upload else float("nan")
+            print(f"{size:>9} {window:>6} {wall:>8.2f} {throughput:>11.1f} {cpu:>6.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,429 @@
+"""
+asyncio versions of get_board_info and upload_firmware.
+
+The bootloader is driven through AsyncSerial, which opens the port in
+non-blocking mode and waits for replies on the event loop, so one loop can
+flash dozens of boards at once. Only the parts that have no non-blocking
+equivalent run on a worker thread: connecting, which may have to reboot the
+autopilot through pymavlink, and decoding the firmware file.
+
+Cancelling an upload, or closing its progress iterator early, drains the
+replies that are still in flight and re-syncs with the bootloader before the
+port is closed, so the board is left waiting in its bootloader.
+"""
+from typing import AsyncGenerator, Optional, TYPE_CHECKING, Union
+from collections import deque
+import asyncio
+import struct
+import time
+
+from serial import Serial
+
+from bootloader_protocol import (
+    _check_firmware_compatibility, _connect, _device_info, _firmware_metadata, _get_sync, _negotiate_baudrate,
+    _prepare_image, _PreparedImage,
+    _parse_chip_description_length, _parse_chip_description_reply, _parse_device_info, _validate_response,
+    _DEVICE_INFO_FIXED_SIZE, _DEVICE_INFO_QUERIES, _INFO_PARAMS, _SN_WORD_ADDRESSES,
+    CHIP_ERASE, END_OF_CMD, GET_CHIP_DES, GET_CRC, GET_DEVICE, GET_SN, GET_SYNC, IN_SYNC,
+    INFO_BL_REV, INFO_BOARD_ID, INFO_FLASH_SIZE, PROGRAM_MULTIPLE_BYTES, PROGRESS_INTERVAL,
+    RECOVERY_QUIET_TIME, REBOOT, RetryPolicy, VerificationError
+)
+from boards import match_boards_by_id
+from firmware import Firmware, Image, iter_chunks, _pad
+from metrics import MetricsSink, UploadMetrics
+
+if TYPE_CHECKING:
+    from image_cache import ImageCache
+
+
+# seconds between checks for data on ports without a selectable file descriptor
+POLL_INTERVAL = 0.005
+
+
+class AsyncSerial:
+    """ Non-blocking reads and writes on an open Serial. """
+
+    def __init__(self, ser: Serial) -> None:
+        self.ser = ser
+        self.ser.timeout = 0
+        self.name = ser.name
+        try:
+            self._fd: Optional[int] = ser.fileno()
+        except (AttributeError, OSError):
+            self._fd = None
+
+    async def _wait_readable(self, timeout: float) -> None:
+        if self._fd is None:
+            await asyncio.sleep(min(POLL_INTERVAL, timeout))
+            return
+
+        loop = asyncio.get_running_loop()
+        readable = asyncio.Event()
+        loop.add_reader(self._fd, readable.set)
+        try:
+            await asyncio.wait_for(readable.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            loop.remove_reader(self._fd)
+
+    async def read(self, size: int, timeout: float = 2) -> bytes:
+        """ Read `size` bytes, or whatever arrived within `timeout` seconds. """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        data = b''
+        while len(data) < size:
+            data += self.ser.read(size - len(data))
+            if len(data) == size:
+                break
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            await self._wait_readable(remaining)
+        return data
+
+    def write(self, data: bytes) -> None:
+        self.ser.write(data)
+
+    def reset_input_buffer(self) -> None:
+        self.ser.reset_input_buffer()
+
+    def close(self) -> None:
+        self.ser.close()
+
+
+async def _command(aser: AsyncSerial, command: bytes, reply_size: int = 0, timeout: float = 2) -> bytes:
+    """ Send `command` and return its `reply_size` reply bytes once IN_SYNC/OK is validated. """
+    aser.reset_input_buffer()
+    aser.write(command)
+    reply = await aser.read(reply_size + 2, timeout)
+    if len(reply) < reply_size + 2:
+        if reply[:1] == IN_SYNC:
+            # a rejected command only gets IN_SYNC and the status back
+            _validate_response(reply[:1], reply[1:2])
+        raise RuntimeError(f"Expected to recieve {reply_size + 2} bytes from the buffer, but got {len(reply)}")
+    _validate_response(reply[reply_size: reply_size+1], reply[reply_size+1: reply_size+2])
+    return reply[:reply_size]
+
+
+async def _get_info(aser: AsyncSerial, param: bytes) -> int:
+    return struct.unpack("<I", await _command(aser, GET_DEVICE + param + END_OF_CMD, 4))[0]
+
+
+async def _get_device_info(aser: AsyncSerial, batched: bool = True) -> dict[str, Union[int, str]]:
+    if batched:
+        aser.reset_input_buffer()
+        aser.write(b''.join(_DEVICE_INFO_QUERIES))
+        fixed_reply = await aser.read(_DEVICE_INFO_FIXED_SIZE)
+        try:
+            info, sn_raw, length = _parse_device_info(fixed_reply)
+            chip = _parse_chip_description_reply(await aser.read(length + 2), length)
+            return _device_info(info, sn_raw, chip)
+        except (RuntimeError, UnicodeDecodeError, ValueError):
+            # the bootloader can't keep up with back-to-back commands, let it
+            # answer whatever it got, then start over
+            await _discard_late_replies(aser)
+            await _resync(aser)
+
+    info = [await _get_info(aser, param) for param in _INFO_PARAMS]
+
+    sn_raw = b''
+    for addr in _SN_WORD_ADDRESSES:
+        sn_raw += (await _command(aser, GET_SN + struct.pack("I", addr) + END_OF_CMD, 4))[::-1]
+
+    aser.reset_input_buffer()
+    aser.write(GET_CHIP_DES + END_OF_CMD)
+    length = _parse_chip_description_length(await aser.read(4))
+    chip = _parse_chip_description_reply(await aser.read(length + 2), length)
+
+    return _device_info(info, sn_raw, chip)
+
+
+async def _resync(aser: AsyncSerial, attempts: int = 3) -> None:
+    for _ in range(attempts):
+        try:
+            await _command(aser, GET_SYNC + END_OF_CMD)
+            return
+        except RuntimeError:
+            pass
+    raise RuntimeError("Lost sync with the bootloader")
+
+
+async def _erase_program_area(aser: AsyncSerial, timeout: float = 20) -> None:
+    aser.reset_input_buffer()
+    aser.write(CHIP_ERASE + END_OF_CMD)
+    reply = await aser.read(2, timeout)
+    if not reply:
+        raise TimeoutError("Couldn't recieve a response from the board after erasing the chip")
+    _validate_response(reply[:1], reply[1:2])
+
+
+async def _write_to_program_area(
+    aser: AsyncSerial,
+    image: Image,
+    window: int = 1,
+    metrics: Optional[UploadMetrics] = None,
+    progress_interval: float = PROGRESS_INTERVAL
+) -> AsyncGenerator[str, None]:
+    """ The asyncio version of bootloader_protocol._write_to_program_area. """
+    CHUNK_SIZE = 252
+
+    if window < 1:
+        raise ValueError(f"Expected the upload window to be at least 1, but got {window}")
+
+    aser.reset_input_buffer()
+    image = _pad(image)
+    if metrics is not None:
+        metrics.image_bytes = len(image)
+    total_chunks = (len(image) + CHUNK_SIZE - 1) // CHUNK_SIZE
+    chunks = iter_chunks(image, CHUNK_SIZE)
+    in_flight: deque[tuple[int, int, float]] = deque()
+
+    acked_chunks = 0
+    last_report = time.monotonic()
+    try:
+        while True:
+            while len(in_flight) < window:
+                offset, chunk = next(chunks, (None, None))
+                if chunk is None:
+                    break
+                aser.write(PROGRAM_MULTIPLE_BYTES + len(chunk).to_bytes() + chunk + END_OF_CMD)
+                in_flight.append((offset, len(chunk), time.monotonic()))
+
+            if not in_flight:
+                break
+
+            reply = await aser.read(2)
+            offset, length, sent = in_flight.popleft()
+            now = time.monotonic()
+            try:
+                _validate_response(reply[:1], reply[1:2])
+            except RuntimeError as err:
+                await aser.read(2 * len(in_flight))
+                in_flight.clear()
+                aser.reset_input_buffer()
+                raise RuntimeError(f"Failed to program the chunk at offset {offset:#x}: {err}") from err
+
+            acked_chunks += 1
+            if metrics is not None:
+                metrics.ack_latency.observe(now - sent)
+                metrics.bytes_acked += length
+
+            if now - last_report >= progress_interval or acked_chunks == total_chunks:
+                last_report = now
+                yield f"{round(acked_chunks / total_chunks * 100)}%"
+    except (asyncio.CancelledError, GeneratorExit):
+        # leave the bootloader idle and in sync before giving up the port
+        if in_flight:
+            await aser.read(2 * len(in_flight))
+        aser.reset_input_buffer()
+        await _resync(aser)
+        raise
+
+
+async def _get_crc(aser: AsyncSerial) -> int:
+    return struct.unpack("I", await _command(aser, GET_CRC + END_OF_CMD, 4))[0]
+
+
+async def _discard_late_replies(aser: AsyncSerial) -> None:
+    """ The asyncio version of bootloader_protocol._discard_late_replies. """
+    while await aser.read(4096, RECOVERY_QUIET_TIME):
+        pass
+
+
+async def _recover(aser: AsyncSerial, resync_attempts: int) -> None:
+    """ The asyncio version of bootloader_protocol._recover. """
+    await _discard_late_replies(aser)
+    await _resync(aser, resync_attempts)
+    for param in (INFO_BL_REV, INFO_BOARD_ID, INFO_FLASH_SIZE):
+        await _get_info(aser, param)
+
+
+async def _flash(
+    aser: AsyncSerial,
+    preparing: "asyncio.Task[_PreparedImage]",
+    progress: dict[str, str],
+    metrics: UploadMetrics,
+    window: int,
+    progress_interval: float
+) -> AsyncGenerator[dict[str, str], None]:
+    """ The asyncio version of bootloader_protocol._flash. """
+    with metrics.phase("erase"):
+        await _erase_program_area(aser)
+    prepared = await preparing
+    progress["Erasing Chip"] = "Completed"
+    progress["Uploading Firmware"] = "0%"
+    if prepared.elided:
+        progress["Erased Tail Skipped"] = f"{prepared.elided / 1000:.1f} kB"
+    yield progress
+
+    metrics.bytes_acked = 0
+    uploading = _write_to_program_area(aser, prepared.image, window, metrics, progress_interval)
+    try:
+        with metrics.phase("upload"):
+            async for prog in uploading:
+                progress["Uploading Firmware"] = prog
+                progress["Upload Speed"] = f"{metrics.upload_rate() / 1000:.1f} kB/s"
+                eta = metrics.eta()
+                progress["ETA"] = f"{eta:.1f} s" if eta is not None else "n/a"
+                yield progress
+    finally:
+        # recover the bootloader before the port is closed if we are cut short
+        await uploading.aclose()
+    rate = metrics.upload_rate()
+    progress["Throughput"] = f"{rate / 1000:.1f} kB/s" if rate else "n/a"
+
+    progress["Verifying Firmware"] = "in progress"
+    yield progress
+    with metrics.phase("verify"):
+        actual_crc = await _get_crc(aser)
+    if prepared.expected_crc != actual_crc:
+        raise VerificationError(
+            f"Verification failed. Expected crc value to be {prepared.expected_crc}, but got {actual_crc}"
+        )
+
+
+async def _open(port: str, negotiate_baudrate: bool = False, metrics: Optional[UploadMetrics] = None) -> AsyncSerial:
+    if metrics is None:
+        metrics = UploadMetrics(port=port)
+
+    def connect() -> Serial:
+        with metrics.phase("connect"):
+            ser = _connect(port, timings=metrics.connect_phases)
+        try:
+            with metrics.phase("sync"):
+                _get_sync(ser)
+                if negotiate_baudrate:
+                    _negotiate_baudrate(ser)
+        except BaseException:
+            ser.close()
+            raise
+        return ser
+
+    return AsyncSerial(await asyncio.to_thread(connect))
+
+
+async def get_board_info_async(port: str, batched: bool = True) -> dict[str, Union[int, str, list[str, int]]]:
+    aser = await _open(port)
+    try:
+        board_info = await _get_device_info(aser, batched)
+    finally:
+        aser.close()
+
+    board_info["Select Board"] = match_boards_by_id(board_info["Board ID"])
+    return board_info
+
+
+async def upload_firmware_async(
+    port: str,
+    path: Union[str, Firmware],
+    window: int = 1,
+    cache: Optional["ImageCache"] = None,
+    only_if_different: bool = False,
+    negotiate_baudrate: bool = False,
+    progress_interval: float = PROGRESS_INTERVAL,
+    metrics_sink: Optional[MetricsSink] = None,
+    retry_policy: Optional[RetryPolicy] = None
+) -> AsyncGenerator[dict[str, str], None]:
+    """
+    The asyncio version of bootloader_protocol.upload_firmware, taking the
+    same options but `backup_path` and `trace_path`, and yielding the same
+    progress dicts:
+
+        async for progress in upload_firmware_async("COM3", "arducopter.apj"):
+            print(progress)
+    """
+    if retry_policy is None:
+        retry_policy = RetryPolicy(retries=0)
+
+    metrics = UploadMetrics(port=port)
+    try:
+        aser = await _open(port, negotiate_baudrate, metrics)
+        try:
+            # GET_DEVICE has to be sent before CHIP_ERASE, see upload_firmware
+            with metrics.phase("sync"):
+                await _get_info(aser, INFO_BL_REV)
+                board_id = await _get_info(aser, INFO_BOARD_ID)
+                flash_size = await _get_info(aser, INFO_FLASH_SIZE)
+
+            # the image is prepared while the chip is being erased, see upload_firmware
+            metadata = _firmware_metadata(path) if isinstance(path, Firmware) else \
+                await asyncio.to_thread(_firmware_metadata, path)
+            _check_firmware_compatibility(board_id, flash_size, *metadata)
+            preparing = asyncio.ensure_future(asyncio.to_thread(_prepare_image, path, cache, flash_size, metrics))
+
+            if only_if_different:
+                with metrics.phase("verify"):
+                    identical = await _get_crc(aser) == (await preparing).expected_crc
+                if identical:
+                    if cache is not None:
+                        cache.store_crc((await preparing).firmware, flash_size)
+                    metrics.result = "Skipped"
+                    yield {
+                        "Port": aser.name,
+                        "Erasing Chip": "Skipped",
+                        "Uploading Firmware": "Skipped",
+                        "Verifying Firmware": "Skipped"
+                    }
+                    aser.write(REBOOT + END_OF_CMD)
+                    return
+
+            progress = {
+                "Port": aser.name,
+                "Erasing Chip": "in progress",
+                "Uploading Firmware": "not started",
+                "Verifying Firmware": "not started",
+                "Baud Rate": str(aser.ser.baudrate)
+            }
+            yield progress
+
+            retries = 0
+            while True:
+                flashing = _flash(aser, preparing, progress, metrics, window, progress_interval)
+                try:
+                    async for progress in flashing:
+                        yield progress
+                    break
+                except retry_policy.retry_on as err:
+                    # a firmware that failed to decode fails the same way on the next attempt
+                    if retries >= retry_policy.retries or (preparing.done() and preparing.exception() is not None):
+                        raise
+                    retries += 1
+                    start = time.monotonic()
+                    await asyncio.sleep(retry_policy.delay_before(retries))
+                    await _recover(aser, retry_policy.resync_attempts)
+                    metrics.retries = retries
+                    metrics.recovery_time += time.monotonic() - start
+                    last_error = err
+                finally:
+                    await flashing.aclose()
+
+                progress.update({
+                    "Erasing Chip": "in progress",
+                    "Uploading Firmware": "not started",
+                    "Verifying Firmware": "not started",
+                    "Retries": str(retries),
+                    "Recovery Time": f"{metrics.recovery_time:.2f} s",
+                    "Last Error": str(last_error)
+                })
+                yield progress
+
+            if cache is not None:
+                cache.store_crc((await preparing).firmware, flash_size)
+            metrics.result = "Completed"
+            progress["Verifying Firmware"] = "Completed"
+            yield progress
+
+            aser.write(REBOOT + END_OF_CMD)
+        finally:
+            aser.close()
+    except (asyncio.CancelledError, GeneratorExit):
+        metrics.result = "Cancelled"
+        raise
+    except Exception as err:
+        metrics.result = "Failed"
+        metrics.error = err
+        raise
+    finally:
+        if metrics_sink is not None:
+            metrics_sink(metrics)
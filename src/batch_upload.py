@@ -0,0 +1,89 @@
+"""
+Flashing several boards at once.
+
+Most of the time spent by upload_firmware is blocked on serial I/O or waiting
+for the board to reboot into its bootloader, so the boards are flashed from a
+thread pool and the total time approaches that of the slowest board.
+"""
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Generator, Iterable, Optional, TYPE_CHECKING, Union
+from queue import Queue
+
+from bootloader_protocol import upload_firmware, PROGRESS_INTERVAL, RetryPolicy
+from firmware import Firmware, load_firmware
+
+if TYPE_CHECKING:
+    from image_cache import ImageCache
+    from metrics import MetricsSink
+
+
+def _upload_job(port: str, firmware: "Future[Firmware]", events: Queue, **options) -> None:
+    try:
+        for progress in upload_firmware(port, firmware.result(), **options):
+            event = dict(progress)
+            event["Port"] = port
+            events.put(event)
+    except Exception as err:
+        events.put({"Port": port, "Result": "Failed", "Error": err})
+    else:
+        events.put({"Port": port, "Result": "Completed"})
+
+
+def upload_firmware_batch(
+    jobs: Iterable[tuple[str, str]],
+    max_workers: int = 8,
+    window: int = 1,
+    cache: Optional["ImageCache"] = None,
+    only_if_different: bool = False,
+    negotiate_baudrate: bool = False,
+    progress_interval: float = PROGRESS_INTERVAL,
+    metrics_sink: Optional["MetricsSink"] = None,
+    retry_policy: Optional[RetryPolicy] = None
+) -> Generator[dict[str, Union[str, Exception]], None, dict[str, Optional[Exception]]]:
+    """
+    Flash each (port, firmware path) pair in `jobs`, at most `max_workers`
+    boards at a time. Every firmware file is decoded once, however many boards
+    it is flashed to, and only if it isn't in `cache` already. The other
+    options are passed on to upload_firmware; `metrics_sink` is called from
+    the worker threads, so it has to be thread-safe like PrometheusTextfileSink.
+
+    The progress dicts of all boards are yielded as they arrive, with "Port" set
+    to the port given in `jobs`. The last dict of each board has a "Result" key
+    that is either "Completed" or "Failed", in which case "Error" holds the
+    exception. The generator returns a dict mapping every port to None or to
+    the exception its upload raised.
+    """
+    jobs = list(jobs)
+    ports = [port for port, _ in jobs]
+    if len(set(ports)) != len(ports):
+        raise ValueError("Each port can only be flashed once per batch")
+
+    results: dict[str, Optional[Exception]] = {}
+    if not jobs:
+        return results
+
+    events: Queue = Queue()
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="upload") as executor:
+        # The decoding tasks are queued before the uploads, so a worker never
+        # waits on a firmware that is queued behind it.
+        load = cache.load if cache is not None else load_firmware
+        firmwares: dict[str, Future[Firmware]] = {}
+        for _, path in jobs:
+            if path not in firmwares:
+                firmwares[path] = executor.submit(load, path)
+
+        for port, path in jobs:
+            executor.submit(
+                _upload_job, port, firmwares[path], events,
+                window=window, cache=cache, only_if_different=only_if_different,
+                negotiate_baudrate=negotiate_baudrate, progress_interval=progress_interval,
+                metrics_sink=metrics_sink, retry_policy=retry_policy
+            )
+
+        while len(results) < len(jobs):
+            event = events.get()
+            if "Result" in event:
+                results[event["Port"]] = event.get("Error")
+            yield event
+
+    return results
@@ -0,0 +1,199 @@
+"""
+Indexed lookups of boards by id, name prefix and vendor.
+
+The registry starts from the tables in boards.py and can merge newer board
+manifests from local JSON files. The indexes are only built on the first
+lookup, and can be kept in a JSON cache file that is reused for as long as
+boards.py and the manifests are unchanged.
+
+Two manifest layouts are understood: ArduPilot's manifest.json, a list of
+firmware entries with "platform" and "board_id" (and optionally
+"manufacturer") fields, and a plain {"ardupilot": {name: id}, "px4": {name: id}}.
+"""
+from bisect import bisect_left
+from typing import Iterable, Optional
+import threading
+import json
+import os
+
+import boards
+
+
+FAMILIES = ("ardupilot", "px4")
+
+# name prefixes of the ArduPilot boards in boards.py, by vendor
+_ARDUPILOT_VENDORS: dict[str, str] = {
+    "AIRLink": "sky-drones",
+    "ARK": "ark",
+    "AtomRC": "atomrc",
+    "BETAFPV": "betafpv",
+    "Beast": "iflight",
+    "Blitz": "iflight",
+    "CUAV": "cuav",
+    "Cube": "cubepilot",
+    "DevEBox": "mcudev",
+    "Drotek": "drotek",
+    "Durandal": "holybro",
+    "FlyingMoon": "flyingmoon",
+    "Flywoo": "flywoo",
+    "Foxeer": "foxeer",
+    "JHEMCU": "jhemcu",
+    "Kakute": "holybro",
+    "Mamba": "diatone",
+    "Matek": "matek",
+    "OMNIBUS": "airbot",
+    "Omnibus": "airbot",
+    "PH4-mini": "holybro",
+    "Pix32v5": "holybro",
+}
+
+# bump when the layout of the cache file changes
+_CACHE_VERSION = 2
+
+
+def _vendor_of(family: str, name: str) -> str:
+    if family == "px4":
+        # PX4 targets are named <vendor>_<board>_<label>
+        return name.split("_", 1)[0].lower() if "_" in name else ""
+    for prefix, vendor in _ARDUPILOT_VENDORS.items():
+        if name.startswith(prefix):
+            return vendor
+    return ""
+
+
+def _read_manifest(path: str) -> list[tuple[str, str, int, str]]:
+    """ The (family, name, board id, vendor) entries of a manifest file. """
+    with open(path, "r") as file:
+        manifest = json.load(file)
+
+    entries = []
+    if "firmware" in manifest:
+        for firmware in manifest["firmware"]:
+            if "platform" not in firmware or "board_id" not in firmware:
+                continue
+            vendor = str(firmware.get("manufacturer", "")).lower()
+            entries.append(("ardupilot", firmware["platform"], int(firmware["board_id"]), vendor))
+    else:
+        for family in FAMILIES:
+            for name, board_id in manifest.get(family, {}).items():
+                entries.append((family, name, int(board_id), ""))
+    return entries
+
+
+class BoardRegistry:
+    def __init__(self, manifests: Iterable[str] = (), cache_path: Optional[str] = None) -> None:
+        self.manifests = list(manifests)
+        self.cache_path = cache_path
+        self._lock = threading.Lock()
+        self._index: Optional[tuple] = None
+
+    def add_manifest(self, path: str) -> None:
+        """ Merge the boards of the manifest at `path`, overriding the ids of known names. """
+        with self._lock:
+            self.manifests.append(path)
+            self._index = None
+
+    def _signature(self) -> list:
+        # lists rather than tuples, so it compares equal once read back from JSON
+        files = [boards.__file__] + self.manifests
+        signature: list = [_CACHE_VERSION]
+        for path in files:
+            stat = os.stat(path)
+            signature.append([os.path.abspath(path), stat.st_mtime_ns, stat.st_size])
+        return signature
+
+    def _compile(self) -> tuple:
+        names: dict[str, tuple[str, int, str]] = {}
+        for name, board_id in boards.ap_board_id_mapping.items():
+            names[name] = ("ardupilot", board_id, _vendor_of("ardupilot", name))
+        for name, board_id in boards.px4_board_id_mapping.items():
+            names[name] = ("px4", board_id, _vendor_of("px4", name))
+
+        for path in self.manifests:
+            for family, name, board_id, vendor in _read_manifest(path):
+                vendor = vendor or (names[name][2] if name in names else _vendor_of(family, name))
+                names[name] = (family, board_id, vendor)
+
+        by_id: dict[int, dict[str, list[str]]] = {}
+        by_vendor: dict[str, list[str]] = {}
+        for name, (family, board_id, vendor) in names.items():
+            by_id.setdefault(board_id, {family: [] for family in FAMILIES})[family].append(name)
+            if vendor:
+                by_vendor.setdefault(vendor, []).append(name)
+
+        ids = {name: board_id for name, (_, board_id, _) in names.items()}
+        sorted_names = sorted((name.lower(), name) for name in names)
+        return by_id, ids, by_vendor, sorted_names
+
+    def _load_cache(self, signature: list) -> Optional[tuple]:
+        try:
+            with open(self.cache_path, "r") as file:
+                cached = json.load(file)
+            if cached["signature"] != signature:
+                return None
+            by_id = {int(board_id): names for board_id, names in cached["by_id"].items()}
+            sorted_names = [(lower_name, name) for lower_name, name in cached["sorted_names"]]
+            return by_id, cached["ids"], cached["by_vendor"], sorted_names
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            return None
+
+    def _save_cache(self, signature: list, index: tuple) -> None:
+        by_id, ids, by_vendor, sorted_names = index
+        cached = {
+            "signature": signature,
+            "by_id": by_id,
+            "ids": ids,
+            "by_vendor": by_vendor,
+            "sorted_names": sorted_names
+        }
+        tmp_path = f"{self.cache_path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "w") as file:
+                json.dump(cached, file)
+            os.replace(tmp_path, self.cache_path)
+        except OSError:
+            pass
+
+    def _get_index(self) -> tuple:
+        index = self._index
+        if index is not None:
+            return index
+
+        with self._lock:
+            if self._index is None:
+                signature = self._signature() if self.cache_path else None
+                index = self._load_cache(signature) if signature else None
+                if index is None:
+                    index = self._compile()
+                    if signature:
+                        self._save_cache(signature, index)
+                self._index = index
+            return self._index
+
+    def match_id(self, board_id: int) -> dict[str, list[str]]:
+        """ The names of the boards with `board_id`, by firmware family. """
+        matched = self._get_index()[0].get(board_id)
+        return {family: list(matched[family]) if matched else [] for family in FAMILIES}
+
+    def id_of(self, name: str) -> Optional[int]:
+        return self._get_index()[1].get(name)
+
+    def match_prefix(self, prefix: str) -> list[str]:
+        """ The names starting with `prefix`, ignoring case, in alphabetical order. """
+        sorted_names = self._get_index()[3]
+        prefix = prefix.lower()
+        matched = []
+        for lower_name, name in sorted_names[bisect_left(sorted_names, (prefix, "")):]:
+            if not lower_name.startswith(prefix):
+                break
+            matched.append(name)
+        return matched
+
+    def match_vendor(self, vendor: str) -> list[str]:
+        return list(self._get_index()[2].get(vendor.lower(), []))
+
+    def vendors(self) -> list[str]:
+        return sorted(self._get_index()[2])
+
+
+registry = BoardRegistry()
@@ -221,16 +221,8 @@ px4_board_id_mapping: dict[str, int] = {
 }
 
 
-def match_boards_by_id(desired_id: int) -> dict[str, int]:
-    ap_matched_boards: list[str] = []
-    px4_matched_boards: list[str] = []
+def match_boards_by_id(desired_id: int) -> dict[str, list[str]]:
+    # imported here, the registry is built from the tables above
+    from board_registry import registry
 
-    for name, id in ap_board_id_mapping.items():
-        if id == desired_id:
-            ap_matched_boards.append(name)
-
-    for name, id in px4_board_id_mapping.items():
-        if id == desired_id:
-            px4_matched_boards.append(name)
-
-    return {"ardupilot": ap_matched_boards, "px4": px4_matched_boards}
+    return registry.match_id(desired_id)
@@ -1,18 +1,22 @@
-from typing import Generator, TYPE_CHECKING, Union
-from pymavlink import mavutil
+from typing import Generator, Optional, TYPE_CHECKING, Union
 from serial import Serial
-from serial.tools.list_ports import comports
 from serial.serialutil import SerialException
-from base64 import b64decode
+from concurrent.futures import Future
+from collections import deque
+from dataclasses import dataclass
 from boards import match_boards_by_id
+from firmware import Firmware, Image, erased_tail, iter_chunks, load_firmware, read_firmware_metadata, _pad
+from metrics import MetricsSink, UploadMetrics
+from transport import SocketTransport, Transport, is_tcp_url
+from wire_trace import RecordingTransport, ReplayTransport, is_replay_url
+import threading
 import struct
 import binascii
 import time
-import json
-import zlib
-import array
 
 if TYPE_CHECKING:
+    from serial.tools.list_ports_common import ListPortInfo
+    from image_cache import ImageCache
     from pymavlink.mavutil import mavserial
     from pymavlink.dialects.v20.common import MAVLink_heartbeat_message
 
@@ -30,13 +34,15 @@ INVALID         = b'\x13'
 GET_SYNC        = b'\x21'
 GET_DEVICE      = b'\x22'
 CHIP_ERASE      = b'\x23'
+CHIP_VERIFY     = b'\x24'
 PROGRAM_MULTIPLE_BYTES = b'\x27'
+READ_MULTI      = b'\x28'
 GET_CRC         = b'\x29'
 GET_SN          = b'\x2b'
 GET_CHIP_DES    = b'\x2e'
 
 REBOOT          = b'\x30'
-SET_BAUD        = b'\x33'     # TODO: consider using or deleting this
+SET_BAUD        = b'\x33'
 
 # GET_DEVICE parameters
 INFO_BL_REV     = b'\x01'
@@ -44,41 +50,47 @@ INFO_BOARD_ID   = b'\x02'
 INFO_BOARD_REV  = b'\x03'
 INFO_FLASH_SIZE = b'\x04'
 
-crc_table = array.array('I', [
-    0x00000000, 0x77073096, 0xee0e612c, 0x990951ba, 0x076dc419, 0x706af48f, 0xe963a535, 0x9e6495a3,
-    0x0edb8832, 0x79dcb8a4, 0xe0d5e91e, 0x97d2d988, 0x09b64c2b, 0x7eb17cbd, 0xe7b82d07, 0x90bf1d91,
-    0x1db71064, 0x6ab020f2, 0xf3b97148, 0x84be41de, 0x1adad47d, 0x6ddde4eb, 0xf4d4b551, 0x83d385c7,
-    0x136c9856, 0x646ba8c0, 0xfd62f97a, 0x8a65c9ec, 0x14015c4f, 0x63066cd9, 0xfa0f3d63, 0x8d080df5,
-    0x3b6e20c8, 0x4c69105e, 0xd56041e4, 0xa2677172, 0x3c03e4d1, 0x4b04d447, 0xd20d85fd, 0xa50ab56b,
-    0x35b5a8fa, 0x42b2986c, 0xdbbbc9d6, 0xacbcf940, 0x32d86ce3, 0x45df5c75, 0xdcd60dcf, 0xabd13d59,
-    0x26d930ac, 0x51de003a, 0xc8d75180, 0xbfd06116, 0x21b4f4b5, 0x56b3c423, 0xcfba9599, 0xb8bda50f,
-    0x2802b89e, 0x5f058808, 0xc60cd9b2, 0xb10be924, 0x2f6f7c87, 0x58684c11, 0xc1611dab, 0xb6662d3d,
-    0x76dc4190, 0x01db7106, 0x98d220bc, 0xefd5102a, 0x71b18589, 0x06b6b51f, 0x9fbfe4a5, 0xe8b8d433,
-    0x7807c9a2, 0x0f00f934, 0x9609a88e, 0xe10e9818, 0x7f6a0dbb, 0x086d3d2d, 0x91646c97, 0xe6635c01,
-    0x6b6b51f4, 0x1c6c6162, 0x856530d8, 0xf262004e, 0x6c0695ed, 0x1b01a57b, 0x8208f4c1, 0xf50fc457,
-    0x65b0d9c6, 0x12b7e950, 0x8bbeb8ea, 0xfcb9887c, 0x62dd1ddf, 0x15da2d49, 0x8cd37cf3, 0xfbd44c65,
-    0x4db26158, 0x3ab551ce, 0xa3bc0074, 0xd4bb30e2, 0x4adfa541, 0x3dd895d7, 0xa4d1c46d, 0xd3d6f4fb,
-    0x4369e96a, 0x346ed9fc, 0xad678846, 0xda60b8d0, 0x44042d73, 0x33031de5, 0xaa0a4c5f, 0xdd0d7cc9,
-    0x5005713c, 0x270241aa, 0xbe0b1010, 0xc90c2086, 0x5768b525, 0x206f85b3, 0xb966d409, 0xce61e49f,
-    0x5edef90e, 0x29d9c998, 0xb0d09822, 0xc7d7a8b4, 0x59b33d17, 0x2eb40d81, 0xb7bd5c3b, 0xc0ba6cad,
-    0xedb88320, 0x9abfb3b6, 0x03b6e20c, 0x74b1d29a, 0xead54739, 0x9dd277af, 0x04db2615, 0x73dc1683,
-    0xe3630b12, 0x94643b84, 0x0d6d6a3e, 0x7a6a5aa8, 0xe40ecf0b, 0x9309ff9d, 0x0a00ae27, 0x7d079eb1,
-    0xf00f9344, 0x8708a3d2, 0x1e01f268, 0x6906c2fe, 0xf762575d, 0x806567cb, 0x196c3671, 0x6e6b06e7,
-    0xfed41b76, 0x89d32be0, 0x10da7a5a, 0x67dd4acc, 0xf9b9df6f, 0x8ebeeff9, 0x17b7be43, 0x60b08ed5,
-    0xd6d6a3e8, 0xa1d1937e, 0x38d8c2c4, 0x4fdff252, 0xd1bb67f1, 0xa6bc5767, 0x3fb506dd, 0x48b2364b,
-    0xd80d2bda, 0xaf0a1b4c, 0x36034af6, 0x41047a60, 0xdf60efc3, 0xa867df55, 0x316e8eef, 0x4669be79,
-    0xcb61b38c, 0xbc66831a, 0x256fd2a0, 0x5268e236, 0xcc0c7795, 0xbb0b4703, 0x220216b9, 0x5505262f,
-    0xc5ba3bbe, 0xb2bd0b28, 0x2bb45a92, 0x5cb36a04, 0xc2d7ffa7, 0xb5d0cf31, 0x2cd99e8b, 0x5bdeae1d,
-    0x9b64c2b0, 0xec63f226, 0x756aa39c, 0x026d930a, 0x9c0906a9, 0xeb0e363f, 0x72076785, 0x05005713,
-    0x95bf4a82, 0xe2b87a14, 0x7bb12bae, 0x0cb61b38, 0x92d28e9b, 0xe5d5be0d, 0x7cdcefb7, 0x0bdbdf21,
-    0x86d3d2d4, 0xf1d4e242, 0x68ddb3f8, 0x1fda836e, 0x81be16cd, 0xf6b9265b, 0x6fb077e1, 0x18b74777,
-    0x88085ae6, 0xff0f6a70, 0x66063bca, 0x11010b5c, 0x8f659eff, 0xf862ae69, 0x616bffd3, 0x166ccf45,
-    0xa00ae278, 0xd70dd2ee, 0x4e048354, 0x3903b3c2, 0xa7672661, 0xd06016f7, 0x4969474d, 0x3e6e77db,
-    0xaed16a4a, 0xd9d65adc, 0x40df0b66, 0x37d83bf0, 0xa9bcae53, 0xdebb9ec5, 0x47b2cf7f, 0x30b5ffe9,
-    0xbdbdf21c, 0xcabac28a, 0x53b39330, 0x24b4a3a6, 0xbad03605, 0xcdd70693, 0x54de5729, 0x23d967bf,
-    0xb3667a2e, 0xc4614ab8, 0x5d681b02, 0x2a6f2b94, 0xb40bbe37, 0xc30c8ea1, 0x5a05df1b, 0x2d02ef8d]
-)
-crc_padding = bytearray(b'\xff\xff\xff\xff')
+# seconds to wait for a GET_SYNC reply while looking for the bootloader
+SYNC_PROBE_TIMEOUT = 0.25
+# seconds to wait for the bootloader to appear after a reboot, and between polls
+REBOOT_TIMEOUT = 10
+REBOOT_POLL_INTERVAL = 0.1
+
+# baud rates tried by _negotiate_baudrate, fastest first
+NEGOTIATED_BAUDRATES = (2000000, 1500000, 1000000, 921600, 460800, 230400)
+
+# seconds to wait for the reply to CHIP_ERASE
+ERASE_TIMEOUT = 20
+
+# minimum seconds between two upload progress reports
+PROGRESS_INTERVAL = 0.5
+# seconds without data after which the late replies of a failed upload are all in
+RECOVERY_QUIET_TIME = 0.1
+
+
+class VerificationError(Exception):
+    """ The flash CRC doesn't match the firmware after uploading. """
+
+
+@dataclass
+class RetryPolicy:
+    """
+    How upload_firmware recovers from a failed erase, upload or verification.
+    The bootloader is re-synced on the port that is already open and the
+    image is erased and uploaded again, without rebooting the board.
+    """
+    # attempts after the first one
+    retries: int = 2
+    # seconds to wait before the first retry, multiplied by `backoff` for each further one
+    delay: float = 0.1
+    backoff: float = 2.0
+    # GET_SYNC attempts before the bootloader is considered lost
+    resync_attempts: int = 5
+    retry_on: tuple[type[Exception], ...] = (RuntimeError, TimeoutError, VerificationError)
+
+    def delay_before(self, retry: int) -> float:
+        """ The seconds to wait before the `retry`-th retry, counted from 1. """
+        return self.delay * self.backoff ** (retry - 1)
 
 
 def _validate_response(recv_in_sync: bytes, recv_status: bytes) -> None:
@@ -93,70 +105,327 @@ def _validate_response(recv_in_sync: bytes, recv_status: bytes) -> None:
         raise RuntimeError(f"Expected to recieve OK byte, but got {recv_status}")
 
 
-def _get_sync(ser: Serial) -> None:
+def _read_reply(ser: Transport, size: int = 0) -> bytes:
+    """
+    Read a reply of `size` bytes followed by IN_SYNC and the status in a
+    single read, and return the `size` bytes once the status is validated.
+    A rejected command only gets IN_SYNC and the status back.
+    """
+    reply = ser.read(size + 2)
+    if len(reply) < size + 2:
+        if reply[:1] == IN_SYNC:
+            _validate_response(reply[:1], reply[1:2])
+        raise RuntimeError(f"Expected to recieve {size + 2} bytes from the buffer, but got {len(reply)}")
+    _validate_response(reply[size: size+1], reply[size+1:])
+    return reply[:size]
+
+
+def _get_sync(ser: Transport) -> None:
     ser.reset_input_buffer()
     ser.write(GET_SYNC + END_OF_CMD)
-    recv_in_sync = ser.read(1)
-    recv_status = ser.read(1)
-    _validate_response(recv_in_sync, recv_status)
+    _read_reply(ser)
 
 
-def _get_info(ser: Serial, param: bytes) -> int:
+def _set_baud(ser: Transport, baudrate: int) -> None:
     ser.reset_input_buffer()
-    ser.write(GET_DEVICE + param + END_OF_CMD)
+    ser.write(SET_BAUD + struct.pack("<I", baudrate) + END_OF_CMD)
     ser.flush()
+    _read_reply(ser)
+
+    # the bootloader replies at the old rate before switching
+    ser.baudrate = baudrate
+    time.sleep(0.02)
+
+
+def _resync(ser: Transport, attempts: int = 3) -> bool:
+    for _ in range(attempts):
+        try:
+            _get_sync(ser)
+            return True
+        except RuntimeError:
+            pass
+    return False
 
-    info_bytes = ser.read(4)
-    if len(info_bytes) < 4:
-        raise RuntimeError("Expected to recieve 4 bytes from the buffer, but got", info_bytes)
-    info = struct.unpack("<I", info_bytes)
 
-    recv_in_sync = ser.read(1)
-    recv_status = ser.read(1)
-    _validate_response(recv_in_sync, recv_status)
+def _negotiate_baudrate(ser: Transport, baudrates: tuple[int, ...] = NEGOTIATED_BAUDRATES) -> int:
+    """
+    Switch the bootloader and the port to the fastest of `baudrates` that
+    both support, and return the rate in use afterwards. If the bootloader
+    doesn't answer at a new rate, both ends are moved back to the rate the
+    port was opened with. Boards on native USB ignore the baud rate, so this
+    only pays off on real UARTs and USB-serial adapters.
+    """
+    default = ser.baudrate
+    supported = set(getattr(ser, "BAUDRATES", ()))
+
+    for baudrate in baudrates:
+        if baudrate <= default or baudrate not in supported:
+            continue
+
+        try:
+            _set_baud(ser, baudrate)
+        except RuntimeError:
+            # this bootloader doesn't implement SET_BAUD
+            ser.reset_input_buffer()
+            return default
+
+        if _resync(ser):
+            return baudrate
+
+        # Nothing at the new rate, ask for the old one at the new rate in case
+        # only the replies were garbled, then look for the bootloader there.
+        try:
+            ser.write(SET_BAUD + struct.pack("<I", default) + END_OF_CMD)
+            ser.flush()
+            time.sleep(0.02)
+        finally:
+            ser.baudrate = default
+        if not _resync(ser):
+            raise RuntimeError(f"Lost sync with the bootloader after switching to {baudrate} baud")
+
+    return default
+
+
+def _get_info(ser: Transport, param: bytes) -> int:
+    ser.reset_input_buffer()
+    ser.write(GET_DEVICE + param + END_OF_CMD)
+    ser.flush()
 
-    return info[0]
+    return struct.unpack("<I", _read_reply(ser, 4))[0]
 
 
-def _get_serial_number(ser: Serial) -> str:
+def _get_serial_number(ser: Transport) -> str:
     sn_word_address = [0, 4, 8]
     sn_raw = b''
     for addr in sn_word_address:
         ser.reset_input_buffer()
         ser.write(GET_SN + struct.pack("I", addr) + END_OF_CMD)
-        sn_raw += ser.read(4)[::-1]
-        
-        recv_in_sync = ser.read(1)
-        recv_status = ser.read(1)
-        _validate_response(recv_in_sync, recv_status)
+        sn_raw += _read_reply(ser, 4)[::-1]
 
     serial_number = binascii.hexlify(sn_raw).decode()
     return serial_number
 
 
-def _get_chip_description(ser: Serial) -> str:
+def _get_chip_description(ser: Transport) -> str:
     ser.reset_input_buffer()
     ser.write(GET_CHIP_DES + END_OF_CMD)
-    length: int = struct.unpack("I", ser.read(4))[0]
-    desc_buf = ser.read(length)
+    length = _parse_chip_description_length(ser.read(4))
+    desc_buf = _read_reply(ser, length)
+
+    return _format_chip_description(desc_buf)
+
 
-    recv_in_sync = ser.read(1)
-    recv_status = ser.read(1)
-    _validate_response(recv_in_sync, recv_status)
+def _parse_chip_description_length(length_bytes: bytes) -> int:
+    """ The length the reply to GET_CHIP_DES starts with. """
+    if len(length_bytes) < 4:
+        if length_bytes[:1] == IN_SYNC:
+            # a rejected command only gets IN_SYNC and the status back
+            _validate_response(length_bytes[:1], length_bytes[1:2])
+        raise RuntimeError(f"Expected to recieve 4 bytes from the buffer, but got {len(length_bytes)}")
+    return struct.unpack("I", length_bytes)[0]
 
+
+def _format_chip_description(desc_buf: bytes) -> str:
     chip, rev = desc_buf.decode().split(',')
     chip_description = chip + " revision " + rev
     return chip_description
 
 
-def _check_firmware_compatibility(board_id, flash_size, firmware_file) -> None:
-    if firmware_file["board_id"] != board_id:
+class _ReplyParser:
+    """ Splits the concatenated replies of several commands and validates each one. """
+
+    def __init__(self, data: bytes) -> None:
+        self.data = data
+        self.offset = 0
+
+    def take(self, size: int) -> bytes:
+        if self.offset + size > len(self.data):
+            raise RuntimeError(f"Expected to recieve {size} more bytes from the buffer, but got",
+                               self.data[self.offset:])
+        data = self.data[self.offset: self.offset+size]
+        self.offset += size
+        return data
+
+    def word(self) -> int:
+        return struct.unpack("<I", self.take(4))[0]
+
+    def status(self) -> None:
+        recv_in_sync = self.take(1)
+        recv_status = self.take(1)
+        _validate_response(recv_in_sync, recv_status)
+
+
+_INFO_PARAMS = (INFO_BL_REV, INFO_BOARD_ID, INFO_BOARD_REV, INFO_FLASH_SIZE)
+_SN_WORD_ADDRESSES = (0, 4, 8)
+
+# the device info queries, in the order _parse_device_info expects their replies
+_DEVICE_INFO_QUERIES = (
+    [GET_DEVICE + param + END_OF_CMD for param in _INFO_PARAMS]
+    + [GET_SN + struct.pack("I", addr) + END_OF_CMD for addr in _SN_WORD_ADDRESSES]
+    + [GET_CHIP_DES + END_OF_CMD]
+)
+# size of the replies up to the length of the chip description
+_DEVICE_INFO_FIXED_SIZE = 6 * len(_INFO_PARAMS) + 6 * len(_SN_WORD_ADDRESSES) + 4
+
+
+def _parse_device_info(fixed_reply: bytes) -> tuple[list[int], bytes, int]:
+    """
+    Parse the fixed-size part of the device info replies into the info words,
+    the raw serial number and the length of the chip description.
+    """
+    reply = _ReplyParser(fixed_reply)
+
+    info = []
+    for _ in _INFO_PARAMS:
+        info.append(reply.word())
+        reply.status()
+
+    sn_raw = b''
+    for _ in _SN_WORD_ADDRESSES:
+        sn_raw += reply.take(4)[::-1]
+        reply.status()
+
+    length = reply.word()
+    if length > 256:
+        raise RuntimeError(f"Unexpected chip description length {length}")
+    return info, sn_raw, length
+
+
+def _parse_chip_description_reply(reply_bytes: bytes, length: int) -> str:
+    reply = _ReplyParser(reply_bytes)
+    desc_buf = reply.take(length)
+    reply.status()
+    return _format_chip_description(desc_buf)
+
+
+def _device_info(info: list[int], sn_raw: bytes, chip: str) -> dict[str, Union[int, str]]:
+    return {
+        "Bootloader Revision": info[0],
+        "Board ID": info[1],
+        "Board Revision": info[2],
+        "Flash Size": info[3],
+        "Serial Number": binascii.hexlify(sn_raw).decode(),
+        "Chip": chip
+    }
+
+
+def _get_device_info_batched(ser: Transport) -> dict[str, Union[int, str]]:
+    """
+    Send all the device info queries in a single write and parse their replies
+    from two reads, instead of one round trip per query.
+    """
+    ser.reset_input_buffer()
+    ser.write(b''.join(_DEVICE_INFO_QUERIES))
+    ser.flush()
+
+    info, sn_raw, length = _parse_device_info(ser.read(_DEVICE_INFO_FIXED_SIZE))
+    chip = _parse_chip_description_reply(ser.read(length + 2), length)
+    return _device_info(info, sn_raw, chip)
+
+
+def _get_device_info(ser: Transport, batched: bool = True) -> dict[str, Union[int, str]]:
+    """
+    Query the bootloader revision, board id and revision, flash size, serial
+    number and chip description. The queries are batched unless `batched` is
+    False, or the bootloader can't keep up with back-to-back commands, in
+    which case they are sent one at a time.
+    """
+    if batched:
+        try:
+            return _get_device_info_batched(ser)
+        except (RuntimeError, UnicodeDecodeError, ValueError):
+            # let the bootloader answer whatever it got, then start over
+            _discard_late_replies(ser)
+            if not _resync(ser):
+                raise RuntimeError("Lost sync with the bootloader while probing the device info")
+
+    return {
+        "Bootloader Revision": _get_info(ser, INFO_BL_REV),
+        "Board ID": _get_info(ser, INFO_BOARD_ID),
+        "Board Revision": _get_info(ser, INFO_BOARD_REV),
+        "Flash Size": _get_info(ser, INFO_FLASH_SIZE),
+        "Serial Number": _get_serial_number(ser),
+        "Chip": _get_chip_description(ser)
+    }
+
+
+def _firmware_metadata(path: Union[str, Firmware]) -> tuple[int, int]:
+    """ The board id and image size of a firmware, without decoding it. """
+    if isinstance(path, Firmware):
+        return path.board_id, path.image_size
+    metadata = read_firmware_metadata(path)
+    if "board_id" not in metadata:
+        raise RuntimeError(f"{path} doesn't record its board id, pass load_firmware(path, board_id) instead")
+    return metadata["board_id"], metadata["image_size"]
+
+
+def _check_firmware_compatibility(board_id: int, flash_size: int, firmware_board_id: int, image_size: int) -> None:
+    if firmware_board_id != board_id:
         raise RuntimeError("The provided firmware image is not suitable for this board")
-    if firmware_file["image_size"] > flash_size:
+    if image_size > flash_size:
         raise RuntimeError("The firmware image is too large for this board")
 
 
-def _erase_program_area(ser: Serial) -> None:
+@dataclass
+class _PreparedImage:
+    firmware: Firmware
+    # the image padded to a 4-byte length, without its erased tail, ready to be split into chunks
+    image: Image
+    expected_crc: int
+    # bytes of erased tail that aren't uploaded
+    elided: int = 0
+
+
+def _prepare_image(
+    path: Union[str, Firmware],
+    cache: Optional["ImageCache"],
+    flash_size: int,
+    metrics: UploadMetrics
+) -> _PreparedImage:
+    """
+    Decode the firmware, pad its image and compute the CRC the bootloader
+    should report. The run of 0xFF bytes at the end of the image is left out
+    of the upload: the chip erase already leaves those bytes as 0xFF, and the
+    expected CRC treats everything past the image as 0xFF, so the CRC check
+    is the same whether they are programmed or not.
+    """
+    with metrics.phase("load"):
+        if isinstance(path, Firmware):
+            firmware = path
+        elif cache is not None:
+            firmware = cache.load(path)
+        else:
+            firmware = load_firmware(path)
+        image = _pad(firmware.image)
+        elided = erased_tail(image)
+        if elided:
+            image = memoryview(image)[:len(image)-elided]
+        metrics.bytes_elided = elided
+        return _PreparedImage(firmware, image, firmware.expected_crc32(flash_size), elided)
+
+
+def _prepare_in_background(
+    path: Union[str, Firmware],
+    cache: Optional["ImageCache"],
+    flash_size: int,
+    metrics: UploadMetrics
+) -> "Future[_PreparedImage]":
+    """ Run _prepare_image on a worker thread, so that it overlaps the chip erase. """
+    future: "Future[_PreparedImage]" = Future()
+
+    def prepare() -> None:
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(_prepare_image(path, cache, flash_size, metrics))
+        except BaseException as err:
+            future.set_exception(err)
+
+    threading.Thread(target=prepare, name="prepare-image", daemon=True).start()
+    return future
+
+
+def _erase_program_area(ser: Transport) -> None:
     """ 
     Erases the program area of the serial device.
     Before calling this function, the bootloader requires that the following commands 
@@ -168,113 +437,337 @@ def _erase_program_area(ser: Serial) -> None:
     ser.reset_input_buffer()
     ser.write(CHIP_ERASE + END_OF_CMD)
 
-    buf = b''
-    timeout = 20
-    start = time.monotonic()
-    while not buf:
-        if (time.monotonic() - start) > timeout:
-            raise TimeoutError("Couldn't recieve a response from the board after erasing the chip")
-        buf = ser.read(2)
-
-    recv_in_sync = bytes([buf[0]])
-    recv_status = bytes([buf[1]])
-    _validate_response(recv_in_sync, recv_status)
+    # the reply only comes once the whole chip is erased
+    timeout = ser.timeout
+    ser.timeout = ERASE_TIMEOUT
+    try:
+        _read_reply(ser)
+    finally:
+        ser.timeout = timeout
     
 
-def _get_image(firmware_file) -> bytes:
-    image = zlib.decompress(b64decode(firmware_file["image"]))
-    # pad image to 4-byte length
-    while ((len(image) % 4) != 0):
-        image += bytes(0xFF)
-    return image
+def _drain_responses(ser: Transport, count: int) -> None:
+    # Consume the replies of commands that were already sent, so that the next
+    # command starts from a clean stream.
+    if count > 0:
+        ser.read(2 * count)
+    ser.reset_input_buffer()
 
 
-def _write_to_program_area(ser: Serial, image: bytes) -> Generator[str, None, None]:
+def _write_to_program_area(
+    ser: Transport,
+    image: Image,
+    window: int = 1,
+    metrics: Optional[UploadMetrics] = None,
+    progress_interval: float = PROGRESS_INTERVAL
+) -> Generator[str, None, None]:
     """"
     Write the firmware to the program area of the serial device.
     Before using this function, make sure the firmware image is appropriate for 
     the board by checking the board id and image size.
+
+    Up to `window` chunks are sent before their replies are read. A window of 1
+    is plain stop-and-wait; larger windows hide the per-transaction latency of
+    USB-CDC links. On the first FAILED/INVALID reply no further chunks are sent,
+    the replies that are still in flight are drained, and a RuntimeError naming
+    the offset of the rejected chunk is raised.
+
+    The percentage uploaded is yielded at most every `progress_interval`
+    seconds, and once the last chunk is acknowledged. With `metrics`, the time
+    each chunk waited for its reply and the bytes acknowledged are recorded.
     """
 
     CHUNK_SIZE = 252
 
+    if window < 1:
+        raise ValueError(f"Expected the upload window to be at least 1, but got {window}")
+
     ser.reset_input_buffer()
 
     # ensure image length is a multiple of 4 bytes
-    while ((len(image) % 4) != 0):
-        image += bytes(0xFF)
-
-    chunks: list[bytes] = []
-    for i in range(0, len(image), CHUNK_SIZE):
-        chunks.append(image[i: i+CHUNK_SIZE])
-
-    sent_chunks = 0
-    for chunk in chunks:
-        length = len(chunk).to_bytes()
-        ser.write(PROGRAM_MULTIPLE_BYTES + length + chunk + END_OF_CMD)
-        recv_in_sync = ser.read(1)
-        recv_status = ser.read(1)
-        _validate_response(recv_in_sync, recv_status)
-
-        sent_chunks += 1
+    image = _pad(image)
+    if metrics is not None:
+        metrics.image_bytes = len(image)
+
+    total_chunks = (len(image) + CHUNK_SIZE - 1) // CHUNK_SIZE
+    chunks = iter_chunks(image, CHUNK_SIZE)
+    # (offset, length, time sent) of the chunks whose replies haven't been read
+    in_flight: deque[tuple[int, int, float]] = deque()
+
+    acked_chunks = 0
+    last_report = time.monotonic()
+    while True:
+        # keep the window full
+        while len(in_flight) < window:
+            offset, chunk = next(chunks, (None, None))
+            if chunk is None:
+                break
+            length = len(chunk).to_bytes()
+            ser.write(PROGRAM_MULTIPLE_BYTES + length + chunk + END_OF_CMD)
+            in_flight.append((offset, len(chunk), time.monotonic()))
+
+        if not in_flight:
+            break
 
-        if sent_chunks % 100 == 0 or sent_chunks == len(chunks):
-            progress = round(sent_chunks / len(chunks) * 100)
+        offset, length, sent = in_flight.popleft()
+        try:
+            _read_reply(ser)
+        except RuntimeError as err:
+            _drain_responses(ser, len(in_flight))
+            raise RuntimeError(f"Failed to program the chunk at offset {offset:#x}: {err}") from err
+        now = time.monotonic()
+
+        acked_chunks += 1
+        if metrics is not None:
+            metrics.ack_latency.observe(now - sent)
+            metrics.bytes_acked += length
+
+        if now - last_report >= progress_interval or acked_chunks == total_chunks:
+            last_report = now
+            progress = round(acked_chunks / total_chunks * 100)
             yield  f"{progress}%"
 
 
-def _get_expected_crc32(flash_size, image) -> int:
-    crc_value = 0
+def _get_crc(ser: Transport) -> int:
+    ser.reset_input_buffer()
 
-    for byte in image:
-        index = (crc_value ^ byte) & 0xff
-        crc_value = crc_table[index] ^ (crc_value >> 8)
+    ser.write(GET_CRC + END_OF_CMD)
+    return struct.unpack("I", _read_reply(ser, 4))[0]
+
+
+def _verify_firmware(ser: Transport, expected_crc: int) -> None:
+    actual_crc = _get_crc(ser)
+
+    if expected_crc != actual_crc:
+        raise VerificationError(f"Verification failed. Expected crc value to be {expected_crc}, but got {actual_crc}")
 
-    # padding for images smaller than the flash size
-    for _ in range(len(image), (flash_size - 1), 4):
-        for byte in crc_padding:
-            index = (crc_value ^ byte) & 0xff
-            crc_value = crc_table[index] ^ (crc_value >> 8)
-            
-    return crc_value
 
+def _discard_late_replies(ser: Transport) -> None:
+    """ Read until the bootloader has been quiet for RECOVERY_QUIET_TIME. """
+    timeout = ser.timeout
+    ser.timeout = RECOVERY_QUIET_TIME
+    try:
+        while ser.read(4096):
+            pass
+    finally:
+        ser.timeout = timeout
+
+
+def _read_flash(ser: Transport, length: int, window: int = 1) -> Generator[bytes, None, None]:
+    """
+    Read the first `length` bytes of flash with READ_MULTI and yield them
+    chunk by chunk. The bootloader reads from its address pointer, which
+    starts at the end of the flash so that nothing is programmed before an
+    erase, and which every read and write moves forward. CHIP_VERIFY moves
+    it back to the start of the flash first, as px_uploader does.
+
+    Up to `window` reads are in flight at once, as in _write_to_program_area.
+    If the reader stops early, the replies still in flight are drained.
+    """
+    READ_CHUNK_SIZE = 252
+
+    if length % 4:
+        raise ValueError(f"Expected the length to read to be a multiple of 4, but got {length}")
+    if window < 1:
+        raise ValueError(f"Expected the read window to be at least 1, but got {window}")
 
-def _verify_firmware(ser: Serial, flash_size: int, image: bytes) -> None:
     ser.reset_input_buffer()
+    ser.write(CHIP_VERIFY + END_OF_CMD)
+    _read_reply(ser)
 
-    expected_crc = _get_expected_crc32(flash_size, image)
+    offsets = iter(range(0, length, READ_CHUNK_SIZE))
+    # (offset, size) of the reads whose replies haven't been read
+    in_flight: deque[tuple[int, int]] = deque()
 
-    ser.write(GET_CRC + END_OF_CMD)
-    recv_crc = ser.read(4)
-    recv_in_sync = ser.read(1)
-    recv_status = ser.read(1)
-    _validate_response(recv_in_sync, recv_status)
-    
-    actual_crc = struct.unpack("I", recv_crc)[0]
+    try:
+        while True:
+            while len(in_flight) < window:
+                offset = next(offsets, None)
+                if offset is None:
+                    break
+                size = min(READ_CHUNK_SIZE, length - offset)
+                ser.write(READ_MULTI + size.to_bytes() + END_OF_CMD)
+                in_flight.append((offset, size))
+
+            if not in_flight:
+                break
+
+            offset, size = in_flight.popleft()
+            try:
+                data = _read_reply(ser, size)
+            except RuntimeError as err:
+                # the replies after a rejected read are out of step
+                in_flight.clear()
+                _discard_late_replies(ser)
+                raise RuntimeError(f"Failed to read the flash at offset {offset:#x}: {err}") from err
+            yield data
+    finally:
+        if in_flight:
+            ser.read(sum(size + 2 for _, size in in_flight))
+            ser.reset_input_buffer()
+
+
+def _compare_flash(ser: Transport, image: Image, window: int = 1) -> Optional[int]:
+    """
+    The offset of the first byte of flash that differs from `image`, None if
+    it matches. The bootloader only programs the first word of an upload when
+    it boots it, so until then that word reads back erased and is taken as
+    matching.
+    """
+    image = _pad(image)
+    offset = 0
+    reading = _read_flash(ser, len(image), window)
+    try:
+        for data in reading:
+            expected = memoryview(image)[offset: offset+len(data)]
+            if offset == 0 and data[:4] == b'\xff' * 4:
+                data = bytes(expected[:4]) + data[4:]
+            if data != expected:
+                return offset + next(i for i in range(len(data)) if data[i] != expected[i])
+            offset += len(data)
+    finally:
+        reading.close()
+    return None
+
+
+def _recover(ser: Transport, resync_attempts: int) -> None:
+    """
+    Bring the bootloader back to a state that allows CHIP_ERASE after a failed
+    upload: discard the replies that are still on their way, re-sync and send
+    GET_DEVICE again.
+    """
+    _discard_late_replies(ser)
+    if not _resync(ser, resync_attempts):
+        raise RuntimeError("Lost sync with the bootloader while recovering from a failed upload")
+    _get_info(ser, INFO_BL_REV)
+    _get_info(ser, INFO_BOARD_ID)
+    _get_info(ser, INFO_FLASH_SIZE)
 
-    if expected_crc != actual_crc:
-        raise Exception(f"Verification failed. Expected crc value to be {expected_crc}, but got {actual_crc}")
+
+def comports() -> list["ListPortInfo"]:
+    # imported on first use, most callers talk to a port they were given
+    from serial.tools.list_ports import comports
+    return comports()
+
+
+def _mavlink_connection(device: str) -> "mavserial":
+    # pymavlink loads its MAVLink dialects on import, which takes longer than
+    # importing everything else, and only rebooting an autopilot needs it
+    from pymavlink import mavutil
+    return mavutil.mavlink_connection(device)
+
+
+def _hardware_id(port: "ListPortInfo") -> Optional[str]:
+    """ The vendor id and serial number of `port`, None if it lacks either, as boards can't be told apart then. """
+    if port.vid is None or not port.serial_number:
+        return None
+    return f"{port.vid}:{port.serial_number}"
+
+
+def _find_device(selected_port: str, bus_id: Optional[str], hardware_id: Optional[str]) -> Optional[str]:
+    """
+    Find the port of a board that may have re-enumerated under another name,
+    by its bus location, or by its vendor id and serial number.
+    """
+    ports = comports()
+    for port in ports:
+        if bus_id and port.location == bus_id:
+            return port.device
+    if hardware_id is not None:
+        for port in ports:
+            if _hardware_id(port) == hardware_id:
+                return port.device
+    for port in ports:
+        if port.device == selected_port:
+            return port.device
+    return None
+
+
+def _open_bootloader(
+    device: str,
+    baudrate: int,
+    timeout: float,
+    trace_path: Optional[str] = None
+) -> Optional[Transport]:
+    """
+    Open `device`, a serial port, a tcp://host:port URL or a replay://<trace
+    path> URL, and return it if a bootloader answers GET_SYNC within
+    `timeout`. With a `trace_path`, the traffic that follows is recorded
+    into that file, see wire_trace.py.
+    """
+    try:
+        if is_tcp_url(device):
+            ser: Transport = SocketTransport.from_url(device, baudrate, timeout)
+        elif is_replay_url(device):
+            ser = ReplayTransport.from_url(device, baudrate, timeout)
+        else:
+            ser = Serial(device, baudrate, timeout=timeout)
+    except (SerialException, OSError):
+        return None
+
+    # a trace starts after the probe, so it isn't replayed
+    if not is_replay_url(device):
+        try:
+            _get_sync(ser)
+        except (RuntimeError, OSError):
+            ser.close()
+            return None
+
+    ser.timeout = 2
+    if trace_path is not None:
+        # started once, by the probe that found the bootloader
+        ser = RecordingTransport(ser, trace_path)
+    return ser
 
 
-def _connect(selected_port: str, baudrate: int = 115200) -> Serial:
-    bus_id: str = ''
-    hardware_id: str = ''
-    conn: "mavserial" = None
+def _connect(
+    selected_port: str,
+    baudrate: int = 115200,
+    timings: Optional[dict[str, float]] = None,
+    trace_path: Optional[str] = None
+) -> Transport:
+    """
+    Open a connection to the bootloader of the board on `selected_port`.
+
+    If the bootloader already answers GET_SYNC, it is used right away.
+    Otherwise the autopilot is rebooted over MAVLink and the board is polled
+    for, by bus location or vendor id and serial number, until its bootloader
+    answers. The time spent in each phase is stored in `timings` if given.
+    A board on a tcp://host:port URL has to be in its bootloader already.
+    With a `trace_path`, the traffic with the bootloader is recorded into it.
+    """
+    if timings is None:
+        timings = {}
 
+    start = time.monotonic()
+    ser = _open_bootloader(selected_port, baudrate, SYNC_PROBE_TIMEOUT, trace_path)
+    timings["probe"] = time.monotonic() - start
+    if ser is not None:
+        return ser
+    if is_tcp_url(selected_port) or is_replay_url(selected_port):
+        # the board behind a TCP server can't be found again after a reboot
+        raise RuntimeError(f"No bootloader answered on {selected_port}")
+
+    # Ports that aren't enumerated, like ptys, can only be used if their
+    # bootloader is already running.
+    bus_id: Optional[str] = None
+    hardware_id: Optional[str] = None
     for port in comports():
         if port.device == selected_port:
             bus_id = port.location
-            hardware_id = str(port.vid) + ":" + port.serial_number
-            conn = mavutil.mavlink_connection(port.device)
+            hardware_id = _hardware_id(port)
             break
-
-    if conn is None:
+    else:
         raise Exception("couldn't find the desired serial device")
-    
+
+    start = time.monotonic()
+    conn = _mavlink_connection(selected_port)
+
     # Pymavlink by default set the value of the system id to 0, which will 
     # prevent us from rebooting the drone if it has another system id. Thus we 
     # have to set the "target_system" attribute manually.
     msg: "MAVLink_heartbeat_message" = conn.wait_heartbeat(timeout= 2)
+    timings["heartbeat"] = time.monotonic() - start
     if not msg:
         conn.close()
         raise TimeoutError("Couldn't recieve heartbeat message from the drone.")
@@ -282,102 +775,390 @@ def _connect(selected_port: str, baudrate: int = 115200) -> Serial:
         conn.target_system = msg.get_srcSystem()
 
     conn.reboot_autopilot(True)
-    time.sleep(3)
     conn.close()
 
-    ser: Serial = None
+    # Wait for the board to come back and answer in its bootloader, which
+    # happens as soon as it has re-enumerated.
+    start = time.monotonic()
+    while time.monotonic() - start < REBOOT_TIMEOUT:
+        device = _find_device(selected_port, bus_id, hardware_id)
+        if device is not None:
+            ser = _open_bootloader(device, baudrate, SYNC_PROBE_TIMEOUT, trace_path)
+            if ser is not None:
+                timings["reboot"] = time.monotonic() - start
+                return ser
+        time.sleep(REBOOT_POLL_INTERVAL)
 
-    # Try to connect using the same port.
-    try:
-        ser = Serial(selected_port, baudrate, timeout=2)
-        return ser
-    except SerialException:
-        pass
+    raise TimeoutError("couldn't find the bootloader of the desired serial device after rebooting it")
 
-    # If the bus id is known, use it to find the correct port.
-    try:
-        for port in comports():
-            if port.location == bus_id:
-                ser = Serial(port.device, baudrate, timeout=2)
-                return ser
-    except SerialException:
-        pass
 
-    # Try to use a combination of the vendor id and the serial number to find
-    # the correct port.
-    for port in comports():
-        if hardware_id == str(port.vid) + ":" + port.serial_number:
-            ser = Serial(port.device, baudrate, timeout=2)
+class BootloaderSession:
+    """
+    A connection to the bootloader of one board, for identifying and flashing
+    it without reconnecting, and so without rebooting it, in between:
 
-    if ser is None:
-        raise Exception("couldn't find the desired serial device")
-    
-    return ser
+        with BootloaderSession("COM3") as session:
+            if session.board_id == 140:
+                for progress in session.upload("arducopter.apj"):
+                    print(progress)
 
+    The device info is queried once and cached. The port is closed when the
+    session ends, and the board leaves its bootloader when it is rebooted,
+    which also ends the session.
+    """
 
-def get_board_info(port: str) -> dict[str, Union[int, str, list[str, int]]]:
-    ser = _connect(port)
-
-    bl_rev = _get_info(ser, INFO_BL_REV)
-    board_id = _get_info(ser, INFO_BOARD_ID)
-    board_rev = _get_info(ser, INFO_BOARD_REV)
-    flash_size = _get_info(ser, INFO_FLASH_SIZE)
-    serial_number = _get_serial_number(ser)
-    chip = _get_chip_description(ser)
-    boards = match_boards_by_id(board_id)
-
-    board_info = {
-        "Bootloader Revision": bl_rev,
-        "Board ID": board_id,
-        "Board Revision": board_rev,
-        "Flash Size": flash_size,
-        "Serial Number": serial_number,
-        "Chip": chip,
-        "Select Board": boards
-    }
+    def __init__(
+        self,
+        port: str,
+        baudrate: int = 115200,
+        negotiate_baudrate: bool = False,
+        trace_path: Optional[str] = None
+    ) -> None:
+        """
+        With `negotiate_baudrate`, the fastest baud rate both ends support is
+        used, see _negotiate_baudrate. With a `trace_path`, the traffic with
+        the bootloader is recorded into that file, see wire_trace.py.
+        """
+        self.port = port
+        self.baudrate = baudrate
+        self.negotiate_baudrate = negotiate_baudrate
+        self.trace_path = trace_path
+        self._ser: Optional[Transport] = None
+        self._device_info: Optional[dict[str, Union[int, str]]] = None
+        # the connect and sync timings, reported with the first upload
+        self._open_metrics: Optional[UploadMetrics] = None
+
+    def __enter__(self) -> "BootloaderSession":
+        self.open()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def open(self) -> None:
+        self._open_metrics = UploadMetrics(port=self.port)
+        self._open(self._open_metrics)
+
+    def _open(self, metrics: UploadMetrics) -> None:
+        with metrics.phase("connect"):
+            ser = _connect(self.port, baudrate=self.baudrate, timings=metrics.connect_phases, trace_path=self.trace_path)
+        try:
+            with metrics.phase("sync"):
+                _get_sync(ser)
+                if self.negotiate_baudrate:
+                    _negotiate_baudrate(ser)
+        except BaseException:
+            ser.close()
+            raise
+        self._ser = ser
+
+    def close(self) -> None:
+        if self._ser is not None:
+            self._ser.close()
+            self._ser = None
+
+    @property
+    def ser(self) -> Transport:
+        if self._ser is None:
+            raise RuntimeError(f"The bootloader session on {self.port} isn't open")
+        return self._ser
+
+    def device_info(self, batched: bool = True) -> dict[str, Union[int, str]]:
+        """ The bootloader revision, board id and revision, flash size, serial number and chip of the board. """
+        if self._device_info is None:
+            self._device_info = _get_device_info(self.ser, batched)
+        return dict(self._device_info)
+
+    @property
+    def board_id(self) -> int:
+        return self.device_info()["Board ID"]
+
+    @property
+    def flash_size(self) -> int:
+        return self.device_info()["Flash Size"]
+
+    def board_info(self) -> dict[str, Union[int, str, list[str, int]]]:
+        """ The device info and the names of the boards with its board id. """
+        board_info = self.device_info()
+        board_info["Select Board"] = match_boards_by_id(board_info["Board ID"])
+        return board_info
+
+    def check_compatibility(self, path: Union[str, Firmware]) -> None:
+        """ Raise a RuntimeError if the firmware isn't built for this board or doesn't fit its flash. """
+        _check_firmware_compatibility(self.board_id, self.flash_size, *_firmware_metadata(path))
+
+    def read_crc(self) -> int:
+        """ The CRC of the whole flash, as computed by the bootloader. """
+        return _get_crc(self.ser)
+
+    def verify(self, firmware: Firmware) -> None:
+        """ Raise a VerificationError if the flash doesn't hold `firmware`. """
+        _verify_firmware(self.ser, firmware.expected_crc32(self.flash_size))
+
+    def read_flash(self, length: Optional[int] = None, window: int = 8) -> bytes:
+        """
+        Read the first `length` bytes of the flash, by default all of it, see
+        _read_flash. Only bootloaders built with READ_MULTI support it.
+        """
+        return b''.join(_read_flash(self.ser, self.flash_size if length is None else length, window))
+
+    def dump_flash(self, path: str, length: Optional[int] = None, window: int = 8) -> int:
+        """ Write the flash to the file at `path` as it is read, see read_flash, and return its length. """
+        length = self.flash_size if length is None else length
+        with open(path, "wb") as file:
+            for data in _read_flash(self.ser, length, window):
+                file.write(data)
+        return length
+
+    def compare_flash(self, image: Image, window: int = 8) -> Optional[int]:
+        """
+        Read the flash back and return the offset of the first byte that
+        differs from `image`, or None if the flash starts with `image`, see
+        _compare_flash.
+        """
+        return _compare_flash(self.ser, image, window)
+
+    def reboot(self) -> None:
+        """ Boot the firmware, which ends the session. """
+        self.ser.write(REBOOT + END_OF_CMD)
+        self.close()
+
+    def upload(
+        self,
+        path: Union[str, Firmware],
+        window: int = 1,
+        cache: Optional["ImageCache"] = None,
+        only_if_different: bool = False,
+        progress_interval: float = PROGRESS_INTERVAL,
+        metrics_sink: Optional[MetricsSink] = None,
+        retry_policy: Optional[RetryPolicy] = None,
+        reboot: bool = True,
+        backup_path: Optional[str] = None
+    ) -> Generator[dict[str, str], None, None]:
+        """
+        Flash the firmware at `path`, see upload_firmware for the options and
+        the progress. The session is opened first if it isn't open yet. Unless
+        `reboot` is False, the board is rebooted into the new firmware once it
+        is verified. With a `backup_path`, the whole flash is read back into
+        that file right before it is erased, see dump_flash, so the board's
+        old firmware can be restored.
+        """
+        if retry_policy is None:
+            retry_policy = RetryPolicy(retries=0)
+
+        metrics = self._open_metrics or UploadMetrics(port=self.port)
+        self._open_metrics = None
+        try:
+            if self._ser is None:
+                self._open(metrics)
+            yield from self._upload(
+                path, metrics, window, cache, only_if_different, progress_interval, retry_policy, reboot,
+                backup_path
+            )
+        except GeneratorExit:
+            metrics.result = "Cancelled"
+            raise
+        except Exception as err:
+            metrics.result = "Failed"
+            metrics.error = err
+            raise
+        finally:
+            if metrics_sink is not None:
+                metrics_sink(metrics)
+
+    def _upload(
+        self,
+        path: Union[str, Firmware],
+        metrics: UploadMetrics,
+        window: int,
+        cache: Optional["ImageCache"],
+        only_if_different: bool,
+        progress_interval: float,
+        retry_policy: RetryPolicy,
+        reboot: bool,
+        backup_path: Optional[str]
+    ) -> Generator[dict[str, str], None, None]:
+        ser = self.ser
+
+        # The bootloader requires calling GET_SYNC and GET_DEVICE before sending the
+        # CHIP_ERASE command. For some unknown reason, a single GET_DEVICE call 
+        # doesn't set STATE_ALLOWS_ERASE to True, so we send GET_DEVICE multiple 
+        # times to ensure the correct state, even if the device info is cached.
+        with metrics.phase("sync"):
+            _get_info(ser, INFO_BL_REV)
+            board_id = _get_info(ser, INFO_BOARD_ID)
+            flash_size = _get_info(ser, INFO_FLASH_SIZE)
+
+        # Only the metadata of the firmware is needed to decide whether the board
+        # may be erased. The image is decoded and its CRC computed while the chip
+        # is being erased, which takes seconds, so verifying is a single GET_CRC.
+        _check_firmware_compatibility(board_id, flash_size, *_firmware_metadata(path))
+        preparing = _prepare_in_background(path, cache, flash_size, metrics)
+
+        if only_if_different:
+            with metrics.phase("verify"):
+                identical = _get_crc(ser) == preparing.result().expected_crc
+            if identical:
+                if cache is not None:
+                    cache.store_crc(preparing.result().firmware, flash_size)
+                metrics.result = "Skipped"
+                yield {
+                    "Port": ser.name,
+                    "Erasing Chip": "Skipped",
+                    "Uploading Firmware": "Skipped",
+                    "Verifying Firmware": "Skipped"
+                }
+                if reboot:
+                    self.reboot()
+                return
+
+        # the backup is only worth its time once the board is going to be erased
+        if backup_path is not None:
+            with metrics.phase("backup"):
+                self.dump_flash(backup_path)
+
+        progress = {
+            "Port": ser.name,
+            "Erasing Chip": "in progress",
+            "Uploading Firmware": "not started",
+            "Verifying Firmware": "not started",
+            "Baud Rate": str(ser.baudrate)
+        }
+        if backup_path is not None:
+            progress["Backup"] = backup_path
+        yield progress
 
-    return board_info
+        retries = 0
+        while True:
+            try:
+                yield from _flash(ser, preparing, progress, metrics, window, progress_interval)
+                break
+            except retry_policy.retry_on as err:
+                # a firmware that failed to decode fails the same way on the next attempt
+                if retries >= retry_policy.retries or (preparing.done() and preparing.exception() is not None):
+                    raise
+                retries += 1
+                start = time.monotonic()
+                time.sleep(retry_policy.delay_before(retries))
+                _recover(ser, retry_policy.resync_attempts)
+                metrics.retries = retries
+                metrics.recovery_time += time.monotonic() - start
+                last_error = err
+
+            progress.update({
+                "Erasing Chip": "in progress",
+                "Uploading Firmware": "not started",
+                "Verifying Firmware": "not started",
+                "Retries": str(retries),
+                "Recovery Time": f"{metrics.recovery_time:.2f} s",
+                "Last Error": str(last_error)
+            })
+            yield progress
+
+        if cache is not None:
+            cache.store_crc(preparing.result().firmware, flash_size)
+        metrics.result = "Completed"
+        progress["Verifying Firmware"] = "Completed"
+        yield progress
 
+        if reboot:
+            self.reboot()
 
-def upload_firmware(port: str, path: str) -> Generator[dict[str, str], None, None]:
-    ser = _connect(port)
 
-    # The bootloader requires calling GET_SYNC and GET_DEVICE before sending the
-    # CHIP_ERASE command. For some unknown reason, a single GET_DEVICE call 
-    # doesn't set STATE_ALLOWS_ERASE to True, so we send GET_DEVICE multiple 
-    # times to ensure the correct state.
-    _get_sync(ser)
-    _get_info(ser, INFO_BL_REV)
-    board_id = _get_info(ser, INFO_BOARD_ID)
-    flash_size = _get_info(ser, INFO_FLASH_SIZE)
-    
-    with open(path, "r") as file:
-        firmware_file: dict = json.load(file)
-    _check_firmware_compatibility(board_id, flash_size, firmware_file)
-
-    progress = {
-        "Port": ser.name,
-        "Erasing Chip": "in progress",
-        "Uploading Firmware": "not started",
-        "Verifying Firmware": "not started"
-    }
-    yield progress
+def get_board_info(port: str, batched: bool = True) -> dict[str, Union[int, str, list[str, int]]]:
+    with BootloaderSession(port) as session:
+        session.device_info(batched)
+        return session.board_info()
+
 
-    _erase_program_area(ser)
+def _flash(
+    ser: Transport,
+    preparing: "Future[_PreparedImage]",
+    progress: dict[str, str],
+    metrics: UploadMetrics,
+    window: int,
+    progress_interval: float
+) -> Generator[dict[str, str], None, None]:
+    """ Erase, upload and verify, the part of upload_firmware that is retried. """
+    with metrics.phase("erase"):
+        _erase_program_area(ser)
+    prepared = preparing.result()
     progress["Erasing Chip"] = "Completed"
     progress["Uploading Firmware"] = "0%"
+    if prepared.elided:
+        progress["Erased Tail Skipped"] = f"{prepared.elided / 1000:.1f} kB"
     yield progress
 
-    image = _get_image(firmware_file)
-
-    for prog in _write_to_program_area(ser, image):
-        progress["Uploading Firmware"] = prog
-        yield progress
+    metrics.bytes_acked = 0
+    with metrics.phase("upload"):
+        for prog in _write_to_program_area(ser, prepared.image, window, metrics, progress_interval):
+            progress["Uploading Firmware"] = prog
+            progress["Upload Speed"] = f"{metrics.upload_rate() / 1000:.1f} kB/s"
+            eta = metrics.eta()
+            progress["ETA"] = f"{eta:.1f} s" if eta is not None else "n/a"
+            yield progress
+    rate = metrics.upload_rate()
+    progress["Throughput"] = f"{rate / 1000:.1f} kB/s" if rate else "n/a"
 
     progress["Verifying Firmware"] = "in progress"
     yield progress
-    _verify_firmware(ser, flash_size, image)
-    progress["Verifying Firmware"] = "Completed"
-    yield progress
-
-    ser.write(REBOOT + END_OF_CMD)
+    with metrics.phase("verify"):
+        _verify_firmware(ser, prepared.expected_crc)
+
+
+def upload_firmware(
+    port: str,
+    path: Union[str, Firmware],
+    window: int = 1,
+    cache: Optional["ImageCache"] = None,
+    only_if_different: bool = False,
+    negotiate_baudrate: bool = False,
+    progress_interval: float = PROGRESS_INTERVAL,
+    metrics_sink: Optional[MetricsSink] = None,
+    retry_policy: Optional[RetryPolicy] = None,
+    backup_path: Optional[str] = None,
+    trace_path: Optional[str] = None
+) -> Generator[dict[str, str], None, None]:
+    """
+    Flash the firmware at `path` to the board on `port`, a serial port or the
+    tcp://host:port URL of one served over TCP, see transport.py. An already loaded
+    Firmware can be passed instead of a path, so that callers flashing the
+    same file to several boards only decode it once. With a `cache`, the file
+    is only decoded if its content isn't cached yet, and the expected CRC for
+    the board's flash size is remembered for the next upload. Only the
+    firmware's metadata is read before the board is erased; the image is
+    decoded and its expected CRC computed on a worker thread during the erase.
+
+    With `only_if_different`, the board's flash CRC is read first and, if it
+    already matches the firmware, erasing and uploading are skipped and every
+    step is reported as "Skipped".
+
+    With `negotiate_baudrate`, the fastest baud rate supported by both the
+    bootloader and the host is used, see _negotiate_baudrate. The rate in use
+    and the throughput achieved by the upload are reported in the progress.
+
+    While uploading, the progress is reported at most every
+    `progress_interval` seconds with the current speed and ETA. When the
+    upload ends, whether it succeeded, failed or was abandoned, its
+    UploadMetrics are passed to `metrics_sink`, see metrics.py.
+
+    With a `retry_policy`, a failed erase, upload or verification is retried
+    on the open port after re-syncing with the bootloader, instead of failing
+    the upload. The number of retries and the time spent recovering are
+    reported in the progress and the metrics.
+
+    With a `backup_path`, the flash is read back into that file before it is
+    erased, see BootloaderSession.dump_flash.
+
+    With a `trace_path`, every command and reply is recorded into that file
+    with its timestamp, and `port` can be the replay://<trace path> URL of a
+    recorded trace, see wire_trace.py.
+    """
+    session = BootloaderSession(port, negotiate_baudrate=negotiate_baudrate, trace_path=trace_path)
+    try:
+        yield from session.upload(
+            path, window, cache, only_if_different, progress_interval, metrics_sink, retry_policy,
+            backup_path=backup_path
+        )
+    finally:
+        session.close()
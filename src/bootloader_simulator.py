@@ -0,0 +1,277 @@
+"""
+An in-process simulation of the PX4 bootloader on a pseudo-terminal.
+
+The simulator speaks the commands used by bootloader_protocol (GET_SYNC,
+GET_DEVICE, CHIP_ERASE, CHIP_VERIFY, PROGRAM_MULTIPLE_BYTES, READ_MULTI,
+GET_CRC, GET_SN, GET_CHIP_DES, SET_BAUD and REBOOT) on the master side of a
+pty, so the uploader can open `simulator.port` like any serial port. Like the
+PX4 bootloader, it starts with its address pointer at the end of the flash,
+so nothing can be programmed or read before CHIP_ERASE or CHIP_VERIFY, and it
+holds the first word of the image back until REBOOT: READ_MULTI reads it as
+erased, while `flash` and GET_CRC already have it. The per-command latency, the baud rate
+of the link, the erase and programming times are configurable, and faults can
+be injected to exercise error handling:
+
+    with BootloaderSimulator(board_id=9, flash_size=2 * 1024 * 1024, erase_time=1) as simulator:
+        for progress in upload_firmware(simulator.port, "arducopter.apj"):
+            print(progress)
+
+ptys only exist on POSIX systems.
+"""
+from dataclasses import dataclass
+from typing import Optional
+import threading
+import select
+import struct
+import heapq
+import time
+import tty
+import os
+
+from bootloader_protocol import (
+    CHIP_ERASE, CHIP_VERIFY, END_OF_CMD, FAILED, GET_CHIP_DES, GET_CRC, GET_DEVICE, GET_SN, GET_SYNC, IN_SYNC,
+    INFO_BL_REV, INFO_BOARD_ID, INFO_BOARD_REV, INFO_FLASH_SIZE, INVALID, OK, PROGRAM_MULTIPLE_BYTES,
+    READ_MULTI, REBOOT, SET_BAUD
+)
+from crc import crc32
+
+
+@dataclass
+class Faults:
+    """
+    Faults to inject, each one only the first time its condition is met.
+    Chunks are counted from 0 since the last CHIP_ERASE.
+    """
+    # answer FAILED to this PROGRAM_MULTIPLE_BYTES
+    fail_chunk: Optional[int] = None
+    # program this chunk but never answer it
+    drop_chunk_reply: Optional[int] = None
+    # program this chunk with a flipped bit, so verification fails
+    corrupt_chunk: Optional[int] = None
+    # answer FAILED to CHIP_ERASE
+    fail_erase: bool = False
+    # stall for this many seconds before answering the `stall_chunk`
+    stall_chunk: Optional[int] = None
+    stall_time: float = 0
+
+
+class BootloaderSimulator:
+    def __init__(
+        self,
+        board_id: int = 9,
+        board_rev: int = 0,
+        bl_rev: int = 5,
+        flash_size: int = 2 * 1024 * 1024 - 16 * 1024,
+        serial_number: bytes = bytes(range(12)),
+        chip_description: str = "STM32F76x,Z",
+        latency: float = 0,
+        baudrate: Optional[int] = None,
+        erase_time: float = 0,
+        program_time: float = 0,
+        faults: Optional[Faults] = None
+    ) -> None:
+        """
+        `latency` is the delay before each reply, as on a USB link. With a
+        `baudrate`, data in either direction takes as long as it would on a
+        UART with 10 bits per byte, otherwise the link is as fast as the pty.
+        `program_time` is spent per PROGRAM_MULTIPLE_BYTES.
+        """
+        self.board_id = board_id
+        self.board_rev = board_rev
+        self.bl_rev = bl_rev
+        self.flash_size = flash_size
+        self.serial_number = serial_number
+        self.chip_description = chip_description
+        self.latency = latency
+        self.baudrate = baudrate
+        self.erase_time = erase_time
+        self.program_time = program_time
+        self.faults = faults or Faults()
+
+        self.flash = bytearray(b'\xff' * flash_size)
+        self.commands: list[bytes] = []
+        self.rebooted = False
+        self._address = flash_size
+        self._chunk = 0
+        # whether the first word is programmed but only written on REBOOT
+        self._first_word_held = False
+
+        self._master_fd, self._slave_fd = os.openpty()
+        tty.setraw(self._slave_fd)
+        self.port = os.ttyname(self._slave_fd)
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="bootloader-simulator", daemon=True)
+        self._thread.start()
+
+    def __enter__(self) -> "BootloaderSimulator":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self._stop.set()
+        self._thread.join()
+        os.close(self._master_fd)
+        os.close(self._slave_fd)
+
+    def _transfer_time(self, size: int) -> float:
+        return size * 10 / self.baudrate if self.baudrate else 0
+
+    def _take_fault(self, name: str) -> bool:
+        if getattr(self.faults, name) == self._chunk:
+            setattr(self.faults, name, None)
+            return True
+        return False
+
+    def _program(self, data: bytes) -> tuple[Optional[bytes], float]:
+        busy = self.program_time
+        if self._take_fault("fail_chunk"):
+            self._chunk += 1
+            return IN_SYNC + FAILED, busy
+        if self._address + len(data) > self.flash_size or len(data) % 4:
+            return IN_SYNC + INVALID, busy
+
+        if self._take_fault("corrupt_chunk"):
+            data = bytes([data[0] ^ 0x01]) + data[1:]
+        self.flash[self._address: self._address+len(data)] = data
+        if self._address == 0:
+            self._first_word_held = True
+        self._address += len(data)
+
+        reply: Optional[bytes] = IN_SYNC + OK
+        if self._take_fault("drop_chunk_reply"):
+            reply = None
+        if self._take_fault("stall_chunk"):
+            busy += self.faults.stall_time
+        self._chunk += 1
+        return reply, busy
+
+    def _execute(self, command: bytes, args: bytes) -> tuple[Optional[bytes], float]:
+        """ Run one command and return its reply and the time spent on it. """
+        if command == GET_SYNC:
+            return IN_SYNC + OK, 0
+        if command == GET_DEVICE:
+            info = {
+                INFO_BL_REV: self.bl_rev,
+                INFO_BOARD_ID: self.board_id,
+                INFO_BOARD_REV: self.board_rev,
+                INFO_FLASH_SIZE: self.flash_size
+            }
+            if args not in info:
+                return IN_SYNC + INVALID, 0
+            return struct.pack("<I", info[args]) + IN_SYNC + OK, 0
+        if command == CHIP_ERASE:
+            self.flash[:] = b'\xff' * self.flash_size
+            self._address = 0
+            self._chunk = 0
+            self._first_word_held = False
+            if self.faults.fail_erase:
+                self.faults.fail_erase = False
+                return IN_SYNC + FAILED, self.erase_time
+            return IN_SYNC + OK, self.erase_time
+        if command == CHIP_VERIFY:
+            self._address = 0
+            return IN_SYNC + OK, 0
+        if command == PROGRAM_MULTIPLE_BYTES:
+            return self._program(args[1:])
+        if command == READ_MULTI:
+            length = args[0]
+            if length % 4 or self._address + length > self.flash_size:
+                return IN_SYNC + INVALID, 0
+            data = bytes(self.flash[self._address: self._address+length])
+            if self._address == 0 and self._first_word_held:
+                data = b'\xff' * 4 + data[4:]
+            self._address += length
+            return data + IN_SYNC + OK, 0
+        if command == GET_CRC:
+            return struct.pack("<I", crc32(self.flash)) + IN_SYNC + OK, 0
+        if command == GET_SN:
+            address = struct.unpack("<I", args)[0]
+            if address + 4 > len(self.serial_number):
+                return IN_SYNC + INVALID, 0
+            return self.serial_number[address: address+4] + IN_SYNC + OK, 0
+        if command == GET_CHIP_DES:
+            description = self.chip_description.encode()
+            return struct.pack("<I", len(description)) + description + IN_SYNC + OK, 0
+        if command == SET_BAUD:
+            return IN_SYNC + OK, 0
+        if command == REBOOT:
+            self.rebooted = True
+            self._first_word_held = False
+            return None, 0
+        return IN_SYNC + INVALID, 0
+
+    def _parse(self, buffer: bytearray) -> Optional[tuple[bytes, bytes, int]]:
+        """ The command, its arguments and its length at the start of `buffer`, None if it is incomplete. """
+        command = bytes(buffer[:1])
+        if command in (GET_DEVICE, READ_MULTI):
+            args_length = 1
+        elif command in (GET_SN, SET_BAUD):
+            args_length = 4
+        elif command == PROGRAM_MULTIPLE_BYTES:
+            if len(buffer) < 2:
+                return None
+            args_length = 1 + buffer[1]
+        else:
+            args_length = 0
+
+        length = 1 + args_length + 1
+        if len(buffer) < length:
+            return None
+        return command, bytes(buffer[1: 1+args_length]), length
+
+    def _run(self) -> None:
+        buffer = bytearray()
+        # (due time, sequence, reply), replies are sent in order once due
+        replies: list[tuple[float, int, bytes]] = []
+        sequence = 0
+        # times from which the bootloader and the link back to the host are free
+        busy_until = 0.0
+        line_free = 0.0
+
+        while True:
+            # commands written just before close() are still executed
+            stopping = self._stop.is_set()
+            timeout = 0 if stopping else 0.05
+            if replies and not stopping:
+                timeout = max(0, min(timeout, replies[0][0] - time.monotonic()))
+            readable, _, _ = select.select([self._master_fd], [], [], timeout)
+
+            now = time.monotonic()
+            if readable:
+                try:
+                    data = os.read(self._master_fd, 4096)
+                except OSError:
+                    data = b''
+                buffer += data
+                arrival = now + self._transfer_time(len(data))
+
+                while buffer:
+                    parsed = self._parse(buffer)
+                    if parsed is None:
+                        break
+                    command, args, length = parsed
+                    terminated = buffer[length-1: length] == END_OF_CMD
+                    del buffer[:length]
+                    self.commands.append(command)
+
+                    if terminated:
+                        reply, busy = self._execute(command, args)
+                    else:
+                        reply, busy = IN_SYNC + INVALID, 0
+                    busy_until = max(busy_until, arrival) + busy
+                    if reply is None:
+                        continue
+                    due = max(busy_until + self.latency, line_free) + self._transfer_time(len(reply))
+                    line_free = due
+                    heapq.heappush(replies, (due, sequence, reply))
+                    sequence += 1
+
+            while replies and replies[0][0] <= time.monotonic():
+                _, _, reply = heapq.heappop(replies)
+                os.write(self._master_fd, reply)
+
+            if stopping:
+                break
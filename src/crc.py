@@ -0,0 +1,124 @@
+"""
+CRC32 of the program area as reported by the bootloader's GET_CRC command.
+
+The bootloader uses the reflected CRC32 polynomial (the same one as zlib) but
+without zlib's initial and final inversion, and it keeps feeding 0xFF words
+for the erased flash that follows the image. The image itself is handled by
+zlib, the erased tail is folded in with GF(2) matrix arithmetic in O(log n).
+"""
+from functools import lru_cache
+from typing import Union
+import zlib
+
+
+Buffer = Union[bytes, bytearray, memoryview]
+
+_MASK = 0xFFFFFFFF
+_POLYNOMIAL = 0xEDB88320
+
+# _zero_operators[k] is the 32x32 GF(2) matrix that advances a crc over
+# 2**k zero bytes. It is extended on demand by _shift.
+_zero_operators: list[list[int]] = []
+
+
+def _gf2_matrix_times(matrix: list[int], vector: int) -> int:
+    result = 0
+    i = 0
+    while vector:
+        if vector & 1:
+            result ^= matrix[i]
+        vector >>= 1
+        i += 1
+    return result
+
+
+def _gf2_matrix_square(matrix: list[int]) -> list[int]:
+    return [_gf2_matrix_times(matrix, row) for row in matrix]
+
+
+def _zero_operator(power: int) -> list[int]:
+    if not _zero_operators:
+        # operator for a single zero bit, squared three times for a zero byte
+        operator = [_POLYNOMIAL] + [1 << n for n in range(31)]
+        for _ in range(3):
+            operator = _gf2_matrix_square(operator)
+        _zero_operators.append(operator)
+
+    while len(_zero_operators) <= power:
+        _zero_operators.append(_gf2_matrix_square(_zero_operators[-1]))
+
+    return _zero_operators[power]
+
+
+def _shift(crc: int, length: int) -> int:
+    """ Advance `crc` over `length` zero bytes. """
+    power = 0
+    while length:
+        if length & 1:
+            crc = _gf2_matrix_times(_zero_operator(power), crc)
+        length >>= 1
+        power += 1
+    return crc
+
+
+@lru_cache(maxsize=None)
+def _erased_crc32(length: int) -> int:
+    """ CRC of `length` 0xFF bytes, starting from 0. """
+    crc = 0
+    block_crc = crc32(b'\xff')
+    power = 0
+    while length:
+        if length & 1:
+            crc = _shift(crc, 1 << power) ^ block_crc
+        # double the block: crc(FF * 2n) = shift(crc(FF * n), n) ^ crc(FF * n)
+        block_crc = _shift(block_crc, 1 << power) ^ block_crc
+        length >>= 1
+        power += 1
+    return crc
+
+
+def _padding_length(image_length: int, flash_size: int) -> int:
+    # The bootloader feeds one 0xFF word for every word between the end of
+    # the image and the end of the flash.
+    return 4 * len(range(image_length, flash_size - 1, 4))
+
+
+def crc32(data: Buffer, crc: int = 0) -> int:
+    """ Continue the bootloader CRC `crc` over `data`. """
+    return zlib.crc32(data, crc ^ _MASK) ^ _MASK
+
+
+def pad_crc32(crc: int, image_length: int, flash_size: int) -> int:
+    """ Fold the erased flash following an image of `image_length` bytes into `crc`. """
+    padding = _padding_length(image_length, flash_size)
+    return _shift(crc, padding) ^ _erased_crc32(padding)
+
+
+def expected_crc32(flash_size: int, image: Buffer) -> int:
+    """ The value GET_CRC returns once `image` is programmed on a board with `flash_size` bytes of flash. """
+    image = memoryview(image).cast('B')
+    return pad_crc32(crc32(image), len(image), flash_size)
+
+
+class Crc32:
+    """
+    Incremental form of expected_crc32, for computing the crc while the image
+    is being streamed:
+
+        crc = Crc32()
+        for chunk in chunks:
+            crc.update(chunk)
+        expected_crc = crc.pad(flash_size)
+    """
+
+    def __init__(self) -> None:
+        self.value = 0
+        self.length = 0
+
+    def update(self, data: Buffer) -> None:
+        data = memoryview(data).cast('B')
+        self.value = crc32(data, self.value)
+        self.length += len(data)
+
+    def pad(self, flash_size: int) -> int:
+        return pad_crc32(self.value, self.length, flash_size)
@@ -0,0 +1,321 @@
+"""
+Loading of firmware files into the image that is uploaded to the bootloader.
+
+The loader is picked by file extension:
+
+- .apj and .px4, the JSON containers of ArduPilot and PX4: the base64 `image`
+  field is streamed straight through the zlib decompressor into one buffer
+  that is already padded to a 4-byte length, so only about one image is held
+  in memory at a time.
+- .bin, a raw image: memory-mapped and chunked without being copied.
+- .hex, Intel HEX: parsed in a single pass into one contiguous buffer, with
+  the gaps between records and the tail padded with erased (0xFF) bytes. Files
+  spanning more than MAX_HEX_SPAN bytes are rejected.
+
+Raw and Intel HEX images don't say which board they are built for, so their
+board id has to be passed to load_firmware. Other formats can be added with
+register_loader.
+"""
+from dataclasses import dataclass, field
+from typing import BinaryIO, Callable, Generator, Optional, Union
+from mmap import mmap, ACCESS_READ
+import binascii
+import json
+import zlib
+import os
+import re
+
+from crc import expected_crc32
+
+
+Image = Union[bytes, bytearray, mmap]
+
+# base64 characters decoded per step, a multiple of 4
+_DECODE_BLOCK_SIZE = 64 * 1024
+
+# compared against the end of an image, see erased_tail
+_ERASED_BLOCK = b'\xff' * 4096
+
+_IMAGE_FIELD = re.compile(rb'"image"\s*:\s*"')
+
+# Intel HEX record types
+_HEX_DATA = 0x00
+_HEX_END_OF_FILE = 0x01
+_HEX_EXTENDED_SEGMENT_ADDRESS = 0x02
+_HEX_EXTENDED_LINEAR_ADDRESS = 0x04
+
+# largest span of an Intel HEX image, above the flash of any board, so records
+# for option bytes or OTP far above the image are rejected instead of filled
+MAX_HEX_SPAN = 16 * 1024 * 1024
+
+
+@dataclass
+class Firmware:
+    board_id: int
+    image_size: int
+    image: Image
+    path: str = ''
+    # sha256 of the firmware file, set when loaded through an ImageCache
+    digest: str = ''
+    # expected GET_CRC value by flash size
+    crcs: dict[int, int] = field(default_factory=dict, repr=False)
+
+    def expected_crc32(self, flash_size: int) -> int:
+        if flash_size not in self.crcs:
+            # the image is uploaded padded to a whole number of words
+            self.crcs[flash_size] = expected_crc32(flash_size, _pad(self.image))
+        return self.crcs[flash_size]
+
+
+def iter_chunks(image: Image, chunk_size: int) -> Generator[tuple[int, memoryview], None, None]:
+    """ Yield (offset, chunk) pairs of `image` without copying it. """
+    view = memoryview(image)
+    for offset in range(0, len(view), chunk_size):
+        yield offset, view[offset: offset+chunk_size]
+
+
+def erased_tail(image: Image) -> int:
+    """
+    The length of the run of erased (0xFF) bytes at the end of `image`, in
+    whole words from the start of the image. Erased flash already reads as
+    0xFF, so these bytes needn't be programmed. Only the tail is scanned, a
+    block at a time from the end.
+    """
+    view = memoryview(image)
+    end = len(view)
+    while end:
+        start = max(0, end - len(_ERASED_BLOCK))
+        block = view[start:end]
+        if block != _ERASED_BLOCK[:end-start]:
+            end = start + len(bytes(block).rstrip(b'\xff'))
+            break
+        end = start
+    # the bootloader programs whole words
+    end = min(len(view), (end + 3) & ~3)
+    return len(view) - end
+
+
+def _pad(image: Image) -> Image:
+    # pad image to 4-byte length
+    padding = -len(image) % 4
+    if padding:
+        image = bytes(image) + b'\xff' * padding
+    return image
+
+
+def _decode_image(encoded: memoryview, image_size: int) -> bytearray:
+    decompressor = zlib.decompressobj()
+    image = bytearray(image_size + -image_size % 4)
+    length = 0
+
+    def write(data: bytes) -> None:
+        nonlocal length
+        end = length + len(data)
+        if end > len(image):
+            # the image_size field is too small, grow past it
+            image.extend(bytes(end - len(image)))
+        image[length: end] = data
+        length = end
+
+    for start in range(0, len(encoded), _DECODE_BLOCK_SIZE):
+        compressed = binascii.a2b_base64(encoded[start: start+_DECODE_BLOCK_SIZE])
+        # bound the output of each step, runs of erased flash compress very well
+        while compressed:
+            write(decompressor.decompress(compressed, _DECODE_BLOCK_SIZE))
+            compressed = decompressor.unconsumed_tail
+    write(decompressor.flush())
+
+    # pad image to 4-byte length
+    del image[length:]
+    image.extend(b'\xff' * (-length % 4))
+    return image
+
+
+def _split_image_field(data: Union[bytes, mmap]) -> tuple[dict, memoryview]:
+    """ The fields of an .apj document other than the image, and the still encoded image. """
+    field_start = _IMAGE_FIELD.search(data)
+    image_start = field_start.end() if field_start else -1
+    image_end = data.find(b'"', image_start) if field_start else -1
+
+    if image_end < 0 or data.find(b'\\', image_start, image_end) >= 0:
+        # escaped or unusual layout, fall back to decoding the whole document
+        fields: dict = json.loads(data[:])
+        return fields, memoryview(fields.pop("image").encode())
+
+    # everything but the image field is small
+    fields = json.loads(bytes(data[:image_start]) + bytes(data[image_end:]))
+    del fields["image"]
+    return fields, memoryview(data)[image_start: image_end]
+
+
+def _parse_firmware(data: Union[bytes, mmap], path: str = '') -> Firmware:
+    fields, encoded = _split_image_field(data)
+    try:
+        image = _decode_image(encoded, fields["image_size"])
+    finally:
+        # a view left on the mapped file keeps it from being closed
+        encoded.release()
+    return Firmware(board_id=fields["board_id"], image_size=fields["image_size"], image=image, path=path)
+
+
+def _check_image_header(encoded: memoryview, path: str) -> None:
+    """ Fail on an image that isn't zlib compressed before anything is erased for it. """
+    try:
+        header = binascii.a2b_base64(encoded[:4])
+    except binascii.Error:
+        header = b''
+    if len(header) < 2 or header[0] & 0x0F != 8 or int.from_bytes(header[:2], "big") % 31:
+        raise ValueError(f"The image of {path} isn't zlib compressed")
+
+
+def _read_apj_metadata(path: str) -> dict:
+    with open(path, "rb") as file:
+        with mmap(file.fileno(), 0, access=ACCESS_READ) as data:
+            fields, encoded = _split_image_field(data)
+            try:
+                _check_image_header(encoded, path)
+            finally:
+                encoded.release()
+    return fields
+
+
+def _load_apj(path: str, board_id: Optional[int] = None) -> Firmware:
+    with open(path, "rb") as file:
+        with mmap(file.fileno(), 0, access=ACCESS_READ) as data:
+            firmware = _parse_firmware(data, path)
+    return firmware
+
+
+def _read_bin_metadata(path: str) -> dict:
+    return {"image_size": os.path.getsize(path)}
+
+
+def _load_bin(path: str, board_id: Optional[int] = None) -> Firmware:
+    if board_id is None:
+        raise ValueError(f"{path} is a raw image, its board id has to be given")
+    with open(path, "rb") as file:
+        size = os.fstat(file.fileno()).st_size
+        # the mapping stays valid after the file is closed
+        image = mmap(file.fileno(), 0, access=ACCESS_READ) if size else b''
+    return Firmware(board_id=board_id, image_size=size, image=image, path=path)
+
+
+def _hex_records(file: BinaryIO, path: str) -> Generator[tuple[int, bytes], None, None]:
+    """ Yield the (absolute address, data) of the data records of an Intel HEX file. """
+    base = 0
+    for number, line in enumerate(file, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            if line[:1] != b':':
+                raise ValueError("missing start code")
+            record = bytes.fromhex(line[1:].decode("ascii"))
+            if len(record) < 5 or len(record) != 5 + record[0]:
+                raise ValueError("wrong record length")
+            if sum(record) & 0xFF:
+                raise ValueError("wrong checksum")
+        except (ValueError, UnicodeDecodeError) as err:
+            raise ValueError(f"Invalid Intel HEX record on line {number} of {path}: {err}") from None
+
+        record_type = record[3]
+        data = record[4:-1]
+        if record_type == _HEX_DATA:
+            yield base + int.from_bytes(record[1:3], "big"), data
+        elif record_type == _HEX_END_OF_FILE:
+            return
+        elif record_type == _HEX_EXTENDED_SEGMENT_ADDRESS:
+            base = int.from_bytes(data, "big") << 4
+        elif record_type == _HEX_EXTENDED_LINEAR_ADDRESS:
+            base = int.from_bytes(data, "big") << 16
+        # the start address records don't matter to the bootloader
+
+
+def _read_hex_metadata(path: str) -> dict:
+    start = end = None
+    with open(path, "rb") as file:
+        for address, data in _hex_records(file, path):
+            start = address if start is None else min(start, address)
+            end = address + len(data) if end is None else max(end, address + len(data))
+    if start is None:
+        return {"image_size": 0}
+    _check_hex_span(path, start, end)
+    return {"image_size": end - start}
+
+
+def _check_hex_span(path: str, start: int, end: int) -> None:
+    if end - start > MAX_HEX_SPAN:
+        raise ValueError(
+            f"{path} has data from {start:#x} to {end:#x}, more than the {MAX_HEX_SPAN} bytes an image can span"
+        )
+
+
+def _load_hex(path: str, board_id: Optional[int] = None) -> Firmware:
+    """
+    The image starts at the lowest address of the file, which has to be its
+    first record, as it is in the output of linkers.
+    """
+    if board_id is None:
+        raise ValueError(f"{path} is an Intel HEX image, its board id has to be given")
+
+    image = bytearray()
+    base: Optional[int] = None
+    with open(path, "rb") as file:
+        for address, data in _hex_records(file, path):
+            if base is None:
+                base = address
+            offset = address - base
+            if offset < 0:
+                raise ValueError(f"{path} has data at {address:#x}, below its first record at {base:#x}")
+            end = offset + len(data)
+            _check_hex_span(path, base, address + len(data))
+            if end > len(image):
+                # gaps between records are left erased
+                image.extend(b'\xff' * (end - len(image)))
+            image[offset: end] = data
+
+    image_size = len(image)
+    image.extend(b'\xff' * (-image_size % 4))
+    return Firmware(board_id=board_id, image_size=image_size, image=image, path=path)
+
+
+# extension -> (load, read metadata)
+_LOADERS: dict[str, tuple[Callable[..., Firmware], Callable[[str], dict]]] = {
+    ".apj": (_load_apj, _read_apj_metadata),
+    ".px4": (_load_apj, _read_apj_metadata),
+    ".bin": (_load_bin, _read_bin_metadata),
+    ".hex": (_load_hex, _read_hex_metadata),
+}
+
+
+def register_loader(extension: str, load: Callable[..., Firmware], read_metadata: Callable[[str], dict]) -> None:
+    """
+    Load the files with `extension` with `load(path, board_id=None)`.
+    `read_metadata(path)` returns their fields, at least image_size, and
+    board_id if the format records it, without decoding the image.
+    """
+    _LOADERS[extension.lower()] = (load, read_metadata)
+
+
+def _loader(path: str) -> tuple[Callable[..., Firmware], Callable[[str], dict]]:
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in _LOADERS:
+        raise ValueError(f"Unknown firmware format {extension!r} of {path}")
+    return _LOADERS[extension]
+
+
+def firmware_extensions() -> tuple[str, ...]:
+    return tuple(_LOADERS)
+
+
+def read_firmware_metadata(path: str) -> dict:
+    """
+    The fields of a firmware file, such as board_id and image_size, without
+    decoding its image. Raw and Intel HEX images have no board_id.
+    """
+    return _loader(path)[1](path)
+
+
+def load_firmware(path: str, board_id: Optional[int] = None) -> Firmware:
+    """ Read a firmware file and decode its image. `board_id` is required for raw and Intel HEX images. """
+    return _loader(path)[0](path, board_id)
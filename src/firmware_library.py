@@ -0,0 +1,166 @@
+"""
+An indexed directory of firmware files.
+
+Only the metadata of each .apj and .px4 file (board id, image size, version, git hash
+and build time) is read, without decoding its image, and kept in an index file
+in the directory. A file is read again only when its mtime or size changes, so
+rescanning a directory of hundreds of files is a stat per file. The image is
+decoded only once an upload starts:
+
+    library = FirmwareLibrary("firmware/")
+    entry = library.best(board_id=140, flash_size=2 * 1024 * 1024)
+    for progress in upload_firmware("COM3", entry.path):
+        print(progress)
+"""
+from dataclasses import dataclass, asdict
+from typing import Optional
+import threading
+import logging
+import json
+import os
+
+from firmware import read_firmware_metadata
+
+
+logger = logging.getLogger(__name__)
+
+# the formats that record the board id
+FIRMWARE_EXTENSIONS = (".apj", ".px4")
+
+# bump when the layout of the index changes
+_INDEX_VERSION = 1
+
+
+@dataclass(frozen=True)
+class FirmwareEntry:
+    path: str
+    board_id: int
+    image_size: int
+    version: str = ''
+    git_hash: str = ''
+    build_time: int = 0
+    mtime_ns: int = 0
+
+
+def _version_key(version: str) -> tuple[int, ...]:
+    """ "4.5.1-beta" -> (4, 5, 1), so versions compare numerically. """
+    key = []
+    for part in version.split("."):
+        digits = ""
+        for char in part:
+            if not char.isdigit():
+                break
+            digits += char
+        if not digits:
+            break
+        key.append(int(digits))
+    return tuple(key)
+
+
+def _preference(entry: FirmwareEntry) -> tuple:
+    # newest version first, then newest build, then newest file
+    return (_version_key(entry.version), entry.build_time, entry.mtime_ns, entry.path)
+
+
+class FirmwareLibrary:
+    def __init__(self, directory: str, index_path: Optional[str] = None) -> None:
+        """ The index is kept in `index_path`, by default a hidden file in `directory`. """
+        self.directory = directory
+        self.index_path = index_path or os.path.join(directory, ".firmware_index.json")
+        self._lock = threading.Lock()
+        # file name -> [mtime_ns, size, entry fields or None if unreadable]
+        self._files: dict[str, list] = {}
+        # board id -> entries, most preferred first
+        self._by_board: Optional[dict[int, list[FirmwareEntry]]] = None
+
+        try:
+            with open(self.index_path, "r") as file:
+                index = json.load(file)
+            if index.get("version") == _INDEX_VERSION:
+                self._files = index["files"]
+        except (OSError, ValueError, KeyError, AttributeError):
+            pass
+
+    def _read_entry(self, name: str, stat: os.stat_result) -> Optional[dict]:
+        path = os.path.join(self.directory, name)
+        try:
+            metadata = read_firmware_metadata(path)
+            return asdict(FirmwareEntry(
+                path=path,
+                board_id=int(metadata["board_id"]),
+                image_size=int(metadata["image_size"]),
+                version=str(metadata.get("version", "")),
+                git_hash=str(metadata.get("git_identity", "")),
+                build_time=int(metadata.get("build_time", 0)),
+                mtime_ns=stat.st_mtime_ns
+            ))
+        except (OSError, ValueError, KeyError, TypeError) as err:
+            logger.warning("Skipping firmware file %s: %s", path, err)
+            return None
+
+    def _save_index(self) -> None:
+        tmp_path = f"{self.index_path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "w") as file:
+                json.dump({"version": _INDEX_VERSION, "files": self._files}, file)
+            os.replace(tmp_path, self.index_path)
+        except OSError:
+            pass
+
+    def refresh(self) -> None:
+        """ Pick up the files that were added, changed or removed since the last scan. """
+        with self._lock:
+            files: dict[str, list] = {}
+            changed = False
+            for dir_entry in os.scandir(self.directory):
+                if not dir_entry.name.lower().endswith(FIRMWARE_EXTENSIONS) or not dir_entry.is_file():
+                    continue
+                stat = dir_entry.stat()
+                known = self._files.get(dir_entry.name)
+                if known and known[0] == stat.st_mtime_ns and known[1] == stat.st_size:
+                    files[dir_entry.name] = known
+                    continue
+                files[dir_entry.name] = [stat.st_mtime_ns, stat.st_size, self._read_entry(dir_entry.name, stat)]
+                changed = True
+
+            changed = changed or files.keys() != self._files.keys()
+            self._files = files
+            if changed or self._by_board is None:
+                self._by_board = self._build_index()
+            if changed:
+                self._save_index()
+
+    def _build_index(self) -> dict[int, list[FirmwareEntry]]:
+        by_board: dict[int, list[FirmwareEntry]] = {}
+        for name, (_, _, fields) in self._files.items():
+            if fields is None:
+                continue
+            entry = FirmwareEntry(**{**fields, "path": os.path.join(self.directory, name)})
+            by_board.setdefault(entry.board_id, []).append(entry)
+        for entries in by_board.values():
+            entries.sort(key=_preference, reverse=True)
+        return by_board
+
+    def _get_index(self) -> dict[int, list[FirmwareEntry]]:
+        if self._by_board is None:
+            self.refresh()
+        return self._by_board
+
+    def entries(self, board_id: Optional[int] = None) -> list[FirmwareEntry]:
+        """ The firmware for `board_id`, or all of it, most preferred first within each board. """
+        index = self._get_index()
+        if board_id is not None:
+            return list(index.get(board_id, []))
+        return [entry for entries in index.values() for entry in entries]
+
+    def unreadable(self) -> list[str]:
+        """ The paths of the firmware files whose metadata couldn't be read. """
+        self._get_index()
+        return [os.path.join(self.directory, name) for name, (_, _, fields) in self._files.items() if fields is None]
+
+    def best(self, board_id: int, flash_size: Optional[int] = None) -> Optional[FirmwareEntry]:
+        """ The newest firmware for `board_id` whose image fits in `flash_size`, if any. """
+        for entry in self._get_index().get(board_id, []):
+            if flash_size is None or entry.image_size <= flash_size:
+                return entry
+        return None
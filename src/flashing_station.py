@@ -0,0 +1,186 @@
+"""
+A flashing station that flashes boards as they are plugged in.
+
+The serial ports are polled for new devices. Each new board is identified
+through its bootloader, the newest firmware for its board id that fits its
+flash is picked from a directory of .apj files, see firmware_library.py, and
+the board is flashed on a worker thread so that a slow board never holds up
+the others.
+A result record is logged for every board.
+
+    python src/flashing_station.py firmware/ --results results.jsonl
+"""
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+import threading
+import inspect
+import logging
+import json
+import time
+
+from serial.tools.list_ports import comports
+
+from bootloader_protocol import _hardware_id, BootloaderSession, RetryPolicy
+from firmware_library import FirmwareLibrary
+
+
+logger = logging.getLogger(__name__)
+
+
+class FlashingStation:
+    def __init__(
+        self,
+        firmware_dir: str,
+        max_workers: int = 8,
+        poll_interval: float = 0.5,
+        forget_after: float = 5,
+        results_path: Optional[str] = None,
+        **upload_options
+    ) -> None:
+        """
+        `upload_options` are negotiate_baudrate and the options of
+        BootloaderSession.upload, which they are passed on to. A board that
+        has been handled is ignored until it has been unplugged for
+        `forget_after` seconds, which has to outlast the reboots during
+        flashing.
+        """
+        # checked here, rather than failing the upload of every board
+        supported = set(inspect.signature(BootloaderSession.upload).parameters) - {"self", "path"}
+        unsupported = sorted(set(upload_options) - supported - {"negotiate_baudrate"})
+        if unsupported:
+            raise TypeError(f"Unsupported upload options: {', '.join(unsupported)}")
+
+        self.firmware_dir = firmware_dir
+        self.poll_interval = poll_interval
+        self.forget_after = forget_after
+        self.results_path = results_path
+        self.upload_options = upload_options
+        self.library = FirmwareLibrary(firmware_dir)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="station")
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        # hardware id -> time the board was last seen, for boards being or already flashed
+        self._handled: dict[str, float] = {}
+        self._busy: set[str] = set()
+
+    def _select_firmware(self, board_id: int, flash_size: Optional[int] = None) -> Optional[str]:
+        """
+        The best firmware in the firmware directory for `board_id` and
+        `flash_size`, by the board id in the files, see FirmwareLibrary.best.
+        """
+        self.library.refresh()
+        entry = self.library.best(board_id, flash_size)
+        return entry.path if entry is not None else None
+
+    def _record(self, record: dict) -> None:
+        logger.info("%s", json.dumps(record))
+        if self.results_path:
+            with self._lock, open(self.results_path, "a") as file:
+                file.write(json.dumps(record) + "\n")
+
+    def _flash(self, device: str, hardware_id: str) -> None:
+        start = time.monotonic()
+        record = {"Port": device, "Hardware ID": hardware_id}
+        options = dict(self.upload_options)
+        negotiate_baudrate = options.pop("negotiate_baudrate", False)
+        try:
+            # identify and flash the board on one connection
+            with BootloaderSession(device, negotiate_baudrate=negotiate_baudrate) as session:
+                board_id = session.board_id
+                record["Board ID"] = board_id
+                record["Flash Size"] = session.flash_size
+
+                path = self._select_firmware(board_id, session.flash_size)
+                if path is None:
+                    raise RuntimeError(f"No firmware found for board id {board_id} in {self.firmware_dir}")
+                record["Firmware"] = path
+
+                progress = {}
+                for progress in session.upload(path, **options):
+                    logger.debug("%s: %s", device, progress)
+            if "Retries" in progress:
+                record["Retries"] = int(progress["Retries"])
+                record["Recovery Time"] = progress["Recovery Time"]
+            skipped = progress.get("Uploading Firmware") == "Skipped"
+            record["Result"] = "Skipped" if skipped else "Completed"
+        except Exception as err:
+            record["Result"] = "Failed"
+            record["Error"] = str(err)
+
+        record["Duration"] = round(time.monotonic() - start, 3)
+        self._record(record)
+        with self._lock:
+            self._busy.discard(hardware_id)
+            self._handled[hardware_id] = time.monotonic()
+
+    def _poll(self) -> tuple[list[tuple[str, str]], list[str]]:
+        """
+        Return the (device, hardware id) of the boards plugged in since the
+        last poll, and the hardware ids of the boards that were unplugged.
+        """
+        now = time.monotonic()
+        added = []
+        removed = []
+        with self._lock:
+            for port in comports():
+                if port.vid is None:
+                    # not a USB device, nothing to hot-plug
+                    continue
+                # a board without a serial number is only known by its device
+                hardware_id = _hardware_id(port) or port.device
+                if hardware_id not in self._handled:
+                    added.append((port.device, hardware_id))
+                    self._busy.add(hardware_id)
+                self._handled[hardware_id] = now
+
+            for hardware_id, last_seen in list(self._handled.items()):
+                if hardware_id not in self._busy and now - last_seen > self.forget_after:
+                    del self._handled[hardware_id]
+                    removed.append(hardware_id)
+        return added, removed
+
+    def run(self) -> None:
+        """ Flash boards as they are plugged in, until stop() is called. """
+        # boards that are already plugged in when the station starts are flashed too
+        while not self._stop.is_set():
+            added, removed = self._poll()
+            for hardware_id in removed:
+                logger.info("Board %s was unplugged", hardware_id)
+            for device, hardware_id in added:
+                logger.info("New board on %s (%s)", device, hardware_id)
+                self._executor.submit(self._flash, device, hardware_id)
+            self._stop.wait(self.poll_interval)
+
+        self._executor.shutdown(wait=True)
+
+    def stop(self) -> None:
+        self._stop.set()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from metrics import PrometheusTextfileSink
+
+    parser = argparse.ArgumentParser(description="Flash boards as they are plugged in.")
+    parser.add_argument("firmware_dir", help="directory of .apj and .px4 files, picked by the board id they record")
+    parser.add_argument("--results", help="file to append a JSON result record per board to")
+    parser.add_argument("--workers", type=int, default=8, help="number of boards flashed at once")
+    parser.add_argument("--only-if-different", action="store_true", help="skip boards that already run the firmware")
+    parser.add_argument("--metrics", help="Prometheus textfile to keep the upload timings in")
+    parser.add_argument("--retries", type=int, default=2, help="times a failed upload is retried without rebooting")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    station = FlashingStation(
+        args.firmware_dir,
+        max_workers=args.workers,
+        results_path=args.results,
+        only_if_different=args.only_if_different,
+        metrics_sink=PrometheusTextfileSink(args.metrics) if args.metrics else None,
+        retry_policy=RetryPolicy(retries=args.retries)
+    )
+    try:
+        station.run()
+    except KeyboardInterrupt:
+        station.stop()
@@ -0,0 +1,175 @@
+"""
+Persistent cache of decoded firmware images.
+
+Entries are keyed by the sha256 of the firmware file, so a file that changes
+on disk simply maps to a new entry. Each entry holds the decoded and padded
+image, which is memory-mapped on a hit, and a small JSON file with the board
+id, image size and the expected CRC for every flash size seen so far. The
+least recently used entries are evicted once the cache outgrows `max_size`.
+
+Only .apj and .px4 files are cached: raw and Intel HEX images don't record
+their board id, so they are loaded with load_firmware instead.
+"""
+from typing import Optional
+from mmap import mmap, ACCESS_READ
+import threading
+import hashlib
+import json
+import os
+
+from firmware import Firmware, _load_apj, _loader
+
+
+# bytes hashed per read of a firmware file
+_HASH_BLOCK_SIZE = 1024 * 1024
+
+
+def _file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        while block := file.read(_HASH_BLOCK_SIZE):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ImageCache:
+    def __init__(self, directory: str, max_size: int = 256 * 1024 * 1024) -> None:
+        self.directory = directory
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+        # path -> [mtime_ns, size, digest], so unchanged files aren't rehashed
+        self._index_path = os.path.join(directory, "index.json")
+        try:
+            with open(self._index_path, "r") as file:
+                self._index: dict[str, list] = json.load(file)
+        except (OSError, ValueError):
+            self._index = {}
+
+    def _entry_path(self, digest: str, extension: str) -> str:
+        return os.path.join(self.directory, digest + extension)
+
+    def _write_atomic(self, path: str, data: bytes) -> None:
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as file:
+            file.write(data)
+        os.replace(tmp_path, path)
+
+    def _save_index(self) -> None:
+        self._write_atomic(self._index_path, json.dumps(self._index).encode())
+
+    def _cached_digest(self, path: str, stat: os.stat_result) -> Optional[str]:
+        entry = self._index.get(path)
+        if entry and entry[0] == stat.st_mtime_ns and entry[1] == stat.st_size:
+            return entry[2]
+        return None
+
+    def _open_entry(self, digest: str, path: str) -> Optional[Firmware]:
+        try:
+            with open(self._entry_path(digest, ".json"), "r") as file:
+                meta = json.load(file)
+            with open(self._entry_path(digest, ".img"), "rb") as file:
+                image = mmap(file.fileno(), 0, access=ACCESS_READ) if meta["length"] else b''
+        except (OSError, ValueError, KeyError):
+            return None
+
+        # mark the entry as recently used
+        try:
+            os.utime(self._entry_path(digest, ".img"))
+        except OSError:
+            pass
+
+        return Firmware(
+            board_id=meta["board_id"],
+            image_size=meta["image_size"],
+            image=image,
+            path=path,
+            digest=digest,
+            crcs={int(size): crc for size, crc in meta["crcs"].items()}
+        )
+
+    def _write_entry(self, firmware: Firmware) -> None:
+        meta = {
+            "board_id": firmware.board_id,
+            "image_size": firmware.image_size,
+            "length": len(firmware.image),
+            "crcs": firmware.crcs
+        }
+        self._write_atomic(self._entry_path(firmware.digest, ".img"), firmware.image)
+        self._write_atomic(self._entry_path(firmware.digest, ".json"), json.dumps(meta).encode())
+
+    def _evict(self) -> None:
+        entries = []
+        total_size = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith(".img"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, name[:-len(".img")]))
+            total_size += stat.st_size
+
+        entries.sort()
+        for _, size, digest in entries:
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(self._entry_path(digest, ".img"))
+                os.remove(self._entry_path(digest, ".json"))
+            except OSError:
+                # still mapped by someone on platforms that forbid removing it
+                continue
+            total_size -= size
+
+    def load(self, path: str) -> Firmware:
+        """ Return the decoded firmware at `path`, decoding it only on a cache miss. """
+        if _loader(path)[0] is not _load_apj:
+            raise ValueError(f"Only .apj and .px4 files can be cached, load {path} with load_firmware instead")
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+
+        with self._lock:
+            digest = self._cached_digest(path, stat)
+        if digest:
+            firmware = self._open_entry(digest, path)
+            if firmware:
+                return firmware
+
+        digest = _file_digest(path)
+
+        with self._lock:
+            self._index[path] = [stat.st_mtime_ns, stat.st_size, digest]
+            self._save_index()
+
+        firmware = self._open_entry(digest, path)
+        if firmware:
+            return firmware
+
+        # decoded from the mapped file, like load_firmware does
+        firmware = _load_apj(path)
+        firmware.digest = digest
+        with self._lock:
+            self._write_entry(firmware)
+            self._evict()
+        return firmware
+
+    def store_crc(self, firmware: Firmware, flash_size: int) -> None:
+        """ Record the expected CRC of `firmware` for `flash_size` in its cache entry. """
+        if not firmware.digest:
+            return
+
+        crc = firmware.expected_crc32(flash_size)
+        meta_path = self._entry_path(firmware.digest, ".json")
+        with self._lock:
+            try:
+                with open(meta_path, "r") as file:
+                    meta = json.load(file)
+            except (OSError, ValueError):
+                return
+            if meta["crcs"].get(str(flash_size)) == crc:
+                return
+            meta["crcs"][str(flash_size)] = crc
+            self._write_atomic(meta_path, json.dumps(meta).encode())
@@ -0,0 +1,159 @@
+"""
+An inventory of the boards plugged into every serial port.
+
+All the ports are probed at once, so a scan takes about as long as the
+slowest port rather than the sum of them. Each port is first probed for a
+bootloader that is already running, which answers with the full device info.
+Otherwise the port is listened to for a MAVLink heartbeat, and the autopilot
+is asked for its AUTOPILOT_VERSION, in which ArduPilot reports its board id.
+The flash size, serial number and chip are only known to the bootloader, so
+with `reboot` the autopilots are rebooted into their bootloader to read them
+and then rebooted back into their firmware:
+
+    for row in scan_inventory(reboot=True):
+        print(row)
+
+    python src/inventory.py --reboot
+"""
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Optional, Union
+import time
+
+from bootloader_protocol import (
+    _get_device_info, _mavlink_connection, _open_bootloader, comports, BootloaderSession, SYNC_PROBE_TIMEOUT
+)
+from boards import match_boards_by_id
+
+
+# seconds to listen for a heartbeat, and then for the reply to AUTOPILOT_VERSION
+HEARTBEAT_TIMEOUT = 2
+VERSION_TIMEOUT = 1
+
+# MAVLink ids, so that pymavlink is only imported by ports with an autopilot
+_MAV_CMD_REQUEST_MESSAGE = 512
+_MAVLINK_MSG_ID_AUTOPILOT_VERSION = 148
+
+INVENTORY_COLUMNS = ("Port", "State", "Board ID", "Select Board", "Flash Size", "Serial Number", "Chip")
+
+Row = dict[str, Union[int, str, dict[str, list[str]]]]
+
+
+def _autopilot_board_id(device: str, heartbeat_timeout: float) -> Optional[Row]:
+    """
+    The board id of the autopilot on `device`, 0 if it doesn't report it,
+    or None if no heartbeat is heard.
+    """
+    conn = _mavlink_connection(device)
+    try:
+        heartbeat = conn.wait_heartbeat(timeout=heartbeat_timeout)
+        if not heartbeat:
+            return None
+        conn.target_system = heartbeat.get_srcSystem()
+        conn.target_component = heartbeat.get_srcComponent()
+        conn.mav.command_long_send(
+            conn.target_system, conn.target_component, _MAV_CMD_REQUEST_MESSAGE, 0,
+            _MAVLINK_MSG_ID_AUTOPILOT_VERSION, 0, 0, 0, 0, 0, 0
+        )
+        version = conn.recv_match(type="AUTOPILOT_VERSION", blocking=True, timeout=VERSION_TIMEOUT)
+    finally:
+        conn.close()
+
+    # ArduPilot puts its board id in the upper half of board_version
+    return {"System ID": heartbeat.get_srcSystem(), "Board ID": version.board_version >> 16 if version else 0}
+
+
+def _scan_port(device: str, reboot: bool, heartbeat_timeout: float) -> Row:
+    row: Row = {"Port": device}
+    try:
+        ser = _open_bootloader(device, 115200, SYNC_PROBE_TIMEOUT)
+        if ser is not None:
+            try:
+                row.update(_get_device_info(ser))
+            finally:
+                ser.close()
+            row["State"] = "Bootloader"
+        elif reboot:
+            with BootloaderSession(device) as session:
+                row.update(session.device_info())
+                session.reboot()
+            row["State"] = "Rebooted"
+        else:
+            autopilot = _autopilot_board_id(device, heartbeat_timeout)
+            if autopilot is None:
+                row["State"] = "No Response"
+                return row
+            row.update(autopilot)
+            row["State"] = "Autopilot"
+    except Exception as err:
+        # one bad port mustn't abort the scan of the others
+        row["State"] = "Failed"
+        row["Error"] = str(err)
+        return row
+
+    if row.get("Board ID"):
+        row["Select Board"] = match_boards_by_id(row["Board ID"])
+    return row
+
+
+def scan_inventory(
+    ports: Optional[Iterable[str]] = None,
+    reboot: bool = False,
+    heartbeat_timeout: float = HEARTBEAT_TIMEOUT,
+    max_workers: int = 32
+) -> list[Row]:
+    """
+    Probe every port in `ports`, by default all the serial ports, at once and
+    return a row per port, sorted by port. The "State" of a row is:
+
+    - "Bootloader": a bootloader was already running, and the row has its
+      device info, like BootloaderSession.board_info.
+    - "Autopilot": a heartbeat was heard. The row has the "System ID" and,
+      if the autopilot reports it, the "Board ID".
+    - "Rebooted": with `reboot`, an autopilot was rebooted into its
+      bootloader for its device info, then back into its firmware.
+    - "No Response", or "Failed" with the "Error".
+
+    "Select Board" holds the names of the boards with the board id.
+    """
+    devices = sorted(ports) if ports is not None else sorted(port.device for port in comports())
+    if not devices:
+        return []
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(devices)), thread_name_prefix="inventory") as executor:
+        return list(executor.map(lambda device: _scan_port(device, reboot, heartbeat_timeout), devices))
+
+
+def _format_cell(value: object) -> str:
+    if isinstance(value, dict):
+        names = [name for names in value.values() for name in names]
+        shown = ", ".join(names[:3])
+        return f"{shown} (+{len(names) - 3})" if len(names) > 3 else shown
+    return str(value)
+
+
+def format_inventory(rows: list[Row], columns: tuple[str, ...] = INVENTORY_COLUMNS) -> str:
+    """ The rows as a plain text table, with a column per key in `columns`. """
+    cells = [list(columns)] + [[_format_cell(row.get(column, "")) for column in columns] for row in rows]
+    widths = [max(len(line[i]) for line in cells) for i in range(len(columns))]
+    return "\n".join("  ".join(cell.ljust(width) for cell, width in zip(line, widths)).rstrip() for line in cells)
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(description="List the boards plugged into the serial ports.")
+    parser.add_argument("ports", nargs="*", help="ports to probe, all the serial ports by default")
+    parser.add_argument("--reboot", action="store_true", help="reboot autopilots into their bootloader for their device info")
+    parser.add_argument("--heartbeat-timeout", type=float, default=HEARTBEAT_TIMEOUT, help="seconds to wait for a heartbeat")
+    parser.add_argument("--json", action="store_true", help="print a JSON object per port instead of a table")
+    args = parser.parse_args()
+
+    start = time.monotonic()
+    rows = scan_inventory(args.ports or None, args.reboot, args.heartbeat_timeout)
+    if args.json:
+        for row in rows:
+            print(json.dumps(row))
+    else:
+        print(format_inventory(rows))
+        print(f"\n{len(rows)} ports scanned in {time.monotonic() - start:.1f} s")
@@ -0,0 +1,204 @@
+"""
+Timing and throughput measurements of firmware uploads.
+
+upload_firmware fills an UploadMetrics with the wall time of each phase
+(connect, sync, load, backup, erase, upload, verify), a histogram of the time
+each chunk took to be acknowledged and the number of bytes programmed. When the upload
+ends, successfully or not, the metrics are handed to the metrics sink, which
+is any callable taking an UploadMetrics. PrometheusTextfileSink aggregates
+them into a file for node_exporter's textfile collector.
+"""
+from dataclasses import dataclass, field
+from contextlib import contextmanager
+from typing import Callable, Generator, Optional
+from bisect import bisect_left
+import threading
+import time
+import os
+
+
+# upper bounds in seconds of the ack latency histogram buckets
+ACK_LATENCY_BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0)
+
+class Histogram:
+    def __init__(self, bounds: tuple[float, ...] = ACK_LATENCY_BUCKETS) -> None:
+        self.bounds = bounds
+        # the last bucket counts what is above the largest bound
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def merge(self, other: "Histogram") -> None:
+        if other.bounds != self.bounds:
+            raise ValueError("Can only merge histograms with the same buckets")
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.count += other.count
+        self.sum += other.sum
+
+    def quantile(self, q: float) -> float:
+        """ The upper bound of the bucket holding the `q` quantile, inf if above the largest bound. """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+@dataclass
+class UploadMetrics:
+    port: str = ''
+    # wall time of each phase, in seconds
+    phases: dict[str, float] = field(default_factory=dict)
+    # probe, heartbeat and reboot times of the connect phase, see _connect
+    connect_phases: dict[str, float] = field(default_factory=dict)
+    ack_latency: Histogram = field(default_factory=Histogram)
+    image_bytes: int = 0
+    # bytes acknowledged by the current upload attempt
+    bytes_acked: int = 0
+    # bytes of erased tail left out of the upload
+    bytes_elided: int = 0
+    # failed attempts that were retried, and the seconds spent getting back in sync
+    retries: int = 0
+    recovery_time: float = 0.0
+    # "Completed", "Skipped", "Failed" or "Cancelled"
+    result: str = ''
+    error: Optional[BaseException] = None
+    # start time of the phases in progress, and duration of the last run of the others
+    _phase_started: dict[str, float] = field(default_factory=dict, repr=False)
+    _last_duration: dict[str, float] = field(default_factory=dict, repr=False)
+
+    @contextmanager
+    def phase(self, name: str) -> Generator[None, None, None]:
+        """ Time a phase. A phase that runs more than once, as on a retry, accumulates. """
+        start = time.monotonic()
+        self._phase_started[name] = start
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - self._phase_started.pop(name)
+            self._last_duration[name] = elapsed
+            self.phases[name] = self.phases.get(name, 0) + elapsed
+
+    def upload_rate(self) -> float:
+        """ Bytes per second programmed by the current or last upload attempt. """
+        if "upload" in self._phase_started:
+            elapsed = time.monotonic() - self._phase_started["upload"]
+        else:
+            elapsed = self._last_duration.get("upload", 0)
+        return self.bytes_acked / elapsed if elapsed > 0 else 0.0
+
+    def eta(self) -> Optional[float]:
+        """ Seconds left until the image is uploaded at the current rate. """
+        rate = self.upload_rate()
+        if not rate:
+            return None
+        return (self.image_bytes - self.bytes_acked) / rate
+
+
+MetricsSink = Callable[[UploadMetrics], None]
+
+
+def _format_labels(labels: dict[str, str]) -> str:
+    if not labels:
+        return ''
+    escaped = (f'{key}="{value}"'.replace("\\", "\\\\").replace("\n", "\\n") for key, value in labels.items())
+    return "{" + ",".join(escaped) + "}"
+
+
+class PrometheusTextfileSink:
+    """
+    Aggregates the metrics of every upload and rewrites `path` in the
+    Prometheus text format after each one. Point node_exporter's textfile
+    collector at the directory of `path` to scrape it.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._results: dict[str, int] = {}
+        self._phase_seconds: dict[str, float] = {}
+        self._phase_count: dict[str, int] = {}
+        self._ack_latency = Histogram()
+        self._bytes = 0
+        self._elided_bytes = 0
+        self._last_rate = 0.0
+        self._retries = 0
+        self._recovery_time = 0.0
+
+    def __call__(self, metrics: UploadMetrics) -> None:
+        with self._lock:
+            self._results[metrics.result] = self._results.get(metrics.result, 0) + 1
+            for phase, seconds in metrics.phases.items():
+                self._phase_seconds[phase] = self._phase_seconds.get(phase, 0) + seconds
+                self._phase_count[phase] = self._phase_count.get(phase, 0) + 1
+            self._ack_latency.merge(metrics.ack_latency)
+            self._bytes += metrics.bytes_acked
+            self._elided_bytes += metrics.bytes_elided
+            self._retries += metrics.retries
+            self._recovery_time += metrics.recovery_time
+            if metrics.bytes_acked:
+                self._last_rate = metrics.upload_rate()
+            self._write()
+
+    def _write(self) -> None:
+        lines = [
+            "# HELP firmup_uploads_total Firmware uploads by result.",
+            "# TYPE firmup_uploads_total counter",
+        ]
+        for result, count in sorted(self._results.items()):
+            lines.append(f"firmup_uploads_total{_format_labels({'result': result})} {count}")
+
+        lines += [
+            "# HELP firmup_phase_seconds Wall time of the upload phases.",
+            "# TYPE firmup_phase_seconds summary",
+        ]
+        for phase in sorted(self._phase_seconds):
+            labels = _format_labels({"phase": phase})
+            lines.append(f"firmup_phase_seconds_sum{labels} {self._phase_seconds[phase]:.6f}")
+            lines.append(f"firmup_phase_seconds_count{labels} {self._phase_count[phase]}")
+
+        lines += [
+            "# HELP firmup_ack_latency_seconds Time from sending a chunk to its acknowledgement.",
+            "# TYPE firmup_ack_latency_seconds histogram",
+        ]
+        cumulative = 0
+        for bound, count in zip(self._ack_latency.bounds + (float("inf"),), self._ack_latency.counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            lines.append(f"firmup_ack_latency_seconds_bucket{_format_labels({'le': le})} {cumulative}")
+        lines.append(f"firmup_ack_latency_seconds_sum {self._ack_latency.sum:.6f}")
+        lines.append(f"firmup_ack_latency_seconds_count {self._ack_latency.count}")
+
+        lines += [
+            "# HELP firmup_uploaded_bytes_total Bytes programmed.",
+            "# TYPE firmup_uploaded_bytes_total counter",
+            f"firmup_uploaded_bytes_total {self._bytes}",
+            "# HELP firmup_elided_bytes_total Erased bytes at the end of images that weren't programmed.",
+            "# TYPE firmup_elided_bytes_total counter",
+            f"firmup_elided_bytes_total {self._elided_bytes}",
+            "# HELP firmup_last_upload_bytes_per_second Throughput of the last upload.",
+            "# TYPE firmup_last_upload_bytes_per_second gauge",
+            f"firmup_last_upload_bytes_per_second {self._last_rate:.1f}",
+            "# HELP firmup_upload_retries_total Failed upload attempts retried on the open port.",
+            "# TYPE firmup_upload_retries_total counter",
+            f"firmup_upload_retries_total {self._retries}",
+            "# HELP firmup_recovery_seconds_total Time spent re-syncing after failed attempts.",
+            "# TYPE firmup_recovery_seconds_total counter",
+            f"firmup_recovery_seconds_total {self._recovery_time:.6f}",
+        ]
+
+        # the collector may read at any time, so replace the file atomically
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as file:
+            file.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,133 @@
+"""
+The byte streams the bootloader protocol runs over.
+
+The protocol functions only need the part of serial.Serial described by
+Transport, so besides a local serial port they can drive a board whose serial
+port is served over TCP, by ser2net in raw mode or by a remote USB hub. Such a
+port is given to upload_firmware as a URL:
+
+    for progress in upload_firmware("tcp://flashing-rig.local:3001", "arducopter.apj"):
+        print(progress)
+
+The serial settings of a port served over TCP are those of the server, so
+boards behind it can't be rebooted into their bootloader over MAVLink and
+the baud rate isn't negotiated.
+"""
+from typing import Optional, Protocol
+import socket
+import time
+
+
+TCP_URL_PREFIX = "tcp://"
+
+# bytes asked from the socket per recv, replies are served from the buffer
+_RECV_SIZE = 64 * 1024
+
+
+class Transport(Protocol):
+    name: str
+    baudrate: int
+    # seconds a read waits for the requested bytes, None to wait forever
+    timeout: Optional[float]
+
+    def read(self, size: int = 1) -> bytes:
+        """ Read `size` bytes, or whatever arrived before the timeout. """
+
+    def write(self, data: bytes) -> Optional[int]:
+        ...
+
+    def flush(self) -> None:
+        """ Wait until everything written is sent. """
+
+    def reset_input_buffer(self) -> None:
+        """ Discard what was received but not read. """
+
+    def close(self) -> None:
+        ...
+
+
+def is_tcp_url(port: str) -> bool:
+    return port.startswith(TCP_URL_PREFIX)
+
+
+class SocketTransport:
+    """
+    A serial port served over TCP. Everything the socket has received is kept
+    in a buffer, so a reply is usually served from a single recv however many
+    reads it is parsed with.
+    """
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        baudrate: int = 115200,
+        timeout: Optional[float] = None,
+        connect_timeout: float = 5
+    ) -> None:
+        """ `baudrate` is only recorded, the server sets the baud rate of the port. """
+        self.name = f"{TCP_URL_PREFIX}{host}:{port}"
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self._buffer = bytearray()
+        self._socket = socket.create_connection((host, port), timeout=connect_timeout)
+        # commands are short, don't hold them back to coalesce them
+        self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    @classmethod
+    def from_url(cls, url: str, baudrate: int = 115200, timeout: Optional[float] = None) -> "SocketTransport":
+        """ Connect to "tcp://host:port". """
+        if not is_tcp_url(url):
+            raise ValueError(f"Expected a {TCP_URL_PREFIX}host:port URL, but got {url}")
+        host, _, port = url[len(TCP_URL_PREFIX):].rpartition(":")
+        if not host or not port.isdigit():
+            raise ValueError(f"Expected a {TCP_URL_PREFIX}host:port URL, but got {url}")
+        return cls(host.strip("[]"), int(port), baudrate, timeout)
+
+    def fileno(self) -> int:
+        return self._socket.fileno()
+
+    def _receive(self, timeout: Optional[float]) -> bool:
+        """ Add what the socket receives within `timeout` to the buffer, False if nothing came. """
+        self._socket.settimeout(timeout)
+        try:
+            data = self._socket.recv(_RECV_SIZE)
+        except (socket.timeout, BlockingIOError):
+            return False
+        if not data:
+            raise ConnectionError(f"{self.name} closed the connection")
+        self._buffer += data
+        return True
+
+    def read(self, size: int = 1) -> bytes:
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        while len(self._buffer) < size:
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            if not self._receive(remaining):
+                break
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def write(self, data: bytes) -> int:
+        self._socket.settimeout(None)
+        self._socket.sendall(data)
+        return len(data)
+
+    def flush(self) -> None:
+        # sendall has handed everything to the kernel
+        pass
+
+    def reset_input_buffer(self) -> None:
+        self._buffer.clear()
+        while self._receive(0):
+            self._buffer.clear()
+
+    def close(self) -> None:
+        self._socket.close()
+
+    def __enter__(self) -> "SocketTransport":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
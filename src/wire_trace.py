@@ -0,0 +1,242 @@
+"""
+Recording of the traffic with a bootloader, and replaying it as a fake device.
+
+With a `trace_path`, upload_firmware records every write to the bootloader and
+every reply read back, with monotonic timestamps, into a compact binary trace:
+
+    for progress in upload_firmware("COM3", "arducopter.apj", trace_path="flash.trace"):
+        print(progress)
+
+The trace starts with MAGIC, followed by one record per write or read: a
+direction byte (TX or RX), the nanoseconds since the recording started as
+an unsigned 64-bit integer, the length of the data as an unsigned 32-bit
+integer, all little-endian, and the data itself. The recording starts once a
+bootloader has answered the probe of upload_firmware, so the probes of a port
+while its board reboots aren't recorded, and a replay skips the probe.
+
+A "replay://<trace path>" port replays a trace as a fake device. Each reply is
+sent once the host has written what preceded it in the trace, after the delay
+the board took to send it, so a slow erase or stalled acks are reproduced
+offline. The written stream is checked against the trace, but not how it is
+split into writes, so uploads with another window can be replayed against the
+same recording. The baud rates the host switched to when it was recorded
+are the only ones a replay supports, so negotiate_baudrate goes the same way:
+
+    for progress in upload_firmware("replay://flash.trace", "arducopter.apj", window=8):
+        print(progress)
+
+    python src/wire_trace.py flash.trace
+"""
+from typing import BinaryIO, Generator, Optional
+from collections import deque
+import struct
+import time
+
+from transport import Transport
+
+
+MAGIC = b"FWTRACE\x01"
+REPLAY_URL_PREFIX = "replay://"
+
+TX = 0
+RX = 1
+
+_RECORD_HEADER = struct.Struct("<BQI")
+
+# SET_BAUD and END_OF_CMD of bootloader_protocol, which imports this module
+_SET_BAUD = b'\x33'
+_END_OF_CMD = b'\x20'
+
+
+def is_replay_url(port: str) -> bool:
+    return port.startswith(REPLAY_URL_PREFIX)
+
+
+def read_trace(path: str) -> Generator[tuple[int, int, bytes], None, None]:
+    """ Yield the (direction, nanoseconds, data) records of the trace at `path`. """
+    with open(path, "rb") as file:
+        if file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} isn't a bootloader trace")
+        while header := file.read(_RECORD_HEADER.size):
+            if len(header) < _RECORD_HEADER.size:
+                raise ValueError(f"{path} ends in the middle of a record")
+            direction, timestamp, length = _RECORD_HEADER.unpack(header)
+            data = file.read(length)
+            if len(data) < length:
+                raise ValueError(f"{path} ends in the middle of a record")
+            yield direction, timestamp, data
+
+
+def _set_baud_rates(path: str) -> Generator[int, None, None]:
+    """ The baud rates of the SET_BAUD commands written in the trace at `path`. """
+    for direction, _, data in read_trace(path):
+        if direction == TX and len(data) == 6 and data[:1] == _SET_BAUD and data[5:] == _END_OF_CMD:
+            yield struct.unpack("<I", data[1:5])[0]
+
+
+class RecordingTransport:
+    """ Passes everything through to `transport` and records it into the trace at `path`. """
+
+    def __init__(self, transport: Transport, path: str) -> None:
+        self.transport = transport
+        self.name = transport.name
+        self._file: BinaryIO = open(path, "wb")
+        self._file.write(MAGIC)
+        self._start = time.monotonic_ns()
+
+    @property
+    def baudrate(self) -> int:
+        return self.transport.baudrate
+
+    @baudrate.setter
+    def baudrate(self, baudrate: int) -> None:
+        self.transport.baudrate = baudrate
+
+    @property
+    def timeout(self) -> Optional[float]:
+        return self.transport.timeout
+
+    @timeout.setter
+    def timeout(self, timeout: Optional[float]) -> None:
+        self.transport.timeout = timeout
+
+    @property
+    def BAUDRATES(self) -> tuple[int, ...]:
+        return getattr(self.transport, "BAUDRATES", ())
+
+    def _record(self, direction: int, data: bytes) -> None:
+        self._file.write(_RECORD_HEADER.pack(direction, time.monotonic_ns() - self._start, len(data)))
+        self._file.write(data)
+
+    def read(self, size: int = 1) -> bytes:
+        data = self.transport.read(size)
+        if data:
+            self._record(RX, data)
+        return data
+
+    def write(self, data: bytes) -> Optional[int]:
+        self._record(TX, bytes(data))
+        return self.transport.write(data)
+
+    def flush(self) -> None:
+        self.transport.flush()
+
+    def reset_input_buffer(self) -> None:
+        self.transport.reset_input_buffer()
+
+    def close(self) -> None:
+        try:
+            self.transport.close()
+        finally:
+            self._file.close()
+
+
+class ReplayTransport:
+    """ A fake device that answers with the replies of a trace, see the module docstring. """
+
+    def __init__(self, path: str, baudrate: int = 115200, timeout: Optional[float] = None) -> None:
+        self.name = f"{REPLAY_URL_PREFIX}{path}"
+        self.baudrate = baudrate
+        self.timeout = timeout
+
+        # the written stream, and the replies as (bytes written before, delay in seconds, data)
+        expected = bytearray()
+        self._replies: deque[tuple[int, float, bytes]] = deque()
+        last_write = 0
+        for direction, timestamp, data in read_trace(path):
+            if direction == TX:
+                expected += data
+                last_write = timestamp
+            else:
+                self._replies.append((len(expected), (timestamp - last_write) / 1e9, data))
+        self._expected = bytes(expected)
+        self._written = 0
+        # the rates the host switched to when it was recorded, so _negotiate_baudrate tries the same ones
+        self.BAUDRATES = tuple(sorted(set(_set_baud_rates(path)) | {baudrate}))
+
+        # (due time, data) of the replies that are on their way, and the ones that arrived
+        self._pending: deque[tuple[float, bytes]] = deque()
+        self._buffer = bytearray()
+
+    @classmethod
+    def from_url(cls, url: str, baudrate: int = 115200, timeout: Optional[float] = None) -> "ReplayTransport":
+        """ Replay "replay://<trace path>". """
+        if not is_replay_url(url):
+            raise ValueError(f"Expected a {REPLAY_URL_PREFIX}<trace path> URL, but got {url}")
+        return cls(url[len(REPLAY_URL_PREFIX):], baudrate, timeout)
+
+    def _arrive(self) -> None:
+        now = time.monotonic()
+        while self._pending and self._pending[0][0] <= now:
+            self._buffer += self._pending.popleft()[1]
+
+    def write(self, data: bytes) -> int:
+        data = bytes(data)
+        expected = self._expected[self._written: self._written+len(data)]
+        if data != expected:
+            mismatch = next((i for i in range(len(expected)) if data[i] != expected[i]), len(expected))
+            raise RuntimeError(f"The host diverged from the trace at byte {self._written + mismatch:#x} written")
+        self._written += len(data)
+
+        now = time.monotonic()
+        while self._replies and self._replies[0][0] <= self._written:
+            _, delay, reply = self._replies.popleft()
+            # replies leave in order, however short their delay
+            due = max(now + delay, self._pending[-1][0] if self._pending else 0)
+            self._pending.append((due, reply))
+        return len(data)
+
+    def read(self, size: int = 1) -> bytes:
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        self._arrive()
+        while len(self._buffer) < size and self._pending:
+            wait = self._pending[0][0] - time.monotonic()
+            if deadline is not None:
+                wait = min(wait, deadline - time.monotonic())
+                if wait < 0:
+                    break
+            time.sleep(max(0.0, wait))
+            self._arrive()
+        if len(self._buffer) < size and not self._pending and deadline is not None:
+            # nothing more is coming, like a device that doesn't answer
+            time.sleep(max(0.0, deadline - time.monotonic()))
+
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def flush(self) -> None:
+        pass
+
+    def reset_input_buffer(self) -> None:
+        self._arrive()
+        self._buffer.clear()
+
+    def close(self) -> None:
+        pass
+
+
+def summarize_trace(path: str) -> dict[int, list[float]]:
+    """ The seconds from each command to the first reply after it, by command byte. """
+    latencies: dict[int, list[float]] = {}
+    command: Optional[tuple[int, int]] = None
+    for direction, timestamp, data in read_trace(path):
+        if direction == TX:
+            command = (data[0], timestamp)
+        elif command is not None:
+            latencies.setdefault(command[0], []).append((timestamp - command[1]) / 1e9)
+            command = None
+    return latencies
+
+
+if __name__ == "__main__":
+    import argparse
+    import statistics
+
+    parser = argparse.ArgumentParser(description="Summarize the reply latency of a bootloader trace by command.")
+    parser.add_argument("trace", help="trace recorded by upload_firmware(trace_path=...)")
+    args = parser.parse_args()
+
+    print(f"{'command':>7} {'count':>6} {'median ms':>9} {'max ms':>8}")
+    for command, seconds in sorted(summarize_trace(args.trace).items()):
+        print(f"{command:#7x} {len(seconds):>6} {statistics.median(seconds) * 1000:>9.2f} {max(seconds) * 1000:>8.2f}")
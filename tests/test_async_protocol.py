@@ -0,0 +1,196 @@
+from async_protocol import get_board_info_async, upload_firmware_async
+from bootloader_protocol import IN_SYNC, OK, INVALID
+from firmware import Firmware
+from crc import expected_crc32
+import async_protocol
+import bootloader_protocol as bp
+import asyncio
+import pytest
+import struct
+import random
+
+
+class FakeBootloader:
+    """ Just enough of the bootloader to run an upload. """
+
+    flash_size = 128 * 1024
+
+    def __init__(self):
+        self.name = "COM3"
+        self.baudrate = 115200
+        self.timeout = 2
+        self.flash = bytearray(b'\xff' * self.flash_size)
+        self.address = 0
+        self.replies = bytearray()
+        self.commands: list[bytes] = []
+        # command -> the whole reply to send instead of the usual one
+        self.answers: dict[bytes, bytes] = {}
+        self.closed = False
+
+    def reset_input_buffer(self):
+        self.replies.clear()
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def write(self, data: bytes):
+        data = bytes(data)
+        while data:
+            command = data[:1]
+            self.commands.append(command)
+            if command in self.answers:
+                self.replies += self.answers[command]
+                return
+            if command == bp.GET_SYNC:
+                reply, data = b'', data[2:]
+            elif command == bp.GET_DEVICE:
+                info = {1: 5, 2: 9, 3: 0, 4: self.flash_size}
+                reply, data = struct.pack("<I", info[data[1]]), data[3:]
+            elif command == bp.GET_SN:
+                reply, data = b'\x00\x00\x00\x01', data[6:]
+            elif command == bp.GET_CHIP_DES:
+                reply, data = struct.pack("<I", 10) + b'STM32F42,3', data[2:]
+            elif command == bp.CHIP_ERASE:
+                self.flash[:] = b'\xff' * self.flash_size
+                self.address = 0
+                reply, data = b'', data[2:]
+            elif command == bp.PROGRAM_MULTIPLE_BYTES:
+                length = data[1]
+                self.flash[self.address: self.address+length] = data[2: 2+length]
+                self.address += length
+                reply, data = b'', data[3+length:]
+            elif command == bp.GET_CRC:
+                reply, data = struct.pack("<I", expected_crc32(0, self.flash)), data[2:]
+            elif command == bp.REBOOT:
+                return
+            else:
+                self.replies += IN_SYNC + INVALID
+                return
+            self.replies += reply + IN_SYNC + OK
+
+    def read(self, size: int) -> bytes:
+        data = bytes(self.replies[:size])
+        del self.replies[:size]
+        return data
+
+
+@pytest.fixture
+def bootloader(monkeypatch):
+    bootloader = FakeBootloader()
+    monkeypatch.setattr(async_protocol, "_connect", lambda port, **kwargs: bootloader)
+    return bootloader
+
+
+def test_get_board_info_async(bootloader):
+    board_info = asyncio.run(get_board_info_async("COM3"))
+
+    assert board_info["Board ID"] == 9
+    assert board_info["Chip"] == "STM32F42 revision 3"
+    assert "px4_fmu-v2_default" in board_info["Select Board"]["px4"]
+    assert bootloader.closed
+
+
+def test_get_board_info_async_rejected_chip_description(bootloader):
+    bootloader.answers[bp.GET_CHIP_DES] = IN_SYNC + INVALID
+    with pytest.raises(RuntimeError):
+        asyncio.run(get_board_info_async("COM3", batched=False))
+    assert bootloader.closed
+
+
+def test_command_reports_truncated_reply(bootloader):
+    bootloader.answers[bp.GET_DEVICE] = struct.pack("<I", 9)
+
+    async def command():
+        aser = async_protocol.AsyncSerial(bootloader)
+        await async_protocol._command(aser, bp.GET_DEVICE + bp.INFO_BOARD_ID + bp.END_OF_CMD, 4, timeout=0.05)
+
+    with pytest.raises(RuntimeError, match="6 bytes"):
+        asyncio.run(command())
+
+
+def test_open_closes_port_when_sync_fails(bootloader):
+    bootloader.answers[bp.GET_SYNC] = IN_SYNC + INVALID
+    with pytest.raises(RuntimeError):
+        asyncio.run(get_board_info_async("COM3"))
+    assert bootloader.closed
+
+
+@pytest.mark.parametrize("window", [1, 16])
+def test_upload_firmware_async(bootloader, window: int):
+    image = random.Random(0).randbytes(40_000)
+    firmware = Firmware(board_id=9, image_size=len(image), image=image)
+
+    async def upload():
+        return [dict(progress) async for progress in upload_firmware_async("COM3", firmware, window)]
+
+    progress = asyncio.run(upload())
+
+    assert progress[-1]["Verifying Firmware"] == "Completed"
+    assert bootloader.flash[:len(image)] == image
+    assert bootloader.commands[-1] == bp.REBOOT
+
+
+def test_upload_firmware_async_runs_boards_concurrently(monkeypatch):
+    image = bytes(252 * 50)
+    firmware = Firmware(board_id=9, image_size=len(image), image=image)
+    boards = [FakeBootloader() for _ in range(20)]
+    monkeypatch.setattr(async_protocol, "_connect", lambda port, **kwargs: boards[int(port)])
+
+    async def upload(port: str) -> dict:
+        async for progress in upload_firmware_async(port, firmware, window=4):
+            await asyncio.sleep(0)
+        return progress
+
+    async def upload_all():
+        return await asyncio.gather(*(upload(str(i)) for i in range(20)))
+
+    results = asyncio.run(upload_all())
+    assert all(progress["Verifying Firmware"] == "Completed" for progress in results)
+
+
+def test_closing_upload_early_leaves_bootloader_in_sync(bootloader):
+    image = bytes(252 * 300)
+    firmware = Firmware(board_id=9, image_size=len(image), image=image)
+
+    async def upload_until(percent: str):
+        uploading = upload_firmware_async("COM3", firmware, window=8, progress_interval=0)
+        async for progress in uploading:
+            if progress["Uploading Firmware"] == percent:
+                break
+        await uploading.aclose()
+
+    asyncio.run(upload_until("33%"))
+
+    assert bootloader.commands[-1] == bp.GET_SYNC
+    assert bootloader.closed
+    assert not bootloader.replies
+
+
+def test_upload_firmware_async_retries_failed_chunk(bootloader):
+    image = random.Random(1).randbytes(20_000)
+    firmware = Firmware(board_id=9, image_size=len(image), image=image)
+    write = bootloader.write
+    failed = []
+
+    def write_failing_once(data: bytes):
+        if data[:1] == bp.PROGRAM_MULTIPLE_BYTES and bootloader.address == 252 * 10 and not failed:
+            failed.append(data)
+            bootloader.replies += IN_SYNC + INVALID
+            return
+        write(data)
+
+    bootloader.write = write_failing_once
+
+    async def upload():
+        return [dict(progress) async for progress in upload_firmware_async(
+            "COM3", firmware, window=4, retry_policy=bp.RetryPolicy(retries=1, delay=0))]
+
+    progress = asyncio.run(upload())
+
+    assert failed
+    assert progress[-1]["Verifying Firmware"] == "Completed"
+    assert progress[-1]["Retries"] == "1"
+    assert bootloader.flash[:len(image)] == image
@@ -0,0 +1,38 @@
+import batch_upload
+from firmware import Firmware
+import time
+
+
+def test_upload_firmware_batch(monkeypatch):
+    loaded = []
+
+    def fake_load_firmware(path):
+        loaded.append(path)
+        return Firmware(board_id=9, image_size=4, image=b'\x00' * 4, path=path)
+
+    def fake_upload_firmware(port, firmware, **options):
+        if port == "bad":
+            raise RuntimeError("no heartbeat")
+        yield {"Port": "/dev/" + port, "Erasing Chip": "in progress"}
+        time.sleep(0.2)
+        yield {"Port": "/dev/" + port, "Erasing Chip": "Completed"}
+
+    monkeypatch.setattr(batch_upload, "load_firmware", fake_load_firmware)
+    monkeypatch.setattr(batch_upload, "upload_firmware", fake_upload_firmware)
+
+    jobs = [(f"port{i}", "a.apj" if i % 2 else "b.apj") for i in range(6)] + [("bad", "a.apj")]
+    events = batch_upload.upload_firmware_batch(jobs, max_workers=8)
+
+    start = time.monotonic()
+    received = []
+    try:
+        while True:
+            received.append(next(events))
+    except StopIteration as stop:
+        results = stop.value
+
+    assert time.monotonic() - start < 1
+    assert sorted(loaded) == ["a.apj", "b.apj"]
+    assert all(event["Port"] in results for event in received)
+    assert isinstance(results.pop("bad"), RuntimeError)
+    assert all(error is None for error in results.values())
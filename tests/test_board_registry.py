@@ -0,0 +1,65 @@
+from board_registry import BoardRegistry
+from boards import match_boards_by_id, ap_board_id_mapping, px4_board_id_mapping
+import json
+
+
+def linear_match(desired_id: int) -> dict[str, list[str]]:
+    return {
+        "ardupilot": [name for name, id in ap_board_id_mapping.items() if id == desired_id],
+        "px4": [name for name, id in px4_board_id_mapping.items() if id == desired_id],
+    }
+
+
+def test_match_boards_by_id_matches_tables():
+    for board_id in set(ap_board_id_mapping.values()) | set(px4_board_id_mapping.values()) | {0, 424242}:
+        assert match_boards_by_id(board_id) == linear_match(board_id)
+
+
+def test_lookups():
+    registry = BoardRegistry()
+
+    assert registry.id_of("CubeOrange") == 140
+    assert registry.id_of("NoSuchBoard") is None
+    assert registry.match_prefix("cubeorangeplus") == [
+        "CubeOrangePlus", "CubeOrangePlus-bdshot", "CubeOrangePlus-SimOnHardWare"
+    ]
+    assert registry.match_prefix("zzz") == []
+    assert "KakuteH7" in registry.match_vendor("Holybro")
+    assert "holybro_kakuteh7_default" in registry.match_vendor("holybro")
+
+
+def test_manifests_are_merged_and_cached(tmp_path):
+    ardupilot_manifest = tmp_path / "manifest.json"
+    ardupilot_manifest.write_text(json.dumps({"firmware": [
+        {"platform": "NewBoard", "board_id": 5000, "manufacturer": "Acme"},
+        {"platform": "CubeOrange", "board_id": 141},
+    ]}))
+    plain_manifest = tmp_path / "px4.json"
+    plain_manifest.write_text(json.dumps({"px4": {"acme_new-board_default": 5000}}))
+
+    cache_path = str(tmp_path / "boards.cache")
+    registry = BoardRegistry([str(ardupilot_manifest)], cache_path=cache_path)
+    registry.add_manifest(str(plain_manifest))
+
+    expected = {"ardupilot": ["NewBoard"], "px4": ["acme_new-board_default"]}
+    assert registry.match_id(5000) == expected
+    assert "CubeOrange" in registry.match_id(141)["ardupilot"]
+    assert "CubeOrange" not in registry.match_id(140)["ardupilot"]
+    assert sorted(registry.match_vendor("acme")) == ["NewBoard", "acme_new-board_default"]
+    assert "CubeOrange" in registry.match_vendor("cubepilot")
+
+    cached = BoardRegistry([str(ardupilot_manifest), str(plain_manifest)], cache_path=cache_path)
+    cached._compile = None
+    assert cached.match_id(5000) == expected
+    assert cached.match_prefix("acme") == ["acme_new-board_default"]
+    assert cached.id_of("NewBoard") == 5000
+
+
+def test_unreadable_cache_is_rebuilt(tmp_path):
+    cache_path = tmp_path / "boards.cache"
+    cache_path.write_bytes(b"\x80\x05not json")
+
+    registry = BoardRegistry(cache_path=str(cache_path))
+
+    assert "CubeOrange" in registry.match_id(140)["ardupilot"]
+    assert json.loads(cache_path.read_text())["by_id"]["140"]["ardupilot"]
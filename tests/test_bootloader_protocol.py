@@ -0,0 +1,392 @@
+from bootloader_protocol import (
+    _negotiate_baudrate, _write_to_program_area, upload_firmware,
+    IN_SYNC, OK, INVALID, PROGRAM_MULTIPLE_BYTES, REBOOT, GET_SYNC, SET_BAUD
+)
+from firmware import Firmware
+import bootloader_protocol
+import pytest
+import subprocess
+import struct
+import time
+import sys
+import os
+
+
+class FakeSerial:
+    """ Answers every PROGRAM_MULTIPLE_BYTES command with IN_SYNC/OK, or with
+    IN_SYNC/INVALID for the chunk at `fail_at`. """
+
+    def __init__(self, fail_at: int = -1):
+        self.fail_at = fail_at
+        self.programmed = 0
+        self.consumed = 0
+        self.max_in_flight = 0
+        self.replies = bytearray()
+
+    def reset_input_buffer(self):
+        self.replies.clear()
+
+    def write(self, data: bytes):
+        assert data[:1] == PROGRAM_MULTIPLE_BYTES
+        status = INVALID if self.programmed == self.fail_at else OK
+        self.replies += IN_SYNC + status
+        self.programmed += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    def read(self, size: int) -> bytes:
+        data = bytes(self.replies[:size])
+        del self.replies[:size]
+        self.consumed += len(data)
+        return data
+
+    @property
+    def in_flight(self) -> int:
+        return self.programmed - self.consumed // 2
+
+
+@pytest.mark.parametrize("window", [1, 4, 32])
+def test_write_to_program_area_window(window: int):
+    ser = FakeSerial()
+    image = bytes(252 * 300)
+
+    progress = list(_write_to_program_area(ser, image, window))
+
+    assert progress[-1] == "100%"
+    assert ser.programmed == 300
+    assert ser.max_in_flight == window
+
+
+def test_write_to_program_area_stops_at_first_failure():
+    ser = FakeSerial(fail_at=10)
+
+    with pytest.raises(RuntimeError, match=f"offset {10 * 252:#x}"):
+        list(_write_to_program_area(ser, bytes(252 * 300), window=8))
+
+    # only the chunks that were already in flight were sent after the failure
+    assert ser.programmed == 18
+    assert ser.in_flight == 0
+
+
+def test_upload_firmware_skips_identical_firmware(monkeypatch):
+    firmware = Firmware(board_id=9, image_size=8, image=bytes(range(8)))
+    info = {bootloader_protocol.INFO_BL_REV: 5, bootloader_protocol.INFO_BOARD_ID: 9,
+            bootloader_protocol.INFO_FLASH_SIZE: 1024}
+
+    class Port:
+        name = "COM3"
+        written = b''
+
+        def write(self, data):
+            self.written += data
+
+        def close(self):
+            pass
+
+    def erase(ser):
+        raise AssertionError("identical firmware was erased")
+
+    ser = Port()
+    monkeypatch.setattr(bootloader_protocol, "_connect", lambda port, **kwargs: ser)
+    monkeypatch.setattr(bootloader_protocol, "_get_sync", lambda ser: None)
+    monkeypatch.setattr(bootloader_protocol, "_get_info", lambda ser, param: info[param])
+    monkeypatch.setattr(bootloader_protocol, "_get_crc", lambda ser: firmware.expected_crc32(1024))
+    monkeypatch.setattr(bootloader_protocol, "_erase_program_area", erase)
+
+    progress = list(upload_firmware("COM3", firmware, only_if_different=True))
+
+    assert progress == [{"Port": "COM3", "Erasing Chip": "Skipped",
+                         "Uploading Firmware": "Skipped", "Verifying Firmware": "Skipped"}]
+    assert ser.written.startswith(REBOOT)
+
+
+class FakeUart:
+    """ A bootloader on a UART whose replies are garbled above `max_baudrate`. """
+
+    BAUDRATES = (115200, 230400, 460800, 921600, 1000000, 1500000, 2000000)
+
+    def __init__(self, max_baudrate: int, supports_set_baud: bool = True):
+        self.max_baudrate = max_baudrate
+        self.supports_set_baud = supports_set_baud
+        self.baudrate = 115200
+        self.device_baudrate = 115200
+        self.next_baudrate = None
+        self.replies = bytearray()
+
+    def reset_input_buffer(self):
+        self.replies.clear()
+
+    def flush(self):
+        pass
+
+    def write(self, data: bytes):
+        # the bootloader switches once the reply to SET_BAUD is sent
+        if self.next_baudrate:
+            self.device_baudrate, self.next_baudrate = self.next_baudrate, None
+        if self.baudrate != self.device_baudrate:
+            return
+        if data[:1] == GET_SYNC:
+            self.replies += IN_SYNC + OK
+        elif data[:1] == SET_BAUD and self.supports_set_baud:
+            self.replies += IN_SYNC + OK
+            self.next_baudrate = struct.unpack("<I", data[1:5])[0]
+        else:
+            self.replies += IN_SYNC + INVALID
+
+    def read(self, size: int) -> bytes:
+        data = bytes(self.replies[:size])
+        del self.replies[:size]
+        if self.next_baudrate is None and self.device_baudrate > self.max_baudrate:
+            return b'\x00' * len(data)
+        return data
+
+
+@pytest.mark.parametrize("max_baudrate", [115200, 460800, 921600, 2000000])
+def test_negotiate_baudrate(monkeypatch, max_baudrate: int):
+    monkeypatch.setattr(bootloader_protocol.time, "sleep", lambda seconds: None)
+    ser = FakeUart(max_baudrate)
+
+    assert _negotiate_baudrate(ser) == max_baudrate
+    assert ser.baudrate == max_baudrate
+    ser.write(GET_SYNC)
+    assert ser.device_baudrate == max_baudrate
+
+
+def test_negotiate_baudrate_without_set_baud(monkeypatch):
+    monkeypatch.setattr(bootloader_protocol.time, "sleep", lambda seconds: None)
+    ser = FakeUart(2000000, supports_set_baud=False)
+
+    assert _negotiate_baudrate(ser) == 115200
+    assert ser.baudrate == 115200
+
+
+class Device:
+    def __init__(self, device: str, location: str = "1-1", vid: int = 0x26ac, serial_number: str = "0001"):
+        self.device = device
+        self.location = location
+        self.vid = vid
+        self.serial_number = serial_number
+
+
+class FakeBootloaderPort:
+    """ A port whose device answers GET_SYNC only once it is in `bootloaders`. """
+
+    bootloaders: set[str] = set()
+
+    def __init__(self, device: str, baudrate: int, timeout: float):
+        self.name = device
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.replies = b''
+
+    def reset_input_buffer(self):
+        self.replies = b''
+
+    def write(self, data: bytes):
+        if self.name in self.bootloaders:
+            self.replies = IN_SYNC + OK
+
+    def read(self, size: int) -> bytes:
+        data, self.replies = self.replies[:size], self.replies[size:]
+        return data
+
+    def close(self):
+        pass
+
+
+class FakeMavlink:
+    def __init__(self, on_reboot):
+        self.on_reboot = on_reboot
+        self.target_system = 0
+
+    def wait_heartbeat(self, timeout):
+        class Heartbeat:
+            def get_srcSystem(self):
+                return 1
+        return Heartbeat()
+
+    def reboot_autopilot(self, hold_in_bootloader):
+        self.on_reboot()
+
+    def close(self):
+        pass
+
+
+def test_connect_uses_running_bootloader(monkeypatch):
+    monkeypatch.setattr(bootloader_protocol, "comports", lambda: [Device("COM3")])
+    monkeypatch.setattr(bootloader_protocol, "Serial", FakeBootloaderPort)
+    monkeypatch.setattr(FakeBootloaderPort, "bootloaders", {"COM3"})
+    monkeypatch.setattr(bootloader_protocol, "_mavlink_connection", None)
+
+    timings = {}
+    ser = bootloader_protocol._connect("COM3", timings=timings)
+
+    assert ser.name == "COM3"
+    assert ser.timeout == 2
+    assert list(timings) == ["probe"]
+
+
+def test_connect_finds_reenumerated_bootloader(monkeypatch):
+    ports = [Device("COM3")]
+
+    def reboot():
+        # the board comes back under a new name on the same bus location
+        ports[:] = [Device("COM7")]
+        FakeBootloaderPort.bootloaders.add("COM7")
+
+    monkeypatch.setattr(bootloader_protocol, "comports", lambda: list(ports))
+    monkeypatch.setattr(bootloader_protocol, "Serial", FakeBootloaderPort)
+    monkeypatch.setattr(FakeBootloaderPort, "bootloaders", set())
+    monkeypatch.setattr(bootloader_protocol, "_mavlink_connection", lambda device: FakeMavlink(reboot))
+
+    timings = {}
+    ser = bootloader_protocol._connect("COM3", timings=timings)
+
+    assert ser.name == "COM7"
+    assert list(timings) == ["probe", "heartbeat", "reboot"]
+    assert timings["reboot"] < 1
+
+
+def test_find_device_needs_a_serial_number(monkeypatch):
+    # another board without a serial number, elsewhere on the bus
+    monkeypatch.setattr(bootloader_protocol, "comports", lambda: [Device("COM9", location="2-1", serial_number=None)])
+
+    hardware_id = bootloader_protocol._hardware_id(Device("COM3", serial_number=None))
+
+    assert hardware_id is None
+    assert bootloader_protocol._find_device("COM3", "1-1", hardware_id) is None
+
+
+class FakeInfoBootloader:
+    """ Answers the device info queries, optionally only the first command of each write. """
+
+    def __init__(self, back_to_back: bool = True):
+        self.back_to_back = back_to_back
+        self.writes = 0
+        self.replies = b''
+        self.timeout = 1
+
+    def reset_input_buffer(self):
+        self.replies = b''
+
+    def flush(self):
+        pass
+
+    def write(self, data: bytes):
+        self.writes += 1
+        info = {1: 5, 2: 140, 3: 0, 4: 2 * 1024 * 1024 - 128 * 1024}
+        while data:
+            command = data[:1]
+            if command == bootloader_protocol.GET_SYNC:
+                reply, data = b'', data[2:]
+            elif command == bootloader_protocol.GET_DEVICE:
+                reply, data = struct.pack("<I", info[data[1]]), data[3:]
+            elif command == bootloader_protocol.GET_SN:
+                reply, data = struct.pack("<I", 0x01020304 + data[1])[::-1], data[6:]
+            elif command == bootloader_protocol.GET_CHIP_DES:
+                reply, data = struct.pack("<I", 9) + b"STM32H7,V", data[2:]
+            self.answer(reply + IN_SYNC + OK)
+            if not self.back_to_back:
+                break
+
+    def answer(self, reply: bytes):
+        self.replies += reply
+
+    def read(self, size: int) -> bytes:
+        data, self.replies = self.replies[:size], self.replies[size:]
+        return data
+
+
+class SlowInfoBootloader(FakeInfoBootloader):
+    """ Answers each query `delay` seconds after the previous one. """
+
+    def __init__(self, delay: float):
+        super().__init__()
+        self.delay = delay
+        self.timeout = 0.05
+        self.pending: list[tuple[float, bytes]] = []
+
+    def answer(self, reply: bytes):
+        due = max([time.monotonic()] + [due for due, _ in self.pending[-1:]]) + self.delay
+        self.pending.append((due, reply))
+
+    def arrive(self):
+        while self.pending and self.pending[0][0] <= time.monotonic():
+            self.replies += self.pending.pop(0)[1]
+
+    def reset_input_buffer(self):
+        self.arrive()
+        super().reset_input_buffer()
+
+    def read(self, size: int) -> bytes:
+        deadline = time.monotonic() + self.timeout
+        self.arrive()
+        while len(self.replies) < size and time.monotonic() < deadline:
+            time.sleep(0.002)
+            self.arrive()
+        return super().read(size)
+
+
+@pytest.mark.parametrize("back_to_back", [True, False])
+def test_get_device_info(back_to_back: bool):
+    ser = FakeInfoBootloader(back_to_back)
+    info = bootloader_protocol._get_device_info(ser)
+
+    assert info == bootloader_protocol._get_device_info(FakeInfoBootloader(), batched=False)
+    assert info["Board ID"] == 140
+    assert info["Serial Number"] == "04030201080302010c030201"
+    assert info["Chip"] == "STM32H7 revision V"
+    # one write when batched, otherwise the batch, a resync and eight queries
+    assert ser.writes == (1 if back_to_back else 10)
+
+
+class TruncatedReplyPort:
+    """ Answers every command with `reply`, cut short by a timeout. """
+
+    def __init__(self, reply: bytes):
+        self.reply = reply
+        self.replies = b''
+        self.timeout = 0.1
+
+    def reset_input_buffer(self):
+        self.replies = b''
+
+    def write(self, data: bytes):
+        self.replies = self.reply
+
+    def read(self, size: int) -> bytes:
+        data, self.replies = self.replies[:size], self.replies[size:]
+        return data
+
+
+@pytest.mark.parametrize("reply", [b'', IN_SYNC, IN_SYNC + OK, struct.pack("<I", 9) + b"STM"])
+def test_get_chip_description_truncated_reply(reply: bytes):
+    with pytest.raises(RuntimeError):
+        bootloader_protocol._get_chip_description(TruncatedReplyPort(reply))
+
+
+@pytest.mark.parametrize("reply", [IN_SYNC, IN_SYNC + INVALID])
+def test_erase_program_area_truncated_reply(monkeypatch, reply: bytes):
+    monkeypatch.setattr(bootloader_protocol, "ERASE_TIMEOUT", 0.1)
+    ser = TruncatedReplyPort(reply)
+    with pytest.raises(RuntimeError):
+        bootloader_protocol._erase_program_area(ser)
+    assert ser.timeout == 0.1
+
+
+def test_get_device_info_waits_out_late_replies():
+    # the batched probe times out while the bootloader is still answering it
+    ser = SlowInfoBootloader(delay=0.03)
+    info = bootloader_protocol._get_device_info(ser)
+
+    assert info == bootloader_protocol._get_device_info(FakeInfoBootloader(), batched=False)
+
+
+def test_import_does_not_load_mavlink():
+    # pymavlink and port enumeration are only imported once they are needed
+    code = (
+        "import sys, bootloader_protocol, boards; "
+        "print([name for name in ('pymavlink', 'serial.tools.list_ports') if name in sys.modules])"
+    )
+    src = os.path.dirname(bootloader_protocol.__file__)
+    output = subprocess.run([sys.executable, "-c", code], cwd=src, capture_output=True, text=True, check=True)
+    assert output.stdout.strip() == "[]"
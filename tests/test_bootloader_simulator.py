@@ -0,0 +1,332 @@
+from bootloader_protocol import (
+    get_board_info, upload_firmware, BootloaderSession, RetryPolicy, VerificationError, CHIP_ERASE, REBOOT
+)
+from firmware import Firmware, load_firmware
+from crc import crc32
+from tests.test_firmware import write_apj
+from base64 import b64encode
+import bootloader_protocol
+import pytest
+import json
+import zlib
+import random
+import time
+import os
+
+if not hasattr(os, "openpty"):
+    pytest.skip("the bootloader simulator needs a pty", allow_module_level=True)
+
+from bootloader_simulator import BootloaderSimulator, Faults  # noqa: E402
+
+
+@pytest.fixture
+def firmware() -> Firmware:
+    image = random.Random(0).randbytes(100_000)
+    return Firmware(board_id=9, image_size=len(image), image=image)
+
+
+def test_get_board_info():
+    with BootloaderSimulator(board_id=140, chip_description="STM32H743,V") as simulator:
+        board_info = get_board_info(simulator.port)
+
+    assert board_info["Board ID"] == 140
+    assert board_info["Chip"] == "STM32H743 revision V"
+    assert "CubeOrange" in board_info["Select Board"]["ardupilot"]
+
+
+@pytest.mark.parametrize("window", [1, 8])
+def test_upload_firmware(firmware: Firmware, window: int):
+    with BootloaderSimulator(latency=0.0005) as simulator:
+        for progress in upload_firmware(simulator.port, firmware, window):
+            pass
+
+    assert progress["Verifying Firmware"] == "Completed"
+    assert simulator.flash[:len(firmware.image)] == firmware.image
+    assert simulator.rebooted
+
+
+def test_upload_firmware_skips_erased_tail():
+    image = random.Random(5).randbytes(30_001) + b'\xff' * 50_000
+    firmware = Firmware(board_id=9, image_size=len(image), image=image)
+    reported = []
+    with BootloaderSimulator() as simulator:
+        updates = list(upload_firmware(simulator.port, firmware, window=8, metrics_sink=reported.append))
+
+    [metrics] = reported
+    assert metrics.bytes_elided == 50_000
+    assert metrics.bytes_acked == metrics.image_bytes == 30_004
+    assert updates[-1]["Erased Tail Skipped"] == "50.0 kB"
+    assert updates[-1]["Verifying Firmware"] == "Completed"
+    assert simulator.flash[:len(image)] == image
+
+
+def test_upload_firmware_reports_failed_chunk(firmware: Firmware):
+    with BootloaderSimulator(faults=Faults(fail_chunk=20)) as simulator:
+        with pytest.raises(RuntimeError, match=f"offset {20 * 252:#x}"):
+            for progress in upload_firmware(simulator.port, firmware, window=8):
+                pass
+
+
+def test_upload_firmware_detects_corruption(firmware: Firmware):
+    with BootloaderSimulator(faults=Faults(corrupt_chunk=3)) as simulator:
+        with pytest.raises(Exception, match="Verification failed"):
+            for progress in upload_firmware(simulator.port, firmware):
+                pass
+
+
+def test_upload_firmware_reports_metrics(firmware: Firmware):
+    reported = []
+    with BootloaderSimulator(erase_time=0.05, program_time=0.002) as simulator:
+        updates = list(upload_firmware(simulator.port, firmware, progress_interval=0.1, metrics_sink=reported.append))
+
+    [metrics] = reported
+    assert metrics.result == "Completed"
+    assert set(metrics.phases) == {"connect", "sync", "load", "erase", "upload", "verify"}
+    assert metrics.phases["erase"] >= 0.05
+    assert metrics.bytes_acked == metrics.image_bytes == len(firmware.image)
+    assert metrics.ack_latency.count == (len(firmware.image) + 251) // 252
+    assert metrics.ack_latency.quantile(0.5) >= 0.002
+    # about 0.8 s of programming reported every 0.1 s, rather than every 100 chunks
+    assert len(updates) >= 6
+    assert "ETA" in updates[-1] and "Upload Speed" in updates[-1]
+
+
+def test_upload_firmware_reports_failure_metrics(firmware: Firmware):
+    reported = []
+    with BootloaderSimulator(faults=Faults(fail_erase=True)) as simulator:
+        with pytest.raises(RuntimeError):
+            for progress in upload_firmware(simulator.port, firmware, metrics_sink=reported.append):
+                pass
+
+    assert reported[0].result == "Failed"
+    assert "upload" not in reported[0].phases
+
+
+@pytest.mark.parametrize("faults", [
+    Faults(fail_chunk=20),
+    Faults(drop_chunk_reply=5),
+    Faults(corrupt_chunk=3),
+    Faults(fail_erase=True),
+], ids=["failed chunk", "dropped reply", "corrupted chunk", "failed erase"])
+def test_upload_firmware_recovers_on_open_port(firmware: Firmware, faults: Faults):
+    reported = []
+    with BootloaderSimulator(faults=faults) as simulator:
+        for progress in upload_firmware(simulator.port, firmware, window=8,
+                                        retry_policy=RetryPolicy(retries=1, delay=0),
+                                        metrics_sink=reported.append):
+            pass
+
+    assert progress["Verifying Firmware"] == "Completed"
+    assert progress["Retries"] == "1"
+    assert simulator.flash[:len(firmware.image)] == firmware.image
+    assert reported[0].retries == 1 and reported[0].recovery_time > 0
+    # the board was never rebooted in between
+    assert simulator.commands.count(REBOOT) == 1
+
+
+class EraseAlwaysFails(Faults):
+    @property
+    def fail_erase(self) -> bool:
+        return True
+
+    @fail_erase.setter
+    def fail_erase(self, value: bool) -> None:
+        pass
+
+
+def test_upload_firmware_gives_up_after_retries(firmware: Firmware):
+    with BootloaderSimulator(faults=EraseAlwaysFails()) as simulator:
+        with pytest.raises(RuntimeError, match="operation failed"):
+            for progress in upload_firmware(simulator.port, firmware, retry_policy=RetryPolicy(retries=2, delay=0)):
+                pass
+
+    assert simulator.commands.count(CHIP_ERASE) == 3
+
+
+def test_upload_firmware_prepares_image_during_erase(tmp_path, monkeypatch):
+    image = random.Random(5).randbytes(50_000)
+    path = write_apj(tmp_path / "fw.apj", image)
+    load_firmware = bootloader_protocol.load_firmware
+
+    def slow_load_firmware(path: str) -> Firmware:
+        time.sleep(0.5)
+        return load_firmware(path)
+
+    monkeypatch.setattr(bootloader_protocol, "load_firmware", slow_load_firmware)
+    with BootloaderSimulator(erase_time=0.5) as simulator:
+        start = time.monotonic()
+        for progress in upload_firmware(simulator.port, path, window=8):
+            pass
+        elapsed = time.monotonic() - start
+
+    assert progress["Verifying Firmware"] == "Completed"
+    assert simulator.flash[:len(image)] == image
+    # one second if decoding and erasing ran one after the other
+    assert elapsed < 0.85
+
+
+def test_upload_firmware_checks_board_before_decoding(tmp_path, monkeypatch):
+    path = write_apj(tmp_path / "fw.apj", bytes(1000), board_id=50)
+    monkeypatch.setattr(bootloader_protocol, "load_firmware", None)
+
+    with BootloaderSimulator(board_id=9) as simulator:
+        with pytest.raises(RuntimeError, match="not suitable"):
+            for progress in upload_firmware(simulator.port, path):
+                pass
+
+    assert CHIP_ERASE not in simulator.commands
+
+
+def test_upload_firmware_rejects_undecodable_image_before_erasing(tmp_path):
+    path = tmp_path / "fw.apj"
+    path.write_text(json.dumps({"board_id": 9, "image_size": 1000, "image": b64encode(bytes(1000)).decode()}))
+
+    with BootloaderSimulator(board_id=9) as simulator:
+        with pytest.raises(ValueError, match="isn't zlib compressed"):
+            for progress in upload_firmware(simulator.port, str(path)):
+                pass
+
+    assert CHIP_ERASE not in simulator.commands
+
+
+def test_upload_firmware_does_not_retry_decoding(tmp_path):
+    compressed = bytearray(zlib.compress(random.Random(6).randbytes(20_000)))
+    compressed[100:110] = bytes(10)
+    path = tmp_path / "fw.apj"
+    path.write_text(json.dumps({"board_id": 9, "image_size": 20_000, "image": b64encode(compressed).decode()}))
+
+    with BootloaderSimulator(board_id=9) as simulator:
+        with pytest.raises(zlib.error):
+            for progress in upload_firmware(simulator.port, str(path), retry_policy=RetryPolicy(retry_on=(Exception,))):
+                pass
+
+    assert simulator.commands.count(CHIP_ERASE) == 1
+
+
+@pytest.fixture
+def opened(monkeypatch) -> list:
+    """ The ports opened by _connect. """
+    opened = []
+    connect = bootloader_protocol._connect
+
+    def recording_connect(*args, **kwargs):
+        opened.append(connect(*args, **kwargs))
+        return opened[-1]
+
+    monkeypatch.setattr(bootloader_protocol, "_connect", recording_connect)
+    return opened
+
+
+def test_session_identifies_and_flashes_on_one_connection(firmware: Firmware, opened: list):
+    with BootloaderSimulator(board_id=9) as simulator:
+        with BootloaderSession(simulator.port) as session:
+            assert session.board_info()["Board ID"] == 9
+            session.check_compatibility(firmware)
+            for progress in session.upload(firmware, window=8, reboot=False):
+                pass
+            session.verify(firmware)
+            session.reboot()
+            with pytest.raises(RuntimeError, match="isn't open"):
+                session.read_crc()
+
+    assert progress["Verifying Firmware"] == "Completed"
+    assert simulator.rebooted
+    assert len(opened) == 1 and not opened[0].is_open
+
+
+def test_session_verify_detects_other_firmware(firmware: Firmware):
+    with BootloaderSimulator() as simulator:
+        with BootloaderSession(simulator.port) as session:
+            with pytest.raises(VerificationError):
+                session.verify(firmware)
+
+
+def test_get_board_info_and_upload_close_the_port(firmware: Firmware, opened: list):
+    with BootloaderSimulator() as simulator:
+        get_board_info(simulator.port)
+        with pytest.raises(RuntimeError):
+            for progress in upload_firmware(simulator.port, Firmware(board_id=1, image_size=4, image=bytes(4))):
+                pass
+
+    assert len(opened) == 2
+    assert not any(ser.is_open for ser in opened)
+
+
+def test_upload_raw_image(tmp_path):
+    image = random.Random(9).randbytes(30_001)
+    path = tmp_path / "fw.bin"
+    path.write_bytes(image)
+
+    with BootloaderSimulator(board_id=9) as simulator:
+        with pytest.raises(RuntimeError, match="board id"):
+            for progress in upload_firmware(simulator.port, str(path)):
+                pass
+        for progress in upload_firmware(simulator.port, load_firmware(str(path), board_id=9), window=8):
+            pass
+
+    assert progress["Verifying Firmware"] == "Completed"
+    assert simulator.flash[:len(image) + 3] == image + b'\xff' * 3
+
+
+def test_upload_backs_up_the_old_firmware(firmware: Firmware, tmp_path):
+    old_firmware = random.Random(10).randbytes(70_000)
+    backup_path = tmp_path / "backup.bin"
+
+    with BootloaderSimulator(flash_size=256 * 1024) as simulator:
+        simulator.flash[:len(old_firmware)] = old_firmware
+        for progress in upload_firmware(simulator.port, firmware, window=8, backup_path=str(backup_path)):
+            pass
+
+    assert progress["Backup"] == str(backup_path)
+    assert backup_path.read_bytes() == old_firmware + b'\xff' * (256 * 1024 - len(old_firmware))
+    assert simulator.flash[:len(firmware.image)] == firmware.image
+
+
+def test_upload_only_backs_up_before_erasing(firmware: Firmware, tmp_path):
+    backup_path = tmp_path / "backup.bin"
+
+    with BootloaderSimulator(flash_size=256 * 1024) as simulator:
+        simulator.flash[:len(firmware.image)] = firmware.image
+        for progress in upload_firmware(simulator.port, firmware, only_if_different=True, backup_path=str(backup_path)):
+            pass
+        # an identical firmware isn't backed up
+        assert progress["Uploading Firmware"] == "Skipped"
+        assert not backup_path.exists()
+
+
+
+def test_read_flash_starts_at_the_start_of_the_flash(firmware: Firmware, tmp_path):
+    old_firmware = random.Random(11).randbytes(4096)
+    backup_path = tmp_path / "backup.bin"
+
+    with BootloaderSimulator(flash_size=256 * 1024) as simulator:
+        simulator.flash[:len(old_firmware)] = old_firmware
+        with BootloaderSession(simulator.port) as session:
+            assert session.read_flash(1024) == old_firmware[:1024]
+            # every read starts over, however far the previous one got
+            for progress in session.upload(firmware, backup_path=str(backup_path), reboot=False):
+                pass
+            assert backup_path.read_bytes()[:len(old_firmware)] == old_firmware
+            # the first word is only programmed on reboot, but compares equal
+            assert session.read_flash(4) == b'\xff' * 4
+            assert session.compare_flash(firmware.image) is None
+
+
+@pytest.mark.parametrize("window", [1, 8])
+def test_compare_flash_finds_first_mismatch(firmware: Firmware, window: int):
+    with BootloaderSimulator(flash_size=256 * 1024) as simulator:
+        simulator.flash[:len(firmware.image)] = firmware.image
+        simulator.flash[12345] ^= 0x40
+        simulator.flash[54321] ^= 0x40
+        with BootloaderSession(simulator.port) as session:
+            assert session.compare_flash(firmware.image, window) == 12345
+            # the reads that were in flight were drained
+            assert session.read_crc() == crc32(simulator.flash)
+
+
+def test_read_flash_reports_rejected_read():
+    with BootloaderSimulator(flash_size=1024) as simulator:
+        with BootloaderSession(simulator.port) as session:
+            with pytest.raises(RuntimeError, match=f"offset {4 * 252:#x}"):
+                session.read_flash(2048, window=4)
+            session.read_crc()
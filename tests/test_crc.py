@@ -0,0 +1,47 @@
+from crc import Crc32, crc32, expected_crc32
+import pytest
+import random
+import zlib
+
+
+def reference_crc32(flash_size: int, image: bytes) -> int:
+    """ The byte-at-a-time loop the bootloader protocol used before. """
+    table = []
+    for n in range(256):
+        c = n
+        for _ in range(8):
+            c = (c >> 1) ^ 0xEDB88320 if c & 1 else c >> 1
+        table.append(c)
+
+    crc_value = 0
+    for byte in image:
+        crc_value = table[(crc_value ^ byte) & 0xff] ^ (crc_value >> 8)
+    for _ in range(len(image), (flash_size - 1), 4):
+        for byte in b'\xff\xff\xff\xff':
+            crc_value = table[(crc_value ^ byte) & 0xff] ^ (crc_value >> 8)
+    return crc_value
+
+
+@pytest.mark.parametrize("image_size, flash_size", [
+    (0, 0), (0, 64), (16, 16), (16, 17), (16, 18), (20, 1000), (1000, 20), (1024, 65536), (4093, 16384),
+])
+def test_expected_crc32_matches_reference(image_size: int, flash_size: int):
+    image = random.Random(image_size).randbytes(image_size)
+    assert expected_crc32(flash_size, image) == reference_crc32(flash_size, image)
+
+
+def test_crc32_is_unconditioned_zlib_crc():
+    data = b'123456789'
+    assert crc32(data) == zlib.crc32(data, 0xFFFFFFFF) ^ 0xFFFFFFFF
+    assert crc32(data[4:], crc32(data[:4])) == crc32(data)
+
+
+def test_incremental_crc32():
+    image = random.Random(0).randbytes(10_000)
+    crc = Crc32()
+    for offset in range(0, len(image), 252):
+        crc.update(memoryview(image)[offset: offset+252])
+
+    assert crc.length == len(image)
+    assert crc.pad(2 * 1024 * 1024) == expected_crc32(2 * 1024 * 1024, image)
+    assert crc.pad(256 * 1024) == reference_crc32(256 * 1024, image)
@@ -0,0 +1,151 @@
+from firmware import erased_tail, iter_chunks, load_firmware, read_firmware_metadata
+from base64 import b64encode
+from mmap import mmap
+import pytest
+import random
+import json
+import zlib
+
+
+def write_apj(path, image: bytes, escape_slashes: bool = False, **fields) -> str:
+    document = json.dumps({
+        "board_id": 9,
+        "image_size": len(image),
+        "summary": "PX4FMUv2",
+        **fields,
+        "image": b64encode(zlib.compress(image)).decode()
+    })
+    if escape_slashes:
+        document = document.replace("/", "\\/")
+    with open(path, "w") as file:
+        file.write(document)
+    return str(path)
+
+
+def test_load_firmware_pads_with_erased_bytes(tmp_path):
+    image = random.Random(1).randbytes(300_001)
+    firmware = load_firmware(write_apj(tmp_path / "fw.apj", image))
+
+    assert firmware.board_id == 9
+    assert firmware.image_size == len(image)
+    assert firmware.image == image + b'\xff\xff\xff'
+
+
+def test_load_firmware_with_escaped_image(tmp_path):
+    image = random.Random(2).randbytes(100_000)
+    firmware = load_firmware(write_apj(tmp_path / "fw.apj", image, escape_slashes=True))
+    assert firmware.image == image
+
+
+def test_load_firmware_with_wrong_image_size(tmp_path):
+    image = random.Random(3).randbytes(1001)
+    firmware = load_firmware(write_apj(tmp_path / "fw.apj", image, image_size=4000))
+    assert firmware.image == image + b'\xff\xff\xff'
+
+
+def test_iter_chunks_does_not_copy():
+    image = bytearray(range(256)) * 4
+    chunks = list(iter_chunks(image, 252))
+
+    assert [offset for offset, _ in chunks] == [0, 252, 504, 756, 1008]
+    assert b''.join(chunks[i][1] for i in range(len(chunks))) == image
+    assert all(chunk.obj is image for _, chunk in chunks)
+
+
+@pytest.mark.parametrize("image, tail", [
+    (b'', 0),
+    (b'\x01\x02\x03\x04', 0),
+    (b'\x01\x02\x03\x04' + b'\xff' * 10_000, 10_000),
+    # the last programmed word keeps its erased bytes
+    (b'\x01\x02' + b'\xff' * 10, 8),
+    (b'\xff' * 9000, 9000),
+])
+def test_erased_tail(image, tail):
+    assert erased_tail(image) == tail
+
+
+def test_read_firmware_metadata_checks_compression(tmp_path):
+    path = tmp_path / "fw.apj"
+    path.write_text(json.dumps({"board_id": 9, "image_size": 8, "image": b64encode(bytes(8)).decode()}))
+    with pytest.raises(ValueError, match="isn't zlib compressed"):
+        read_firmware_metadata(str(path))
+
+
+def test_read_firmware_metadata_skips_image(tmp_path):
+    path = write_apj(tmp_path / "fw.apj", random.Random(4).randbytes(5000), git_identity="a1b2c3d")
+    metadata = read_firmware_metadata(path)
+
+    assert metadata == {"board_id": 9, "image_size": 5000, "summary": "PX4FMUv2", "git_identity": "a1b2c3d"}
+
+
+def write_hex(path, records: list[tuple[int, bytes]]) -> str:
+    lines = []
+    upper = None
+    for address, data in records:
+        for start in range(0, len(data), 16):
+            if (address + start) >> 16 != upper:
+                upper = (address + start) >> 16
+                lines.append(bytes([2, 0, 0, 4]) + upper.to_bytes(2, "big"))
+            chunk = data[start: start+16]
+            lines.append(bytes([len(chunk)]) + ((address + start) & 0xFFFF).to_bytes(2, "big") + b'\x00' + chunk)
+    lines.append(bytes([0, 0, 0, 1]))
+    with open(path, "w") as file:
+        for record in lines:
+            file.write(":" + (record + bytes([-sum(record) & 0xFF])).hex().upper() + "\n")
+    return str(path)
+
+
+def test_load_bin_maps_the_file(tmp_path):
+    image = random.Random(5).randbytes(4096)
+    path = tmp_path / "fw.bin"
+    path.write_bytes(image)
+
+    firmware = load_firmware(str(path), board_id=140)
+
+    assert (firmware.board_id, firmware.image_size) == (140, 4096)
+    assert isinstance(firmware.image, mmap)
+    assert firmware.image[:] == image
+    assert read_firmware_metadata(str(path)) == {"image_size": 4096}
+    with pytest.raises(ValueError, match="board id"):
+        load_firmware(str(path))
+
+
+def test_load_hex_fills_gaps_and_pads(tmp_path):
+    first = random.Random(6).randbytes(0x10010)
+    second = random.Random(7).randbytes(5)
+    # the first record crosses a 64K boundary, the second one leaves a gap
+    path = write_hex(tmp_path / "fw.hex", [(0x0800_8000, first), (0x0801_8020, second)])
+
+    firmware = load_firmware(path, board_id=9)
+
+    expected = first + b'\xff' * (0x0801_8020 - 0x0800_8000 - len(first)) + second
+    assert firmware.image_size == len(expected)
+    assert firmware.image == expected + b'\xff' * (-len(expected) % 4)
+    assert read_firmware_metadata(path) == {"image_size": len(expected)}
+
+
+def test_load_hex_rejects_sparse_records(tmp_path):
+    # option bytes far above the image would otherwise be filled in with 0xFF
+    path = write_hex(tmp_path / "fw.hex", [(0x0800_0000, b'\x00' * 16), (0x1FFF_7800, b'\xaa' * 4)])
+    with pytest.raises(ValueError, match="0x1fff7804"):
+        load_firmware(path, board_id=9)
+    with pytest.raises(ValueError, match="0x1fff7804"):
+        read_firmware_metadata(path)
+
+
+def test_load_hex_rejects_bad_checksum(tmp_path):
+    path = tmp_path / "fw.hex"
+    path.write_text(":0400000001020304F1\n:00000001FF\n")
+    with pytest.raises(ValueError, match="line 1"):
+        load_firmware(str(path), board_id=9)
+
+
+def test_load_px4_container(tmp_path):
+    image = random.Random(8).randbytes(2000)
+    firmware = load_firmware(write_apj(tmp_path / "fw.px4", image, board_id=50))
+    assert (firmware.board_id, firmware.image) == (50, image)
+
+
+def test_unknown_format(tmp_path):
+    with pytest.raises(ValueError, match="Unknown firmware format"):
+        load_firmware(str(tmp_path / "fw.elf"))
@@ -0,0 +1,57 @@
+from firmware_library import FirmwareLibrary
+from tests.test_firmware import write_apj
+import firmware_library
+import random
+import json
+import os
+
+
+def write_firmware(directory, name: str, board_id: int, image_size: int = 1000, **fields) -> str:
+    image = random.Random(name).randbytes(image_size)
+    return write_apj(directory / name, image, board_id=board_id, **fields)
+
+
+def test_best_firmware(tmp_path):
+    write_firmware(tmp_path, "copter-4.4.apj", 140, version="4.4.4", git_identity="aaaaaaa")
+    newest = write_firmware(tmp_path, "copter-4.5.apj", 140, version="4.5.1", git_identity="bbbbbbb")
+    write_firmware(tmp_path, "copter-4.10.apj", 140, image_size=5000, version="4.10.0-beta")
+    write_firmware(tmp_path, "fmu-v2.apj", 9, version="1.14.0")
+    (tmp_path / "notes.txt").write_text("not firmware")
+    (tmp_path / "broken.apj").write_text("{}")
+
+    library = FirmwareLibrary(str(tmp_path))
+
+    # 4.10 is the newest but doesn't fit
+    entry = library.best(140, flash_size=4096)
+    assert entry.path == newest
+    assert (entry.version, entry.git_hash, entry.image_size) == ("4.5.1", "bbbbbbb", 1000)
+    assert library.best(140).version == "4.10.0-beta"
+    assert library.best(140, flash_size=100) is None
+    assert library.best(424242) is None
+    assert [entry.version for entry in library.entries(140)] == ["4.10.0-beta", "4.5.1", "4.4.4"]
+    assert library.unreadable() == [str(tmp_path / "broken.apj")]
+
+
+def test_index_is_reused_until_files_change(tmp_path, monkeypatch):
+    write_firmware(tmp_path, "a.apj", 140, version="4.4.0")
+    path = write_firmware(tmp_path, "b.apj", 140, version="4.5.0")
+    FirmwareLibrary(str(tmp_path)).refresh()
+
+    read = []
+    read_firmware_metadata = firmware_library.read_firmware_metadata
+    monkeypatch.setattr(firmware_library, "read_firmware_metadata", lambda path: read.append(path) or read_firmware_metadata(path))
+
+    library = FirmwareLibrary(str(tmp_path))
+    assert library.best(140).version == "4.5.0"
+    assert read == []
+
+    # a changed file is read again, a removed one is dropped
+    write_firmware(tmp_path, "b.apj", 140, version="4.3.0", build_time=1)
+    os.utime(path, ns=(1, 1))
+    os.remove(tmp_path / "a.apj")
+    library.refresh()
+    assert read == [path]
+    assert [entry.version for entry in library.entries()] == ["4.3.0"]
+
+    with open(tmp_path / ".firmware_index.json") as file:
+        assert list(json.load(file)["files"]) == ["b.apj"]
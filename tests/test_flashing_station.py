@@ -0,0 +1,59 @@
+from flashing_station import FlashingStation
+from tests.test_firmware import write_apj
+import flashing_station
+import pytest
+
+
+class Device:
+    def __init__(self, device: str, serial_number: str, vid: int = 0x26ac):
+        self.device = device
+        self.serial_number = serial_number
+        self.vid = vid
+
+
+def test_select_firmware(tmp_path):
+    image = bytes(1000)
+    write_apj(tmp_path / "CubeOrange.apj", image, board_id=140, version="4.4.0")
+    write_apj(tmp_path / "arducopter_CubeOrange.apj", image, board_id=140, version="4.5.1")
+    write_apj(tmp_path / "CubeOrangePlus.apj", image, board_id=1063)
+    write_apj(tmp_path / "too_large.apj", image, board_id=1063, image_size=4096, version="9.9")
+    # named after a board, but its metadata can't be read
+    (tmp_path / "CubeYellow.apj").write_text("{}")
+
+    station = FlashingStation(str(tmp_path))
+
+    assert station._select_firmware(140) == str(tmp_path / "arducopter_CubeOrange.apj")
+    assert station._select_firmware(1063, flash_size=2048) == str(tmp_path / "CubeOrangePlus.apj")
+    assert station._select_firmware(120) is None
+    assert station._select_firmware(424242) is None
+
+
+def test_upload_options_are_checked(tmp_path):
+    FlashingStation(str(tmp_path), negotiate_baudrate=True, window=8, only_if_different=True)
+    with pytest.raises(TypeError, match="trace_path"):
+        FlashingStation(str(tmp_path), window=8, trace_path="flash.trace")
+
+
+def test_poll_reports_each_board_once(monkeypatch):
+    ports = [Device("/dev/ttyACM0", "A"), Device("/dev/ttyS0", None, vid=None)]
+    monkeypatch.setattr(flashing_station, "comports", lambda: list(ports))
+    clock = [0.0]
+    monkeypatch.setattr(flashing_station.time, "monotonic", lambda: clock[0])
+
+    station = FlashingStation(".", forget_after=5)
+
+    assert station._poll() == ([("/dev/ttyACM0", "9900:A")], [])
+    station._busy.clear()
+
+    # a reboot shorter than forget_after doesn't count as a new board
+    ports[0] = Device("/dev/ttyACM1", "B")
+    clock[0] = 3
+    assert station._poll() == ([("/dev/ttyACM1", "9900:B")], [])
+    ports.append(Device("/dev/ttyACM0", "A"))
+    clock[0] = 4
+    assert station._poll() == ([], [])
+
+    # a busy board is never forgotten
+    ports[:] = []
+    clock[0] = 20
+    assert station._poll() == ([], ["9900:A"])
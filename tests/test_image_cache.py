@@ -0,0 +1,69 @@
+from image_cache import ImageCache
+from firmware import load_firmware
+from base64 import b64encode
+from mmap import mmap
+import hashlib
+import pytest
+import random
+import json
+import zlib
+import os
+
+
+def write_apj(path, image: bytes, board_id: int = 9) -> str:
+    with open(path, "w") as file:
+        json.dump({
+            "board_id": board_id,
+            "image_size": len(image),
+            "image": b64encode(zlib.compress(image)).decode()
+        }, file)
+    return str(path)
+
+
+def test_cache_hit_is_memory_mapped(tmp_path):
+    image = random.Random(0).randbytes(4096)
+    path = write_apj(tmp_path / "fw.apj", image)
+
+    first = ImageCache(str(tmp_path / "cache")).load(path)
+    assert bytes(first.image) == load_firmware(path).image
+    ImageCache(str(tmp_path / "cache")).store_crc(first, 1024 * 1024)
+
+    second = ImageCache(str(tmp_path / "cache")).load(path)
+    assert isinstance(second.image, mmap)
+    assert second.image[:] == first.image
+    assert second.digest == first.digest
+    assert first.digest == hashlib.sha256(open(path, "rb").read()).hexdigest()
+    assert second.crcs == {1024 * 1024: load_firmware(path).expected_crc32(1024 * 1024)}
+
+
+def test_changed_file_is_reloaded(tmp_path):
+    cache = ImageCache(str(tmp_path / "cache"))
+    path = write_apj(tmp_path / "fw.apj", b'\x01' * 64)
+    assert cache.load(path).image[:] == b'\x01' * 64
+
+    write_apj(tmp_path / "fw.apj", b'\x02' * 128, board_id=50)
+    os.utime(path, ns=(0, 0))
+    firmware = cache.load(path)
+    assert firmware.image[:] == b'\x02' * 128
+    assert firmware.board_id == 50
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    cache = ImageCache(str(tmp_path / "cache"), max_size=3000)
+    paths = [write_apj(tmp_path / f"fw{i}.apj", bytes([i]) * 1000) for i in range(4)]
+
+    digests = []
+    for i, path in enumerate(paths):
+        digests.append(cache.load(path).digest)
+        os.utime(os.path.join(cache.directory, digests[-1] + ".img"), ns=(i, i))
+
+    images = {name[:-4] for name in os.listdir(cache.directory) if name.endswith(".img")}
+    assert images == set(digests[1:])
+
+
+@pytest.mark.parametrize("name", ["fw.bin", "fw.hex", "fw.elf"])
+def test_only_firmware_containers_are_cached(tmp_path, name: str):
+    path = tmp_path / name
+    path.write_bytes(b'\x00' * 64)
+    with pytest.raises(ValueError, match=name):
+        ImageCache(str(tmp_path / "cache")).load(str(path))
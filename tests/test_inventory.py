@@ -0,0 +1,89 @@
+from types import SimpleNamespace
+import inventory
+import pytest
+import time
+import os
+
+if not hasattr(os, "openpty"):
+    pytest.skip("the bootloader simulator needs a pty", allow_module_level=True)
+
+from bootloader_simulator import BootloaderSimulator  # noqa: E402
+from inventory import format_inventory, scan_inventory  # noqa: E402
+
+
+class FakeMavlink:
+    """ An autopilot that sends a heartbeat and answers AUTOPILOT_VERSION, if it has a `board_id`. """
+
+    def __init__(self, board_id):
+        self.board_id = board_id
+        self.mav = SimpleNamespace(command_long_send=lambda *args: None)
+
+    def wait_heartbeat(self, timeout):
+        if self.board_id is None:
+            time.sleep(timeout)
+            return None
+        return SimpleNamespace(get_srcSystem=lambda: 1, get_srcComponent=lambda: 1)
+
+    def recv_match(self, type, blocking, timeout):
+        return SimpleNamespace(board_version=self.board_id << 16 | 3)
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def silent_ports():
+    """ Two ptys that nothing answers on, for the autopilots. """
+    fds = [os.openpty() for _ in range(2)]
+    yield [os.ttyname(slave) for _, slave in fds]
+    for master, slave in fds:
+        os.close(master)
+        os.close(slave)
+
+
+def test_scan_inventory_probes_all_ports_at_once(monkeypatch, silent_ports):
+    autopilot, silent = silent_ports
+    boards = {autopilot: 1063, silent: None}
+    monkeypatch.setattr(inventory, "_mavlink_connection", lambda device: FakeMavlink(boards[device]))
+
+    with BootloaderSimulator(board_id=140) as cube_orange, BootloaderSimulator(board_id=9) as cube_black:
+        start = time.monotonic()
+        rows = scan_inventory([autopilot, silent, cube_orange.port, cube_black.port], heartbeat_timeout=0.5)
+        elapsed = time.monotonic() - start
+
+    by_port = {row["Port"]: row for row in rows}
+    assert [row["Port"] for row in rows] == sorted(by_port)
+    assert by_port[cube_orange.port]["State"] == "Bootloader"
+    assert by_port[cube_orange.port]["Flash Size"] == cube_orange.flash_size
+    assert "CubeOrange" in by_port[cube_orange.port]["Select Board"]["ardupilot"]
+    assert by_port[cube_black.port]["Board ID"] == 9
+    assert by_port[autopilot]["State"] == "Autopilot"
+    assert "CubeOrangePlus" in by_port[autopilot]["Select Board"]["ardupilot"]
+    assert by_port[silent] == {"Port": silent, "State": "No Response"}
+    # the bootloader probes and the heartbeat timeout overlap
+    assert elapsed < 1.5
+
+
+def test_scan_inventory_reports_failed_port(silent_ports):
+    silent, _ = silent_ports
+    with BootloaderSimulator(board_id=140) as cube_orange:
+        # a pty isn't enumerated, so it can't be found again after a reboot
+        rows = scan_inventory([silent, cube_orange.port], reboot=True)
+
+    by_port = {row["Port"]: row for row in rows}
+    assert by_port[silent]["State"] == "Failed"
+    assert by_port[silent]["Error"]
+    assert by_port[cube_orange.port]["State"] == "Bootloader"
+
+
+def test_format_inventory():
+    rows = [
+        {"Port": "COM3", "State": "Bootloader", "Board ID": 140, "Flash Size": 2080768,
+         "Select Board": {"ardupilot": ["CubeOrange", "CubeOrange-bdshot"], "px4": ["cubepilot_cubeorange_default"]}},
+        {"Port": "COM10", "State": "No Response"}
+    ]
+    lines = format_inventory(rows, ("Port", "State", "Board ID", "Select Board")).splitlines()
+
+    assert lines[0].split() == ["Port", "State", "Board", "ID", "Select", "Board"]
+    assert lines[1].split(None, 3) == ["COM3", "Bootloader", "140", "CubeOrange, CubeOrange-bdshot, cubepilot_cubeorange_default"]
+    assert lines[2].rstrip() == "COM10  No Response"
@@ -0,0 +1,41 @@
+from metrics import Histogram, PrometheusTextfileSink, UploadMetrics
+import pytest
+
+
+def test_histogram_quantile():
+    histogram = Histogram(bounds=(0.001, 0.01, 0.1))
+    for value in [0.0005] * 90 + [0.05] * 9 + [5]:
+        histogram.observe(value)
+
+    assert histogram.counts == [90, 0, 9, 1]
+    assert histogram.quantile(0.5) == 0.001
+    assert histogram.quantile(0.95) == 0.1
+    assert histogram.quantile(1) == float("inf")
+
+
+def test_merging_histograms_needs_the_same_buckets():
+    with pytest.raises(ValueError):
+        Histogram(bounds=(1,)).merge(Histogram(bounds=(2,)))
+
+
+def test_prometheus_textfile_sink_aggregates_uploads(tmp_path):
+    path = tmp_path / "firmup.prom"
+    sink = PrometheusTextfileSink(str(path))
+
+    for result in ("Completed", "Completed", "Failed"):
+        metrics = UploadMetrics(port="COM3", phases={"erase": 1.5, "upload": 2.0}, result=result)
+        metrics.ack_latency.observe(0.003)
+        metrics.bytes_acked = 1000
+        metrics.bytes_elided = 20
+        sink(metrics)
+
+    text = path.read_text()
+    assert 'firmup_uploads_total{result="Completed"} 2' in text
+    assert 'firmup_uploads_total{result="Failed"} 1' in text
+    assert 'firmup_phase_seconds_sum{phase="erase"} 4.500000' in text
+    assert 'firmup_phase_seconds_count{phase="upload"} 3' in text
+    assert 'firmup_ack_latency_seconds_bucket{le="0.005"} 3' in text
+    assert 'firmup_ack_latency_seconds_bucket{le="+Inf"} 3' in text
+    assert "firmup_uploaded_bytes_total 3000" in text
+    assert "firmup_elided_bytes_total 60" in text
+    assert list(tmp_path.iterdir()) == [path]
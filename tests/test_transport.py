@@ -0,0 +1,119 @@
+from bootloader_protocol import get_board_info, upload_firmware
+from firmware import Firmware
+from transport import SocketTransport
+import threading
+import socket
+import select
+import pytest
+import random
+import time
+import os
+
+if not hasattr(os, "openpty"):
+    pytest.skip("the bootloader simulator needs a pty", allow_module_level=True)
+
+from bootloader_simulator import BootloaderSimulator  # noqa: E402
+
+
+class Ser2Net:
+    """ Serves a serial port on a local TCP port, like ser2net in raw mode. """
+
+    def __init__(self, device: str) -> None:
+        self.device = device
+        self._server = socket.create_server(("127.0.0.1", 0))
+        self.url = f"tcp://127.0.0.1:{self._server.getsockname()[1]}"
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        connection, _ = self._server.accept()
+        fd = os.open(self.device, os.O_RDWR | os.O_NOCTTY)
+        try:
+            while not self._stop.is_set():
+                readable, _, _ = select.select([connection, fd], [], [], 0.05)
+                if connection in readable:
+                    data = connection.recv(4096)
+                    if not data:
+                        break
+                    os.write(fd, data)
+                if fd in readable:
+                    connection.sendall(os.read(fd, 4096))
+        finally:
+            os.close(fd)
+            connection.close()
+
+    def close(self) -> None:
+        self._stop.set()
+        self._server.close()
+        self._thread.join(1)
+
+
+@pytest.fixture
+def echo_server():
+    """ A TCP server that sends back what it receives, once `release` is set. """
+    server = socket.create_server(("127.0.0.1", 0))
+    release = threading.Event()
+
+    def serve():
+        connection, _ = server.accept()
+        with connection:
+            while data := connection.recv(4096):
+                release.wait()
+                connection.sendall(data)
+
+    threading.Thread(target=serve, daemon=True).start()
+    yield f"tcp://127.0.0.1:{server.getsockname()[1]}", release
+    server.close()
+
+
+def test_socket_transport_buffers_replies(echo_server):
+    url, release = echo_server
+    release.set()
+    with SocketTransport.from_url(url, timeout=1) as transport:
+        transport.write(b'\x12\x10\x12\x13')
+        assert transport.read(1) == b'\x12'
+        # the rest came with the first recv
+        assert transport._buffer == b'\x10\x12\x13'
+        assert transport.read(3) == b'\x10\x12\x13'
+
+
+def test_socket_transport_read_times_out(echo_server):
+    url, release = echo_server
+    with SocketTransport.from_url(url, timeout=0.1) as transport:
+        transport.write(b'\x12\x10')
+        start = time.monotonic()
+        assert transport.read(2) == b''
+        assert 0.1 <= time.monotonic() - start < 0.5
+
+        release.set()
+        time.sleep(0.1)
+        transport.reset_input_buffer()
+        assert transport.read(2) == b''
+
+
+@pytest.mark.parametrize("url", ["COM3", "tcp://localhost", "tcp://:3001"])
+def test_socket_transport_rejects_bad_urls(url):
+    with pytest.raises(ValueError):
+        SocketTransport.from_url(url)
+
+
+def test_upload_firmware_over_tcp():
+    image = random.Random(0).randbytes(50_000)
+    firmware = Firmware(board_id=9, image_size=len(image), image=image)
+    with BootloaderSimulator(board_id=9) as simulator:
+        ser2net = Ser2Net(simulator.port)
+        try:
+            progress = list(upload_firmware(ser2net.url, firmware, window=8))[-1]
+        finally:
+            ser2net.close()
+
+        assert progress["Port"] == ser2net.url
+        assert progress["Verifying Firmware"] == "Completed"
+        assert simulator.flash[:len(image)] == image
+
+
+def test_connect_over_tcp_needs_a_running_bootloader(echo_server):
+    url, _ = echo_server
+    with pytest.raises(RuntimeError, match="No bootloader answered"):
+        get_board_info(url)
@@ -0,0 +1,80 @@
+from bootloader_protocol import upload_firmware, CHIP_ERASE, PROGRAM_MULTIPLE_BYTES
+from firmware import Firmware
+from wire_trace import read_trace, summarize_trace, RX, TX
+import pytest
+import random
+import os
+
+if not hasattr(os, "openpty"):
+    pytest.skip("the bootloader simulator needs a pty", allow_module_level=True)
+
+from bootloader_simulator import BootloaderSimulator  # noqa: E402
+
+
+@pytest.fixture
+def firmware() -> Firmware:
+    image = random.Random(0).randbytes(20_000)
+    return Firmware(board_id=9, image_size=len(image), image=image)
+
+
+@pytest.fixture
+def trace(tmp_path, firmware: Firmware) -> str:
+    """ A recorded upload with a slow erase and one stalled chunk. """
+    path = str(tmp_path / "upload.trace")
+    with BootloaderSimulator(erase_time=0.3, latency=0.001) as simulator:
+        simulator.faults.stall_chunk = 10
+        simulator.faults.stall_time = 0.2
+        for progress in upload_firmware(simulator.port, firmware, trace_path=path):
+            pass
+    return path
+
+
+def test_upload_firmware_records_trace(trace: str, firmware: Firmware):
+    records = list(read_trace(trace))
+    written = b''.join(data for direction, _, data in records if direction == TX)
+    timestamps = [timestamp for _, timestamp, _ in records]
+
+    assert {direction for direction, _, _ in records} == {TX, RX}
+    assert timestamps == sorted(timestamps)
+    assert firmware.image[:252] in written
+
+    latencies = summarize_trace(trace)
+    assert min(latencies[CHIP_ERASE[0]]) >= 0.3
+    assert max(latencies[PROGRAM_MULTIPLE_BYTES[0]]) >= 0.2
+
+
+@pytest.mark.parametrize("window", [1, 8])
+def test_replay_reproduces_timing(trace: str, firmware: Firmware, window: int):
+    reported = []
+    updates = list(upload_firmware(f"replay://{trace}", firmware, window=window, metrics_sink=reported.append))
+
+    [metrics] = reported
+    assert updates[-1]["Verifying Firmware"] == "Completed"
+    assert metrics.phases["erase"] >= 0.3
+    assert metrics.ack_latency.quantile(1) >= 0.2
+
+
+def test_replay_negotiates_the_recorded_baudrate(tmp_path, firmware: Firmware):
+    path = str(tmp_path / "negotiated.trace")
+    with BootloaderSimulator() as simulator:
+        recorded = list(upload_firmware(simulator.port, firmware, negotiate_baudrate=True, trace_path=path))
+
+    replayed = list(upload_firmware(f"replay://{path}", firmware, negotiate_baudrate=True))
+
+    assert recorded[-1]["Baud Rate"] == replayed[-1]["Baud Rate"] == "2000000"
+    assert replayed[-1]["Verifying Firmware"] == "Completed"
+
+
+def test_replay_detects_divergence(trace: str):
+    image = random.Random(1).randbytes(20_000)
+    other = Firmware(board_id=9, image_size=len(image), image=image)
+    with pytest.raises(RuntimeError, match="diverged from the trace"):
+        for progress in upload_firmware(f"replay://{trace}", other):
+            pass
+
+
+def test_read_trace_rejects_other_files(tmp_path):
+    path = tmp_path / "not.trace"
+    path.write_bytes(b"{}")
+    with pytest.raises(ValueError):
+        list(read_trace(str(path)))